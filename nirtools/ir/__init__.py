@@ -1,197 +1,434 @@
 import os
-import gzip
+import re
+import heapq
+import pickle
+from operator import itemgetter
+from itertools import count
 from collections import defaultdict, OrderedDict
+from collections.abc import Mapping
+
+import numpy as np
+
+from . import parsing, fileio
+from .containers import Run, Qrels, ArrayView, as_dict
+
+BATCH_SIZE = 1 << 20
+
+
+def _qid_key(qid):
+    """
+    Sort key of a single qid: integer qids in int order, before any other qid in string order.
+    Same order as `_sorted_qids` for all-integer or all-string qids, usable to compare qids one pair at a time
+    """
+    try:
+        return 0, int(qid), ""
+    except ValueError:
+        return 1, 0, qid
+
+
+def _sorted_qids(qids):
+    try:
+        return sorted(qids, key=int)  # sort according to qid int value rather than string value
+    except (ValueError, TypeError):
+        return sorted(qids)
 
 
 def sort_qid_docid_value_dict(d):
     sorted_d = OrderedDict()
-    try:
-        qids = sorted(
-            d.keys(), key=lambda k: int(k)
-        )  # sort according to qid int value rather than string value
-    except:
-        qids = sorted(d.keys())
-
-    for qid in qids:  # sort according to label/score, from large to small
-        docs = sorted(d[qid].items(), key=lambda kv: kv[1], reverse=True)
+    for qid, docs in _iter_sorted_queries(d):  # sort according to label/score, from large to small
         sorted_d[qid] = {k: v for k, v in docs}
     return sorted_d
 
 
-def load_qrels(fn):
+def load_qrels(fn, as_array=False, cache=False):
     """
     Loading trec format query relevance file into a dictionary
 
     :param fn: qrel file path
+    :param as_array: bool, return the array-backed `Qrels` instead of nested dict. default False
+    :param cache: bool, reuse the binary sidecar `fn + ".nirbin"`, building it on first use or after `fn` changed
     :return: dict, in format {qid: {docid: label, ...}, ...}
     """
+    if cache:
+        from .binary import load_cached
+
+        qrels = load_cached(fn, kind="qrels", load_fn=lambda: load_qrels(fn, as_array=True))
+        return qrels if as_array else qrels.to_dict()
+
+    if as_array:
+        with fileio.open_input(fn, mode="rt") as f:
+            return Qrels.from_records(*_collect_records(_iter_rows(f, fmt="qrels")))
+
     qrels = defaultdict(dict)
-    with open(fn, "r", encoding="utf-8") as f:
+    qid = docs = None
+    with fileio.open_input(fn, mode="rt") as f:
         for line in f:
-            qid, _, docid, label = line.strip().split()
-            qrels[qid][docid] = int(label)
+            q, _, docid, label = line.split()
+            if q != qid:
+                qid, docs = q, qrels[q]
+            docs[docid] = int(label)
     return qrels
 
 
-def load_runs_tsv(fn, topk=None):
+def _check_topk(topk):
+    if topk is not None and (not isinstance(topk, int) or isinstance(topk, bool) or topk <= 0):
+        raise TypeError(f"Unexpected type of topk: expected positive int, but got {topk}")
+
+
+def _topk_items(docid2score, topk):
     """
-    Loading tsv format runfile into a dictionary
+    Equivalent to sorting the scores from large to small and keeping the first topk,
+    but in O(n log topk)
+    """
+    return {docid: score for docid, score in heapq.nlargest(topk, docid2score.items(), key=itemgetter(1))}
 
-    :param fn: runfile path
-    :return: dict, in format {qid: {docid: score, ...}, ...}
+
+def _iter_topk_rows(rows, topk):
     """
-    runs = defaultdict(dict)
-    with open(fn, "r", encoding="utf-8") as f:
-        for line in f:
-            qid, docid, rank = line.strip().split()
-            runs[qid][docid] = -int(rank)
+    Keep the topk (qid, docid, value) rows of each query in a bounded min-heap while reading, so the peak
+    memory is O(queries * topk) rather than the size of the runfile. A row only enters the heap when its
+    value beats the smallest one kept, which most rows of a long ranking do not.
 
-    if topk is not None:
-        if not isinstance(topk, int) and topk > 0:
-            raise TypeError(f'Unexpected type of topk: expected positive int, but got {topk}')
+    Same as `_topk_items` over the dict of each query: ties are kept in file order, and a docid repeated
+    in a query takes its last value, as long as the docid is still kept when it comes again.
 
-        for qid in runs:
-            docid2scores = sorted(runs[qid].items(), key=lambda kv: kv[1], reverse=True)[:topk]
-            runs[qid] = {docid: score for docid, score in docid2scores}
+    :return: a iterator yielding the kept rows, query by query in the order of their first row, and from
+        large to small value within a query
+    """
+    heaps = {}  # qid -> (heap of [value, -push order, docid], {docid: heap entry})
+    qid = heap = kept = None
+    order = count(0, -1)  # pushes come in file order, so later rows lose the ties
+    for q, docid, value in rows:
+        if q != qid:
+            qid = q
+            heap, kept = heaps.setdefault(q, ([], {}))
+        if docid in kept:
+            kept[docid][0] = value
+            heapq.heapify(heap)
+        elif len(heap) < topk:
+            kept[docid] = entry = [value, next(order), docid]
+            heapq.heappush(heap, entry)
+        elif value > heap[0][0]:
+            kept[docid] = entry = [value, next(order), docid]
+            del kept[heapq.heapreplace(heap, entry)[2]]
+
+    for qid, (heap, _) in heaps.items():
+        for value, _, docid in sorted(heap, reverse=True):
+            yield qid, docid, value
+
+
+def _iter_rows(lines, fmt="trec"):
+    """
+    :param fmt: str, "trec" or "tsv" runfile, or "qrels"
+    :return: a iterator yielding (qid, docid, value) for every line, where value is the score of trec runs,
+        the negative rank of tsv runs or the label of qrels
+    """
+    if fmt == "trec":
+        for line in lines:
+            qid, _, docid, _, score, _ = line.split()
+            yield qid, docid, float(score)
+    elif fmt == "tsv":
+        for line in lines:
+            qid, docid, rank = line.split()
+            yield qid, docid, -int(rank)
+    else:
+        for line in lines:
+            qid, _, docid, label = line.split()
+            yield qid, docid, int(label)
+
+
+def _text_array(values):
+    """
+    ASCII strings are kept as bytes, which `Run.from_records` sorts much faster than str
+    """
+    try:
+        return np.array(values, dtype="S")
+    except UnicodeEncodeError:
+        return np.array(values, dtype=str)
 
-    return runs
 
-def load_runs_from_file_contents(file_contents, topk=None):
-    runs = defaultdict(dict)
-    for line in file_contents:
-        qid, _, docid, _, score, _ = line.strip().split()
-        runs[qid][docid] = float(score)
+def _collect_records(rows, batch_size=BATCH_SIZE):
+    """
+    Collect the (qid, docid, value) rows into the aligned columns taken by `Run.from_records`, converting
+    them into arrays every batch_size rows to free the Python objects
 
-    if topk is not None:
-        if not isinstance(topk, int) and topk > 0:
-            raise TypeError(f'Unexpected type of topk: expected positive int, but got {topk}')
+    :return: (qids, docids, values), three aligned np.ndarray
+    """
+    parts, qids, starts, docids, values = [], [], [], [], []
+
+    def flush():
+        counts = np.diff(starts + [len(docids)])
+        parts.append((np.repeat(_text_array(qids), counts), _text_array(docids), np.array(values)))
+        for col in (qids, starts, docids, values):
+            col.clear()
+
+    qid = None
+    for q, docid, value in rows:
+        if q != qid:
+            if len(docids) >= batch_size:
+                flush()
+            qid = q
+            qids.append(q)
+            starts.append(len(docids))
+        docids.append(docid)
+        values.append(value)
+    if docids:
+        flush()
+
+    if not parts:
+        return np.array([], dtype=str), np.array([], dtype=str), np.array([])
+    return [_concatenate(part) for part in zip(*parts)]
+
+
+def _concatenate(parts):
+    """
+    Concatenate the parts of a column, converting bytes parts to str if any part is not ASCII
+    """
+    if any(part.dtype.kind == "U" for part in parts):
+        parts = [part.astype(str) for part in parts]
+    return np.concatenate(parts)
+
+
+def _load_runs_from_rows(rows, topk=None):
+    """
+    Build the array-backed `Run` from (qid, docid, score) rows, see `_collect_records` and `_iter_topk_rows`
+    """
+    _check_topk(topk)
+    return Run.from_records(*_collect_records(rows if topk is None else _iter_topk_rows(rows, topk)))
 
-        for qid in runs:
-            docid2scores = sorted(runs[qid].items(), key=lambda kv: kv[1], reverse=True)[:topk]
-            runs[qid] = {docid: score for docid, score in docid2scores}
 
+def _load_runs_from_lines(lines, fmt="trec", topk=None):
+    """
+    Fill the nested dict line by line, looking up the dict of a query only when the qid changes. With topk
+    given, only the topk documents of each query are kept while reading, see `_iter_topk_rows`
+    """
+    _check_topk(topk)
+    runs = defaultdict(dict)
+    if topk is not None:
+        for qid, docid, score in _iter_topk_rows(_iter_rows(lines, fmt=fmt), topk):
+            runs[qid][docid] = score
+        return runs
+
+    qid = docs = None
+    if fmt == "trec":
+        for line in lines:
+            q, _, docid, _, score, _ = line.split()
+            if q != qid:
+                qid, docs = q, runs[q]
+            docs[docid] = float(score)
+    else:
+        for line in lines:
+            q, docid, rank = line.split()
+            if q != qid:
+                qid, docs = q, runs[q]
+            docs[docid] = -int(rank)
     return runs
 
 
-def load_runs(fn, topk=None):
+def load_runs_tsv(fn, topk=None, as_array=False, num_workers=None):
     """
-    Loading trec format runfile into a dictionary
+    Loading tsv format runfile into a dictionary
 
     :param fn: runfile path
+    :param as_array: bool, return the array-backed `Run` instead of nested dict. default False
+    :param num_workers: int, parse the file with this many processes, see `parallel.load_runs_parallel`
     :return: dict, in format {qid: {docid: score, ...}, ...}
     """
-    with open(fn, "r", encoding="utf-8") as f:
-        runs = load_runs_from_file_contents(file_contents=f, topk=topk)
-    return runs
+    if num_workers is not None and num_workers > 1:
+        from .parallel import load_runs_parallel
+
+        return load_runs_parallel(fn, topk=topk, as_array=as_array, num_workers=num_workers, fmt="tsv")
 
+    with fileio.open_input(fn, mode="rt") as f:
+        if as_array:
+            return _load_runs_from_rows(_iter_rows(f, fmt="tsv"), topk=topk)
+        return _load_runs_from_lines(f, fmt="tsv", topk=topk)
 
-def write_qrels(qrels_dict, outp_fn):
-    outp_dir = os.path.dirname(outp_fn).strip("").rstrip("/")
-    if outp_dir:
-        os.makedirs(outp_dir, exist_ok=True)
 
-    sorted_qrels = sort_qid_docid_value_dict(qrels_dict)
-    with open(outp_fn, "w", encoding="utf-8") as f:
-        for qid in sorted_qrels:
-            for docid, value in sorted_qrels[qid].items():
-                f.write(f"{qid}\tQ0\t{docid}\t{value}\n")
+def load_runs_from_file_contents(file_contents, topk=None, as_array=False):
+    if as_array:
+        return _load_runs_from_rows(_iter_rows(file_contents), topk=topk)
+    return _load_runs_from_lines(file_contents, topk=topk)
 
 
-def write_runs(run_dict, outp_fn, label="test"):
-    outp_dir = os.path.dirname(outp_fn).strip("").rstrip("/")
-    if outp_dir:
-        os.makedirs(outp_dir, exist_ok=True)
+def load_runs(fn, topk=None, as_array=False, num_workers=None, cache=False):
+    """
+    Loading trec format runfile into a dictionary
 
-    sorted_run_dict = sort_qid_docid_value_dict(run_dict)
-    with open(outp_fn, "w", encoding="utf-8") as f:
-        for qid in sorted_run_dict:
-            for rank, (docid, score) in enumerate(sorted_run_dict[qid].items()):
-                f.write(f"{qid}\tQ0\t{docid}\t{rank+1}\t{score}\t{label}\n")
-                # e.g. 1 Q0 DOC_1 1 -0.1 test
+    :param fn: runfile path
+    :param as_array: bool, return the array-backed `Run` instead of nested dict. default False
+    :param num_workers: int, parse the file with this many processes, see `parallel.load_runs_parallel`
+    :param cache: bool, reuse the binary sidecar `fn + ".nirbin"`, building it on first use or after `fn` changed.
+        Reloading is almost free with `as_array=True`, since the arrays are memory-mapped
+    :return: dict, in format {qid: {docid: score, ...}, ...}
+    """
+    if cache:
+        from .binary import load_cached
 
+        _check_topk(topk)
+        runs = load_cached(fn, kind="run", load_fn=lambda: load_runs(fn, as_array=True, num_workers=num_workers))
+        runs = runs if topk is None else runs.topk(topk)
+        return runs if as_array else runs.to_dict()
 
-def _read_until_close_tag(f, close_tags):
-    def _is_end(line):
-        for close_tag in close_tags:
-            if line.startswith(close_tag):
-                return True
-        return False
+    if num_workers is not None and num_workers > 1:
+        from .parallel import load_runs_parallel
 
-    content = ""
-    while True:
-        line = f.readline()
-        if _is_end(line) or line == "":
-            content = content.split()
-            return content, line
+        return load_runs_parallel(fn, topk=topk, as_array=as_array, num_workers=num_workers)
 
-        content += line.strip()
+    with fileio.open_input(fn, mode="rt") as f:
+        runs = load_runs_from_file_contents(f, topk=topk, as_array=as_array)
+    return runs
 
 
-def load_topic_trec(topic_fn, fields=["title"]):
+def _iter_sorted_queries(d):
     """
-    Yield query id and specified field from trec-format topic file
+    Yield the queries one at a time, qids sorted as in `sort_qid_docid_value_dict` and documents sorted
+    from large to small value, without copying the whole dict
 
-    :param topic_fn: the path to the trec-topic file
-    :return: a iterator yielding (qid, field content)
+    :param d: dict in format {qid: {docid: value, ...}, ...}, array-backed `Run` or `Qrels`, or an iterable
+        of (qid, {docid: value, ...}) pairs, which is consumed lazily and kept in the given query order
+    :return: a iterator yielding (qid, iterable of (docid, value))
     """
-    qid, topic = "-1", {}
-    fields = sorted(fields, key=lambda name: {"title": 0, "desc": 1, "narr": 2}[name])
+    if isinstance(d, (Run, Qrels)):
+        for qid in _sorted_qids(d):
+            docids, values = d.query(qid)
+            order = np.argsort(-values, kind="stable")
+            yield qid, zip(docids[order].tolist(), values[order].tolist())
+        return
 
-    with open(topic_fn, "rt", encoding="utf-8") as f:
-        while True:
-            line = f.readline()
-            if line == "":
-                break
+    pairs = ((qid, d[qid]) for qid in _sorted_qids(d)) if isinstance(d, Mapping) else d
+    for qid, docid2value in pairs:
+        yield qid, sorted(docid2value.items(), key=itemgetter(1), reverse=True)
 
-            line = line.strip()
-            if line.startswith("<num>"):
-                if qid != "-1":
-                    yield qid, topic
-                qid = (
-                    line.replace("<num>", "")
-                    .replace("</num>", "")
-                    .replace("Number: ", "")
-                    .strip()
-                )
-                topic = {}
-                continue
 
-            for field in fields:
-                if not line.startswith(f"<{field}>"):
-                    continue
-
-                if field == "title":
-                    curline = (
-                        line.replace(f"<title>", "")
-                        .replace(f"</title>", "")
-                        .strip()
-                        .split()
-                    )
-                    topic["title"], line = _read_until_close_tag(f, ["\n", "<desc>"])
-                    topic["title"] = curline + topic["title"]
-
-                if field == "desc" or ("desc" in fields and line.startswith("<desc>")):
-                    curline = (
-                        line.replace(f"<desc>", "")
-                        .line.replace(f"</desc>", "")
-                        .replace("Description:", "")
-                        .strip()
-                        .split()
-                    )
-                    topic["desc"], line = _read_until_close_tag(f, ["\n", "<narr>"])
-                    topic["desc"] = curline + topic["desc"]
-
-                if field == "narr" or ("narr" in fields and line.startswith("<narr>")):
-                    curline = (
-                        line.replace(f"<narr>", "")
-                        .line.replace(f"</narr>", "")
-                        .replace("Narrative:", "")
-                        .strip()
-                        .split()
-                    )
-                    topic["narr"], line = _read_until_close_tag(f, ["\n", "</top>"])
-                    topic["narr"] = curline + topic["narr"]
-        yield qid, topic
+def write_qrels(qrels_dict, outp_fn, compresslevel=None):
+    """
+    Write qrels in trec format, compressed if outp_fn ends with .gz, .bz2, .xz or .zst
+
+    :param qrels_dict: see `_iter_sorted_queries`
+    """
+    with fileio.open_output(outp_fn, compresslevel=compresslevel) as f:
+        for qid, docs in _iter_sorted_queries(qrels_dict):
+            f.write("".join([f"{qid}\tQ0\t{docid}\t{value}\n" for docid, value in docs]))
+
+
+def write_runs(run_dict, outp_fn, label="test", compresslevel=None):
+    """
+    Write runs in trec format, compressed if outp_fn ends with .gz, .bz2, .xz or .zst.
+    Each query is sorted and formatted on its own and written in one call, so passing a generator of
+    (qid, {docid: score}) pairs streams the run without materializing it.
+
+    :param run_dict: see `_iter_sorted_queries`
+    """
+    with fileio.open_output(outp_fn, compresslevel=compresslevel) as f:
+        for qid, docs in _iter_sorted_queries(run_dict):
+            f.write(
+                "".join(
+                    [f"{qid}\tQ0\t{docid}\t{rank}\t{score}\t{label}\n" for rank, (docid, score) in enumerate(docs, 1)]
+                )  # e.g. 1 Q0 DOC_1 1 -0.1 test
+            )
+
+
+_TOPIC_TAG_PATTERN = re.compile(r"<(/?)([A-Za-z][\w-]*)[^>]*>")
+_TOPIC_LABEL_PATTERN = re.compile(r"^\s*(?:Number|Topic|Description|Narrative)\s*:", re.IGNORECASE)
+# tag names of TREC, NTCIR and CLEF topics, the latter with a language prefix, e.g. <EN-title>
+_TOPIC_FIELD_ALIASES = {
+    "num": "num", "title": "title", "desc": "desc", "description": "desc", "narr": "narr", "narrative": "narr",
+}
+TOPIC_CACHE_SUFFIX = ".topics.pkl"
+
+
+def _topic_field(tag):
+    tag = tag.lower()
+    if len(tag) > 3 and tag[2] == "-":
+        tag = tag[3:]
+    return _TOPIC_FIELD_ALIASES.get(tag)
+
+
+def _parse_topics(text, fields):
+    topics, qid, topic = {}, None, {}
+    tags = list(_TOPIC_TAG_PATTERN.finditer(text))
+    for i, tag in enumerate(tags):
+        closing, name = tag.groups()
+        if name.lower() == "top":
+            if qid is not None:
+                topics[qid] = topic
+            qid, topic = None, {}
+            continue
+
+        field = _topic_field(name)
+        if closing or (field != "num" and field not in fields):
+            continue
+
+        # a field runs until the next tag, whether it is closed (NTCIR, CLEF) or not (TREC)
+        end = tags[i + 1].start() if i + 1 < len(tags) else len(text)
+        content = " ".join(_TOPIC_LABEL_PATTERN.sub("", text[tag.end() : end]).split())
+        if field == "num":
+            qid = content
+        else:
+            topic[field] = content
+
+    if qid is not None:
+        topics[qid] = topic
+    return topics
+
+
+def load_topics(topic_fn, fields=("title",), cache=False):
+    """
+    Parse a TREC, NTCIR or CLEF topic file in one pass over its whole content. Tags are matched
+    case-insensitively, and <description>, <narrative> and language-prefixed tags such as <EN-title>
+    map onto title, desc and narr.
+
+    :param topic_fn: the path to the topic file, can be compressed
+    :param fields: list of str, "title", "desc" and "narr"
+    :param cache: bool, reuse the pickled sidecar `topic_fn + TOPIC_CACHE_SUFFIX`, building it on first use
+        or after `topic_fn` changed
+    :return: dict in format {qid: {field: content, ...}, ...}, where the content is whitespace-normalized
+        and the fields missing in a topic are skipped
+    """
+    fields = tuple(sorted(set(fields)))
+    unknown = set(fields) - {"title", "desc", "narr"}
+    if unknown:
+        raise ValueError(f"Unexpected topic fields {sorted(unknown)}, expected title, desc or narr")
+
+    if cache:
+        from .binary import source_stamp
+
+        cache_fn, stamp = topic_fn + TOPIC_CACHE_SUFFIX, source_stamp(topic_fn)
+        try:
+            with open(cache_fn, "rb") as f:
+                cached = pickle.load(f)
+            if cached["stamp"] == stamp and cached["fields"] == fields:
+                return cached["topics"]
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+            pass
+
+        topics = load_topics(topic_fn, fields)
+        tmp_fn = f"{cache_fn}.tmp{os.getpid()}"
+        try:
+            with open(tmp_fn, "wb") as f:
+                pickle.dump({"stamp": stamp, "fields": fields, "topics": topics}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_fn, cache_fn)
+        except OSError:  # e.g. read-only directory, the cache is only an optimization
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+        return topics
+
+    with fileio.open_input(topic_fn) as f:
+        text = f.read().decode("utf-8", errors="replace")
+    return _parse_topics(text, fields)
+
+
+def load_topic_trec(topic_fn, fields=["title"], cache=False):
+    """
+    Yield query id and specified field from trec-format topic file
+
+    :param topic_fn: the path to the trec-topic file
+    :param cache: bool, see `load_topics`
+    :return: a iterator yielding (qid, {field: list of tokens})
+    """
+    for qid, topic in load_topics(topic_fn, fields, cache=cache).items():
+        yield qid, {field: content.split() for field, content in topic.items()}
 
 
 def load_topic_tsv(topic_fn, delimiter="\t"):
@@ -202,53 +439,92 @@ def load_topic_tsv(topic_fn, delimiter="\t"):
     :param delimiter: str, the delimiter betwen id and content
     :return: a iterator yielding (qid, field content)
     """
-    with open(topic_fn) as f:
+    with fileio.open_input(topic_fn, "rt") as f:
         for line in f:
             qid, content = line.strip().split(delimiter)
             yield qid, content
 
 
-def load_collection_trec(coll_fn):
+def iter_trec_docs(f, chunk_size=parsing.CHUNK_SIZE):
     """
-    Return a iterator yielding doc id and contnet from trec-format collection file
+    Scan a binary trec-format collection stream for <DOC>...</DOC> blocks with bulk byte searches
 
-    :param coll_fn: path to the trec-format collection file
-    :return: a iterator yielding (docid, document content)
+    :param f: file object opened in binary mode
+    :param chunk_size: int, number of bytes read at a time
+    :return: a iterator yielding the bytes between <DOC> and </DOC>
     """
-    docid = ""
-    f = gzip.open(coll_fn) if coll_fn.endswith(".gz") else open(coll_fn, "rb")
+    buf = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
 
-    def read_nextline():
+        buf += chunk
+        pos = 0
         while True:
-            try:
-                line = f.readline()
-                line = line.decode().strip()
+            start = buf.find(b"<DOC>", pos)
+            if start == -1:  # keep a possibly truncated open tag
+                pos = max(pos, len(buf) - len(b"<DOC>"))
                 break
-            except:
-                print(f"invalid line:\t {line}")
-        return line
+            end = buf.find(b"</DOC>", start)
+            if end == -1:
+                pos = start
+                break
+            yield buf[start + len(b"<DOC>") : end]
+            pos = end + len(b"</DOC>")
+        buf = buf[pos:]
+
 
+def _find_fields(doc, tag):
+    open_tag, close_tag = b"<%s>" % tag, b"</%s>" % tag
+    contents, pos = [], 0
     while True:
-        line = read_nextline()
-        if line == "":
-            line = read_nextline()
-            if line == "":
-                break
+        start = doc.find(open_tag, pos)
+        if start == -1:
+            return contents
+        start += len(open_tag)
+        end = doc.find(close_tag, start)
+        end = len(doc) if end == -1 else end
+        contents.append(doc[start:end])
+        pos = end + len(close_tag)
 
-        if line.startswith("<DOCNO>"):
-            docid = line.replace("<DOCNO>", "").replace("</DOCNO>", "").strip()
 
-        if line == "<TEXT>":
-            doc = read_nextline()
-            while True:
-                line = read_nextline()
-                if line == "</TEXT>":
-                    break
-                doc += line
+def parse_trec_doc(doc, fields=("TEXT",)):
+    """
+    Extract the docno and the content of the given fields from one trec-format document
+
+    :param doc: bytes, the content between <DOC> and </DOC>
+    :param fields: list of str, the tags to extract, e.g. ("HEADLINE", "TEXT")
+    :return: (docid, content), where content joins all the fields with whitespace normalized,
+        or (docid, None) if none of the fields is present
+    """
+    docnos = _find_fields(doc, b"DOCNO")
+    docid = docnos[0].strip().decode("utf-8", errors="replace") if docnos else ""
 
-            assert docid != ""
-            yield docid, doc.strip()
-            docid = ""
+    contents = [content for field in fields for content in _find_fields(doc, field.encode())]
+    if not contents:
+        return docid, None
+    content = contents[0] if len(contents) == 1 else b" ".join(contents)
+    return docid, b" ".join(content.split()).decode("utf-8", errors="replace")
+
+
+def load_collection_trec(coll_fn, fields=("TEXT",)):
+    """
+    Return a iterator yielding doc id and contnet from trec-format collection file.
+    Documents without any of the fields are skipped.
+
+    :param coll_fn: path to the trec-format collection file, can be compressed
+    :param fields: list of str, the tags whose content is yielded, default ("TEXT",)
+    :return: a iterator yielding (docid, document content)
+    """
+    with fileio.open_input(coll_fn) as f:
+        for doc in iter_trec_docs(f):
+            docid, content = parse_trec_doc(doc, fields)
+            if content is None:
+                continue
+            if docid == "":
+                raise ValueError(f"Found a document without <DOCNO>: {doc[:200]!r}")
+            yield docid, content
 
 
 def load_collection_tsv(coll_fn, delimiter="\t"):
@@ -259,7 +535,7 @@ def load_collection_tsv(coll_fn, delimiter="\t"):
     :param delimiter: str, the delimiter betwen id and content
     :return: a iterator yielding (qid, field content)
     """
-    with open(coll_fn) as f:
+    with fileio.open_input(coll_fn, "rt") as f:
         for line in f:
             docid, content = line.strip().split(delimiter)
             yield docid, content
@@ -0,0 +1,161 @@
+"""
+Compact binary format of the array-backed Run and Qrels, loaded back with mmap and without copy.
+
+Layout: the magic bytes, a little-endian uint64 header length, the json header, then every array at
+a 64-byte aligned offset. The header records the dtype, shape and offset of each array (the query
+and docid string tables, the per-query offsets, the docid codes and the values) and, for cache
+sidecars, the mtime and size of the text file it was built from.
+"""
+import os
+import json
+import struct
+
+import numpy as np
+
+from .containers import Run, Qrels
+
+MAGIC = b"NIRBIN1\n"
+ALIGN = 64
+CACHE_SUFFIX = ".nirbin"
+
+_ARRAYS = ("qids", "docids", "offsets", "doc_codes", "values")
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def source_stamp(fn):
+    """
+    :return: dict, the mtime and size of the given file, used to validate a cache sidecar
+    """
+    stat = os.stat(fn)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _save(obj, fn, kind, value_dtype, source=None):
+    arrays = {name: np.ascontiguousarray(getattr(obj, name)) for name in _ARRAYS}
+    if value_dtype is not None:
+        arrays["values"] = arrays["values"].astype(value_dtype)
+
+    specs, offset = {}, 0
+    for name, arr in arrays.items():
+        specs[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset = _align(offset + arr.nbytes)
+    header = json.dumps({"kind": kind, "source": source, "arrays": specs}).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    outp_dir = os.path.dirname(fn)
+    if outp_dir:
+        os.makedirs(outp_dir, exist_ok=True)
+    tmp_fn = f"{fn}.tmp{os.getpid()}"
+    try:
+        with open(tmp_fn, "wb") as f:
+            f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+            for name, arr in arrays.items():
+                f.seek(data_start + specs[name]["offset"])
+                f.write(arr.tobytes())
+            f.truncate(data_start + offset)
+        os.replace(tmp_fn, fn)  # readers never see a partially written file
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+
+def _read_header(fn):
+    with open(fn, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{fn} is not a nirtools binary file")
+        (length,) = struct.unpack("<Q", f.read(8))
+        return json.loads(f.read(length)), _align(len(MAGIC) + 8 + length)
+
+
+def _load(fn, kind, cls):
+    header, data_start = _read_header(fn)
+    if header["kind"] != kind:
+        raise ValueError(f"Expect a binary {kind} file, but {fn} holds {header['kind']}")
+
+    buf = np.memmap(fn, mode="r", dtype=np.uint8)
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        start = data_start + spec["offset"]
+        nbytes = int(np.prod(spec["shape"])) * dtype.itemsize
+        arrays[name] = buf[start : start + nbytes].view(dtype).reshape(spec["shape"])
+    return cls(**arrays)
+
+
+def save_runs_binary(runs, fn, score_dtype=np.float32, source=None):
+    """
+    Save the run into the binary format
+
+    :param runs: `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param fn: output path
+    :param score_dtype: numpy dtype of the stored scores, default float32; None keeps the dtype of the run
+    :param source: dict, stamp of the text file the run was loaded from, see `source_stamp`
+    """
+    runs = runs if isinstance(runs, Run) else Run.from_dict(runs)
+    _save(runs, fn, kind="run", value_dtype=score_dtype, source=source)
+
+
+def load_runs_binary(fn):
+    """
+    Memory-map a run saved by `save_runs_binary`, the arrays of the returned `Run` are views of the file
+
+    :param fn: binary run path
+    :return: Run
+    """
+    return _load(fn, kind="run", cls=Run)
+
+
+def save_qrels_binary(qrels, fn, source=None):
+    """
+    Save the qrels into the binary format
+
+    :param qrels: `Qrels` or dict in format {qid: {docid: label, ...}, ...}
+    :param fn: output path
+    :param source: dict, stamp of the text file the qrels was loaded from, see `source_stamp`
+    """
+    qrels = qrels if isinstance(qrels, Qrels) else Qrels.from_dict(qrels)
+    _save(qrels, fn, kind="qrels", value_dtype=None, source=source)
+
+
+def load_qrels_binary(fn):
+    """
+    Memory-map a qrels saved by `save_qrels_binary`
+
+    :param fn: binary qrels path
+    :return: Qrels
+    """
+    return _load(fn, kind="qrels", cls=Qrels)
+
+
+def load_cached(fn, kind, load_fn):
+    """
+    Load the run or qrels from the sidecar `fn + CACHE_SUFFIX` if it was built from the current
+    version of `fn`, otherwise load it with `load_fn` and (re)build the sidecar.
+    Scores are cached as float64 so the cached run equals the parsed one.
+
+    :param fn: text file path
+    :param kind: str, "run" or "qrels"
+    :param load_fn: callable returning the array-backed `Run` or `Qrels` parsed from `fn`
+    """
+    cache_fn, stamp = fn + CACHE_SUFFIX, source_stamp(fn)
+    save, load = {
+        "run": (lambda obj: save_runs_binary(obj, cache_fn, score_dtype=None, source=stamp), load_runs_binary),
+        "qrels": (lambda obj: save_qrels_binary(obj, cache_fn, source=stamp), load_qrels_binary),
+    }[kind]
+
+    try:
+        header, _ = _read_header(cache_fn)
+        if header["kind"] == kind and header["source"] == stamp:
+            return load(cache_fn)
+    except (OSError, ValueError, KeyError, struct.error):
+        pass
+
+    obj = load_fn()
+    try:
+        save(obj)
+    except OSError:  # e.g. read-only directory, the cache is only an optimization
+        return obj
+    return load(cache_fn)
@@ -0,0 +1,227 @@
+"""
+Sharded iteration over trec or tsv collections, and a multi-process map over all the documents.
+
+A collection (a single file, or a directory of files) is cut into units: document-aligned byte ranges
+of the uncompressed files, whole compressed files, and for a single compressed file one strided pass
+per shard (every shard decompresses the stream, but only parses its own documents). Worker processes
+handle the units round-robin and stream their results back through bounded queues, so the consumer
+can restore the collection order while memory stays flat.
+"""
+import os
+import traceback
+import multiprocessing
+from itertools import islice, zip_longest
+
+from . import parsing, fileio, iter_trec_docs, parse_trec_doc
+from .parallel import split_byte_ranges, RangeReader
+
+BATCH_SIZE = 256
+QUEUE_SIZE = 8
+UNITS_PER_WORKER = 8
+
+_MISSING = object()
+
+
+def list_collection_files(path):
+    """
+    :param path: a collection file or a directory of collection files
+    :return: list of str, the sorted file paths, hidden files skipped
+    """
+    if not os.path.isdir(path):
+        return [path]
+    names = sorted(name for name in os.listdir(path) if not name.startswith("."))
+    return [os.path.join(path, name) for name in names if os.path.isfile(os.path.join(path, name))]
+
+
+def guess_format(fn):
+    """
+    :return: str, "trec" if the (possibly compressed) file starts with a tag, otherwise "tsv"
+    """
+    with fileio.open_input(fn) as f:
+        head = f.read(4096).lstrip()
+    return "trec" if head.startswith(b"<") else "tsv"
+
+
+def _iter_docs(f, fmt, fields, delimiter):
+    if fmt == "trec":
+        for doc in iter_trec_docs(f):
+            docid, content = parse_trec_doc(doc, fields)
+            if content is None:
+                continue
+            if docid == "":
+                raise ValueError(f"Found a document without <DOCNO>: {doc[:200]!r}")
+            yield docid, content
+        return
+
+    for chunk in parsing.iter_chunks(f):
+        lines = chunk.decode("utf-8").split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        for line in lines:
+            docid, content = line.strip().split(delimiter)
+            yield docid, content
+
+
+def _iter_unit(unit, fmt, fields, delimiter):
+    """
+    :param unit: (fn, start, end, stride, offset), start is None for the whole (possibly compressed) file
+    """
+    fn, start, end, stride, offset = unit
+    with (fileio.open_input(fn) if start is None else RangeReader(fn, start, end)) as f:
+        docs = _iter_docs(f, fmt or guess_format(fn), fields, delimiter)
+        if stride > 1:
+            docs = islice(docs, offset, None, stride)
+        yield from docs
+
+
+def _is_single_stream(fns):
+    return len(fns) == 1 and fileio.detect_compression(fns[0]) is not None
+
+
+def _split_units(path, num_units, fmt=None):
+    """
+    Cut the collection into about `num_units` units in collection order, files smaller than the
+    average unit are not split
+
+    :return: list of (fn, start, end, stride, offset)
+    """
+    fns = list_collection_files(path)
+    if _is_single_stream(fns):
+        return [(fns[0], None, None, num_units, offset) for offset in range(num_units)]
+
+    sizes = [os.path.getsize(fn) for fn in fns]
+    range_size = max(sum(sizes) // max(num_units, 1), 1)
+    units = []
+    for fn, size in zip(fns, sizes):
+        num_ranges = size // range_size if len(fns) > 1 else num_units
+        if num_ranges <= 1 or fileio.detect_compression(fn) is not None:
+            units.append((fn, None, None, 1, 0))
+            continue
+
+        # trec documents may be preceded by anything, so trec ranges start right at a <DOC> tag
+        if (fmt or guess_format(fn)) == "trec":
+            ranges = split_byte_ranges(fn, num_ranges, delimiter=b"<DOC>", after=False)
+        else:
+            ranges = split_byte_ranges(fn, num_ranges)
+        units.extend((fn, start, end, 1, 0) for start, end in ranges)
+    return units
+
+
+def iter_collection(path, num_shards=1, shard_id=0, fmt=None, fields=("TEXT",), delimiter="\t"):
+    """
+    Yield the documents of one shard of a collection. The shards are disjoint and together cover the
+    whole collection, so `num_shards` independent jobs can each process `shard_id` in range(num_shards).
+
+    :param path: a trec or tsv collection file (can be compressed), or a directory of collection files
+    :param num_shards: int, number of shards
+    :param shard_id: int, the shard to iterate over, in range(num_shards)
+    :param fmt: str, "trec" or "tsv", guessed from the content of each file by default
+    :param fields: list of str, the tags yielded from trec-format documents, see `load_collection_trec`
+    :param delimiter: str, the delimiter between id and content of tsv-format collections
+    :return: a iterator yielding (docid, document content)
+    """
+    if fmt not in (None, "trec", "tsv"):
+        raise ValueError(f"Unexpected collection format {fmt}, expected 'trec' or 'tsv'")
+    if not 0 <= shard_id < num_shards:
+        raise ValueError(f"Expect 0 <= shard_id < num_shards, but got shard {shard_id} of {num_shards}")
+
+    for unit in _split_units(path, num_shards, fmt=fmt)[shard_id::num_shards]:
+        yield from _iter_unit(unit, fmt, fields, delimiter)
+
+
+def _worker(fn, units, unit_ids, queue, fmt, fields, delimiter, batch_size):
+    """
+    Put (unit id, [results]) batches, then (unit id, None) at the end of each unit, and
+    (None, traceback) on failure
+    """
+    try:
+        for unit_id in unit_ids:
+            batch = []
+            for docid, content in _iter_unit(units[unit_id], fmt, fields, delimiter):
+                batch.append(fn(docid, content))
+                if len(batch) == batch_size:
+                    queue.put((unit_id, batch))
+                    batch = []
+            if batch:
+                queue.put((unit_id, batch))
+            queue.put((unit_id, None))
+    except BaseException:
+        queue.put((None, traceback.format_exc()))
+
+
+def _get(queue):
+    unit_id, batch = queue.get()
+    if unit_id is None:
+        raise RuntimeError(f"parallel_map worker failed:\n{batch}")
+    return unit_id, batch
+
+
+def _iter_unit_results(queue):
+    while True:
+        _, batch = _get(queue)
+        if batch is None:
+            return
+        yield from batch
+
+
+def parallel_map(fn, collection, workers=None, ordered=True, fmt=None, fields=("TEXT",), delimiter="\t",
+                 batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE):
+    """
+    Apply fn to every document of the collection in worker processes
+
+    :param fn: callable taking (docid, content), must be picklable unless processes are forked
+    :param collection: a trec or tsv collection file (can be compressed), or a directory of collection files
+    :param workers: int, number of processes, default to the number of cpus
+    :param ordered: bool, yield the results in collection order, otherwise as soon as they are ready
+    :param fmt, fields, delimiter: see `iter_collection`
+    :param batch_size: int, number of results sent back at a time
+    :param queue_size: int, number of batches each worker can get ahead of the consumer
+    :return: a iterator yielding fn(docid, content)
+    """
+    if fmt not in (None, "trec", "tsv"):
+        raise ValueError(f"Unexpected collection format {fmt}, expected 'trec' or 'tsv'")
+    workers = workers or os.cpu_count()
+    # a single compressed stream is read once per worker, otherwise more units than workers balance the load
+    num_units = workers if _is_single_stream(list_collection_files(collection)) else workers * UNITS_PER_WORKER
+    units = _split_units(collection, num_units, fmt=fmt)
+    workers = max(min(workers, len(units)), 1)
+    if workers == 1:
+        for unit in units:
+            for docid, content in _iter_unit(unit, fmt, fields, delimiter):
+                yield fn(docid, content)
+        return
+
+    ctx = multiprocessing.get_context()
+    queues = [ctx.Queue(maxsize=queue_size) for _ in range(workers if ordered else 1)]
+    procs = [
+        ctx.Process(
+            target=_worker,
+            args=(fn, units, range(i, len(units), workers), queues[i if ordered else 0], fmt, fields, delimiter,
+                  batch_size),
+            daemon=True,
+        )
+        for i in range(workers)
+    ]
+    for proc in procs:
+        proc.start()
+
+    try:
+        if not ordered:
+            remaining = len(units)
+            while remaining:
+                _, batch = _get(queues[0])
+                if batch is None:
+                    remaining -= 1
+                else:
+                    yield from batch
+        elif units[0][3] > 1:  # strided passes over one stream: interleave the results document by document
+            for results in zip_longest(*(_iter_unit_results(queue) for queue in queues), fillvalue=_MISSING):
+                yield from (result for result in results if result is not _MISSING)
+        else:  # unit i is handled by worker i % workers, so taking the units in turn restores the order
+            for unit_id in range(len(units)):
+                yield from _iter_unit_results(queues[unit_id % workers])
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
@@ -0,0 +1,416 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def _first_appearance_codes(values):
+    """
+    Intern the given strings into integer codes numbered by first appearance. Only the first value of
+    each block of equal consecutive values is hashed, which is cheap for qid columns of runfiles.
+
+    :param values: np.ndarray of str or bytes
+    :return: (vocab, codes), where vocab[codes] == values
+    """
+    starts = np.flatnonzero(values[1:] != values[:-1]) + 1
+    starts = np.concatenate([[0], starts]) if len(values) else starts
+    vocab = {}
+    block_codes = [vocab.setdefault(v, len(vocab)) for v in values[starts].tolist()]
+    codes = np.repeat(np.asarray(block_codes, dtype=np.int64), np.diff(np.append(starts, len(values))))
+    return np.array(list(vocab), dtype=values.dtype), codes
+
+
+def _as_text(values):
+    """
+    Keep str and bytes arrays as they are, convert other sequences into str arrays
+    """
+    if isinstance(values, np.ndarray) and values.dtype.kind in "SU":
+        return values
+    return np.asarray(values, dtype=str)
+
+
+def _sorted_codes(values):
+    """
+    Sorted vocabulary of the given strings, like `np.unique(values, return_inverse=True)`. Bytes arrays,
+    e.g. the ASCII docids collected by the loaders, are sorted as big-endian 8-byte words past their common
+    prefix, which is much faster than comparing the strings.
+
+    :param values: np.ndarray of str or bytes
+    :return: (vocab, codes, order), where vocab[codes] == values and order is the stable sorting order of values
+    """
+    if values.dtype.kind == "S" and len(values):
+        mat = values.view(np.uint8).reshape(len(values), values.dtype.itemsize)
+        same = (mat == mat[0]).all(axis=0)
+        prefix = values.dtype.itemsize if same.all() else int(np.argmin(same))
+        words = np.zeros((len(values), (values.dtype.itemsize - prefix + 7) // 8 * 8), dtype=np.uint8)
+        words[:, : values.dtype.itemsize - prefix] = mat[:, prefix:]
+        words = words.view(">u8")
+        order = np.lexsort(words.T[::-1]) if words.shape[1] else np.arange(len(values))
+        sorted_words = words[order]
+        is_new = np.concatenate([[True], (sorted_words[1:] != sorted_words[:-1]).any(axis=1)])
+    else:
+        order = np.argsort(values, kind="stable")
+        sorted_values = values[order]
+        is_new = np.concatenate([[True], sorted_values[1:] != sorted_values[:-1]])[: len(values)]
+
+    codes = np.empty(len(values), dtype=np.int64)
+    codes[order] = np.cumsum(is_new) - 1
+    return values[order[is_new]], codes, order
+
+
+def _code_dtype(n):
+    return np.int32 if n < np.iinfo(np.int32).max else np.int64
+
+
+class _ArrayBacked(Mapping):
+    """
+    Columnar storage of a {qid: {docid: value}} mapping.
+
+    Queries are kept in storage order in `qids`; the entries of the i-th query live in
+    `doc_codes[offsets[i]:offsets[i+1]]` and `values[offsets[i]:offsets[i+1]]`, where the codes
+    index into the sorted docid vocabulary `docids`.
+    """
+
+    _value_dtype = None
+
+    def __init__(self, qids, docids, offsets, doc_codes, values):
+        self.qids = np.asarray(qids, dtype=str)
+        self.docids = np.asarray(docids, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.doc_codes = np.asarray(doc_codes)
+        self.values = np.asarray(values)
+        if self.values.dtype.kind not in "fiu":
+            self.values = self.values.astype(self._value_dtype)
+
+        if len(self.offsets) != len(self.qids) + 1:
+            raise ValueError(
+                f"Expect {len(self.qids) + 1} offsets for {len(self.qids)} queries, but got {len(self.offsets)}"
+            )
+        if len(self.doc_codes) != len(self.values):
+            raise ValueError(f"Expect same number of docids and values.")
+        self._qid2idx = None
+
+    @classmethod
+    def from_records(cls, qids, docids, values):
+        """
+        Build the container from three aligned columns, one row per (qid, docid, value) line.
+        Queries and documents keep their order of first appearance, and a repeated (qid, docid) pair
+        keeps its last value, same as filling a dict line by line.
+
+        :param qids: sequence of str, or np.ndarray of ASCII bytes
+        :param docids: sequence of str, or np.ndarray of ASCII bytes
+        :param values: sequence of numbers
+        """
+        qids, docids = _as_text(qids), _as_text(docids)
+        values = np.asarray(values, dtype=cls._value_dtype)
+        if not len(qids) == len(docids) == len(values):
+            raise ValueError(f"Expect columns of same length.")
+
+        qid_vocab, qid_codes = _first_appearance_codes(qids)
+        doc_vocab, doc_codes, doc_order = _sorted_codes(docids)
+
+        # rows grouped by query in order of first appearance, with no repeated (qid, docid) pair,
+        # are kept as they are; a repeated pair shows up as equal neighbours in the stable docid order
+        grouped = (np.diff(qid_codes) >= 0).all()
+        if grouped:
+            sorted_qids, sorted_docs = qid_codes[doc_order], doc_codes[doc_order]
+            grouped = not ((sorted_docs[1:] == sorted_docs[:-1]) & (sorted_qids[1:] == sorted_qids[:-1])).any()
+
+        if grouped:
+            first = last = np.arange(len(values))
+        else:
+            # rows of a repeated (qid, docid) pair collapse into the position of the first and the value of the last
+            keys = qid_codes * max(len(doc_vocab), 1) + doc_codes
+            order = np.argsort(keys, kind="stable")
+            sorted_keys = keys[order]
+            is_new = np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])[: len(keys)]
+            if is_new.all():
+                first = last = np.arange(len(keys))
+            else:
+                group_starts = np.flatnonzero(is_new)
+                first, last = order[group_starts], order[np.append(group_starts[1:], len(keys)) - 1]
+                order = np.argsort(first)
+                first, last = first[order], last[order]
+
+            order = np.argsort(qid_codes[first], kind="stable")
+            first, last = first[order], last[order]
+
+        counts = np.bincount(qid_codes[first], minlength=len(qid_vocab))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(
+            qids=qid_vocab,
+            docids=doc_vocab,
+            offsets=offsets,
+            doc_codes=doc_codes[first].astype(_code_dtype(len(doc_vocab))),
+            values=values[last],
+        )
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        Concatenate the containers in order, same as `from_records` over all their rows. When no query
+        is in several parts, only the sorted docid vocabularies are merged, in about linear time.
+
+        :param parts: iterable of containers of this type
+        """
+        parts = list(parts)
+        if not parts:
+            return cls.from_records([], [], [])
+        qids = np.concatenate([part.qids for part in parts])
+        if len(set(qids.tolist())) < len(qids):
+            records = zip(*(part.to_records() for part in parts))
+            return cls.from_records(*(np.concatenate(col) for col in records))
+
+        doc_vocab, codes, _ = _sorted_codes(np.concatenate([part.docids for part in parts]))  # merges sorted runs
+        doc_codes, start = [], 0
+        for part in parts:
+            doc_codes.append(codes[start : start + len(part.docids)][part.doc_codes])
+            start += len(part.docids)
+        counts = np.concatenate([np.diff(part.offsets) for part in parts])
+        return cls(
+            qids=qids,
+            docids=doc_vocab,
+            offsets=np.concatenate([[0], np.cumsum(counts)]),
+            doc_codes=np.concatenate(doc_codes).astype(_code_dtype(len(doc_vocab))),
+            values=np.concatenate([part.values for part in parts]),
+        )
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Build the container from a dict in format {qid: {docid: value, ...}, ...}
+        """
+        qids, docids, values = [], [], []
+        for qid, docid2value in d.items():
+            qids.extend([qid] * len(docid2value))
+            docids.extend(docid2value.keys())
+            values.extend(docid2value.values())
+        return cls.from_records(qids, docids, values)
+
+    def to_dict(self):
+        """
+        :return: dict, in format {qid: {docid: value, ...}, ...}
+        """
+        return {qid: self[qid] for qid in self}
+
+    def to_records(self):
+        """
+        :return: (qids, docids, values), three aligned np.ndarray with one row per entry
+        """
+        return np.repeat(self.qids, np.diff(self.offsets)), self.docids[self.doc_codes], self.values
+
+    @property
+    def num_entries(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return sum(
+            arr.nbytes for arr in (self.qids, self.docids, self.offsets, self.doc_codes, self.values)
+        )
+
+    def index(self, qid):
+        """
+        :return: int, the position of the given query in storage order
+        """
+        if self._qid2idx is None:
+            self._qid2idx = {qid: i for i, qid in enumerate(self.qids.tolist())}
+        return self._qid2idx[qid]
+
+    def query(self, qid):
+        """
+        Array view of a single query, without building a dict
+
+        :param qid: str
+        :return: (docids, values), two aligned np.ndarray
+        """
+        i = self.index(qid)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.docids[self.doc_codes[start:end]], self.values[start:end]
+
+    def query_codes(self):
+        """
+        :return: np.ndarray, the query position of every entry
+        """
+        return np.repeat(np.arange(len(self.qids)), np.diff(self.offsets))
+
+    def subset(self, qids):
+        """
+        Keep only the given queries, in the given order; queries not in the container are skipped
+
+        :param qids: iterable of str
+        """
+        indices = np.array([self.index(qid) for qid in qids if qid in self], dtype=np.int64)
+        starts, counts = self.offsets[indices], np.diff(self.offsets)[indices]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        entries = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        return type(self)(
+            qids=self.qids[indices],
+            docids=self.docids,
+            offsets=offsets,
+            doc_codes=self.doc_codes[entries],
+            values=self.values[entries],
+        )
+
+    def view(self, qids=None, depth=None):
+        """
+        Select queries and the top entries of each query without copying the arrays, see `ArrayView`
+
+        :param qids: iterable of str, the queries to keep in the given order, default to all;
+            queries not in the container are skipped
+        :param depth: int, keep the depth entries with the largest values per query
+        """
+        return ArrayView(self, qids=qids, depth=depth)
+
+    def topk(self, k):
+        """
+        Keep the k entries with the largest values per query, sorted from large to small.
+        Ties keep their storage order.
+
+        :param k: positive int
+        """
+        qcodes = self.query_codes()
+        order = np.lexsort((-self.values, qcodes))
+        ranks = np.arange(len(order)) - self.offsets[qcodes]
+        keep = order[ranks < k]
+        counts = np.minimum(np.diff(self.offsets), k)
+        return type(self)(
+            qids=self.qids,
+            docids=self.docids,
+            offsets=np.concatenate([[0], np.cumsum(counts)]),
+            doc_codes=self.doc_codes[keep],
+            values=self.values[keep],
+        )
+
+    def __getitem__(self, qid):
+        try:
+            docids, values = self.query(qid)
+        except KeyError:
+            raise KeyError(qid) from None
+        return dict(zip(docids.tolist(), values.tolist()))
+
+    def __contains__(self, qid):
+        try:
+            self.index(qid)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.qids.tolist())
+
+    def __len__(self):
+        return len(self.qids)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(queries={len(self)}, entries={self.num_entries})"
+
+
+class Run(_ArrayBacked):
+    """
+    Array-backed runfile, dict-like in format {qid: {docid: score, ...}, ...}
+    """
+
+    _value_dtype = np.float64
+
+    @property
+    def scores(self):
+        return self.values
+
+
+class Qrels(_ArrayBacked):
+    """
+    Array-backed qrels, dict-like in format {qid: {docid: label, ...}, ...}
+    """
+
+    _value_dtype = np.int32
+
+    @property
+    def labels(self):
+        return self.values
+
+
+class ArrayView(Mapping):
+    """
+    Read-only selection of the queries of a `Run` or `Qrels`, and of the top entries of each, sharing
+    the arrays of the container. The entries of a query are slices of the container arrays, except
+    for the queries cut to depth whose entries are not already sorted from large to small value.
+    Use `materialize` to get a standalone container, e.g. for the native metrics.
+    """
+
+    def __init__(self, base, qids=None, depth=None):
+        self.base = base
+        self.depth = depth
+        self.qids = base.qids if qids is None else np.array([qid for qid in qids if qid in base], dtype=str)
+        self._qid2idx = None
+        self._is_sorted = None
+
+    def _index(self, qid):
+        if self._qid2idx is None:
+            self._qid2idx = {qid: self.base.index(qid) for qid in self.qids.tolist()}
+        return self._qid2idx[qid]
+
+    def _sorted(self):
+        if self._is_sorted is None:
+            values, offsets = self.base.values, self.base.offsets
+            non_increasing = values[1:] <= values[:-1]
+            bounds = offsets[1:-1]
+            bounds = bounds[(bounds > 0) & (bounds < len(values))]  # empty queries put bounds at the ends
+            non_increasing[bounds - 1] = True  # no order across queries
+            self._is_sorted = bool(non_increasing.all())
+        return self._is_sorted
+
+    def query(self, qid):
+        """
+        :return: (docids, values), two aligned np.ndarray, in storage order or, when cut to depth,
+            sorted from large to small value with ties in storage order
+        """
+        i = self._index(qid)
+        start, end = self.base.offsets[i], self.base.offsets[i + 1]
+        if self.depth is not None and end - start > self.depth:
+            if self._sorted():
+                end = start + self.depth
+            else:
+                order = start + np.argsort(-self.base.values[start:end], kind="stable")[: self.depth]
+                return self.base.docids[self.base.doc_codes[order]], self.base.values[order]
+        return self.base.docids[self.base.doc_codes[start:end]], self.base.values[start:end]
+
+    def materialize(self):
+        """
+        :return: the selection as a `Run` or `Qrels` of its own
+        """
+        subset = self.base.subset(self.qids.tolist())
+        return subset if self.depth is None else subset.topk(self.depth)
+
+    def to_dict(self):
+        return {qid: self[qid] for qid in self}
+
+    def __getitem__(self, qid):
+        try:
+            docids, values = self.query(qid)
+        except KeyError:
+            raise KeyError(qid) from None
+        return dict(zip(docids.tolist(), values.tolist()))
+
+    def __contains__(self, qid):
+        try:
+            self._index(qid)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.qids.tolist())
+
+    def __len__(self):
+        return len(self.qids)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.base!r}, queries={len(self)}, depth={self.depth})"
+
+
+def as_dict(d):
+    """
+    Convert the array-backed Run, Qrels or their views into the nested dict expected by pytrec_eval
+    and ir_measures, leave other objects unchanged
+    """
+    return d.to_dict() if isinstance(d, (_ArrayBacked, ArrayView)) else d
@@ -0,0 +1,324 @@
+"""
+Random access to the documents of a trec or tsv collection file.
+
+`build_docstore` scans the collection once and saves, for every docid, where its raw record (the
+<DOC>...</DOC> block or the tsv line) is found. Uncompressed collections are read in place at the
+recorded byte offsets. Compressed streams cannot be seeked, so their records are recompressed into a
+sidecar of independently zlib-compressed blocks of whole records, and the index records the block and
+the offset inside the decompressed block instead.
+"""
+import os
+import json
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import numpy as np
+
+from . import parsing, fileio, parse_trec_doc, _find_fields
+from .binary import source_stamp
+
+INDEX_SUFFIX = ".docstore.npz"
+BLOCK_SIZE = 1 << 16
+CACHE_SIZE = 100000
+BLOCK_CACHE_SIZE = 64
+
+
+def _iter_records(f, fmt, delimiter):
+    """
+    :param f: binary file object
+    :return: a iterator yielding (docid, start, record), with start the position of the record in the stream
+    """
+    offset = 0
+    if fmt == "tsv":
+        delimiter = delimiter.encode("utf-8")
+        for chunk in parsing.iter_chunks(f):
+            pos = 0
+            for line in chunk.split(b"\n"):
+                if line.strip():
+                    yield line.strip().split(delimiter)[0].decode("utf-8"), offset + pos, line
+                pos += len(line) + 1
+            offset += len(chunk)
+        return
+
+    buf = b""
+    while True:
+        chunk = f.read(parsing.CHUNK_SIZE)
+        if not chunk:
+            break
+
+        buf += chunk
+        pos = 0
+        while True:
+            start = buf.find(b"<DOC>", pos)
+            if start == -1:
+                pos = max(pos, len(buf) - len(b"<DOC>"))
+                break
+            end = buf.find(b"</DOC>", start)
+            if end == -1:
+                pos = start
+                break
+            end += len(b"</DOC>")
+            docnos = _find_fields(buf[start:end], b"DOCNO")
+            if not docnos:
+                raise ValueError(f"Found a document without <DOCNO>: {buf[start:start + 200]!r}")
+            yield docnos[0].strip().decode("utf-8", errors="replace"), offset + start, buf[start:end]
+            pos = end
+        buf = buf[pos:]
+        offset += pos
+
+
+def build_docstore(coll_fn, index_fn=None, fmt=None, delimiter="\t", block_size=BLOCK_SIZE):
+    """
+    Index the position of every document in the collection file and save the index.
+    A docid occurring several times points to its first record.
+
+    :param coll_fn: path to the trec or tsv collection file, can be compressed
+    :param index_fn: output path, default to `coll_fn + INDEX_SUFFIX`
+    :param fmt: str, "trec" or "tsv", guessed from the content by default
+    :param delimiter: str, the delimiter between id and content of tsv-format collections
+    :param block_size: int, approximate uncompressed size of the blocks a compressed collection is
+        recompressed into, smaller blocks decompress faster but compress worse
+    :return: str, the index path
+    """
+    from .collection import guess_format
+
+    fmt = fmt or guess_format(coll_fn)
+    if fmt not in ("trec", "tsv"):
+        raise ValueError(f"Unexpected collection format {fmt}, expected 'trec' or 'tsv'")
+    index_fn = index_fn or coll_fn + INDEX_SUFFIX
+    compressed = fileio.detect_compression(coll_fn) is not None
+    blocks_fn = os.path.splitext(index_fn)[0] + ".blocks"
+
+    docids, offsets, lengths, blocks, block_offsets = [], [], [], [], [0]
+    with fileio.open_input(coll_fn) as f:
+        if not compressed:
+            for docid, start, record in _iter_records(f, fmt, delimiter):
+                docids.append(docid)
+                offsets.append(start)
+                lengths.append(len(record))
+        else:
+            with open(blocks_fn + ".tmp", "wb") as outp:
+                block = []
+                block_len = 0
+
+                def flush():
+                    outp.write(zlib.compress(b"".join(block), 6))
+                    block_offsets.append(outp.tell())
+                    block.clear()
+
+                for docid, _, record in _iter_records(f, fmt, delimiter):
+                    docids.append(docid)
+                    offsets.append(block_len)
+                    lengths.append(len(record))
+                    blocks.append(len(block_offsets) - 1)
+                    block.append(record)
+                    block_len += len(record)
+                    if block_len >= block_size:
+                        flush()
+                        block_len = 0
+                if block:
+                    flush()
+            os.replace(blocks_fn + ".tmp", blocks_fn)
+
+    docids = np.array(docids, dtype=str)
+    order = np.argsort(docids, kind="stable")
+    sorted_docids = docids[order]
+    first = np.concatenate([[True], sorted_docids[1:] != sorted_docids[:-1]])[: len(order)]
+    order = order[first]
+
+    meta = {
+        "fmt": fmt,
+        "delimiter": delimiter,
+        "source": os.path.abspath(coll_fn),
+        "stamp": source_stamp(coll_fn),
+        "blocks": os.path.abspath(blocks_fn) if compressed else None,
+    }
+    arrays = dict(
+        docids=docids[order],
+        offsets=np.array(offsets, dtype=np.int64)[order],
+        lengths=np.array(lengths, dtype=np.int64)[order],
+        meta=np.array(json.dumps(meta)),
+    )
+    if compressed:
+        arrays["blocks"] = np.array(blocks, dtype=np.int64)[order]
+        arrays["block_offsets"] = np.array(block_offsets, dtype=np.int64)
+
+    tmp_fn = f"{index_fn}.tmp{os.getpid()}.npz"
+    np.savez(tmp_fn, **arrays)
+    os.replace(tmp_fn, index_fn)
+    return index_fn
+
+
+def _pread(f, offset, length):
+    """
+    Read length bytes at offset without moving the file position, so processes forked with the file
+    open, which share its position, do not race on it
+    """
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), length, offset)
+    f.seek(offset)
+    return f.read(length)
+
+
+class DocStore(Mapping):
+    """
+    Read-only mapping from docid to document content backed by the collection file and its index, with
+    an LRU cache of the recently fetched documents. Trec documents without any of the fields map to None.
+
+    >>> store = DocStore("collection.trec.gz")
+    >>> store.get("DOC-1")
+    >>> store.get_many(candidate_docids)
+    """
+
+    def __init__(self, coll_fn, index_fn=None, fields=("TEXT",), cache_size=CACHE_SIZE, build=True, **kwargs):
+        """
+        :param coll_fn: path to the collection file
+        :param index_fn: path to the index, default to `coll_fn + INDEX_SUFFIX`
+        :param fields: list of str, the tags returned from trec-format documents, see `parse_trec_doc`
+        :param cache_size: int, number of documents kept in the LRU cache, 0 disables the cache
+        :param build: bool, (re)build the index if it is missing or older than the collection file,
+            otherwise raise a ValueError
+        :param kwargs: passed to `build_docstore`
+        """
+        self.coll_fn = coll_fn
+        self.index_fn = index_fn or coll_fn + INDEX_SUFFIX
+        self.fields = tuple(fields)
+        self.cache_size = cache_size
+
+        if not self._is_fresh():
+            if not build:
+                raise ValueError(f"{self.index_fn} is missing or outdated, build it with build_docstore")
+            build_docstore(coll_fn, self.index_fn, **kwargs)
+
+        with np.load(self.index_fn) as index:
+            self.docids, self.offsets, self.lengths = index["docids"], index["offsets"], index["lengths"]
+            self.meta = json.loads(str(index["meta"]))
+            self.blocks = index["blocks"] if "blocks" in index else None
+            self.block_offsets = index["block_offsets"] if "block_offsets" in index else None
+
+        self._f = None
+        self._cache = OrderedDict()
+        self._block_cache = OrderedDict()
+
+    def _is_fresh(self):
+        try:
+            with np.load(self.index_fn) as index:
+                meta = json.loads(str(index["meta"]))
+        except (OSError, ValueError, KeyError):
+            return False
+        if meta["stamp"] != source_stamp(self.coll_fn):
+            return False
+        return meta["blocks"] is None or os.path.exists(meta["blocks"])
+
+    def _file(self):
+        if self._f is None:
+            self._f = open(self.meta["blocks"] or self.coll_fn, "rb")
+        return self._f
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):  # the file is reopened lazily, e.g. in a worker process
+        state = self.__dict__.copy()
+        state.update(_f=None, _cache=OrderedDict(), _block_cache=OrderedDict())
+        return state
+
+    def _read_block(self, block_id):
+        if block_id in self._block_cache:
+            self._block_cache.move_to_end(block_id)
+            return self._block_cache[block_id]
+
+        start, end = int(self.block_offsets[block_id]), int(self.block_offsets[block_id + 1])
+        block = zlib.decompress(_pread(self._file(), start, end - start))
+        self._block_cache[block_id] = block
+        if len(self._block_cache) > BLOCK_CACHE_SIZE:
+            self._block_cache.popitem(last=False)
+        return block
+
+    def _read_record(self, i):
+        offset, length = int(self.offsets[i]), int(self.lengths[i])
+        if self.blocks is not None:
+            return self._read_block(int(self.blocks[i]))[offset : offset + length]
+        return _pread(self._file(), offset, length)
+
+    def _parse(self, record):
+        if self.meta["fmt"] == "trec":
+            _, content = parse_trec_doc(record[len(b"<DOC>") : -len(b"</DOC>")], self.fields)
+            return content
+        _, content = record.decode("utf-8").strip().split(self.meta["delimiter"])
+        return content
+
+    def _lookup(self, docids):
+        """
+        :return: np.ndarray, the index position of each docid, -1 if it is not in the collection
+        """
+        docids = np.asarray(docids, dtype=str)
+        if not len(self.docids):
+            return np.full(len(docids), -1)
+        pos = np.minimum(np.searchsorted(self.docids, docids), len(self.docids) - 1)
+        return np.where(self.docids[pos] == docids, pos, -1)
+
+    def _cache_put(self, docid, content):
+        if self.cache_size > 0:
+            self._cache[docid] = content
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def __getitem__(self, docid):
+        if docid in self._cache:
+            self._cache.move_to_end(docid)
+            return self._cache[docid]
+
+        (i,) = self._lookup([docid])
+        if i == -1:
+            raise KeyError(docid)
+        content = self._parse(self._read_record(i))
+        self._cache_put(docid, content)
+        return content
+
+    def get_many(self, docids):
+        """
+        Fetch a batch of documents, reading the uncached ones in file order
+
+        :param docids: iterable of str
+        :return: dict in format {docid: content}, docids not in the collection are skipped
+        """
+        docids = list(docids)
+        found, missing = {}, []
+        for docid in docids:
+            if docid in self._cache:
+                self._cache.move_to_end(docid)
+                found[docid] = self._cache[docid]
+            else:
+                missing.append(docid)
+
+        if missing:
+            positions = self._lookup(missing)
+            positions = np.unique(positions[positions != -1])
+            blocks = self.blocks[positions] if self.blocks is not None else np.zeros(len(positions))
+            for i in positions[np.lexsort((self.offsets[positions], blocks))].tolist():
+                docid = str(self.docids[i])
+                found[docid] = self._parse(self._read_record(i))
+                self._cache_put(docid, found[docid])
+        return {docid: found[docid] for docid in docids if docid in found}
+
+    def __contains__(self, docid):
+        return docid in self._cache or self._lookup([docid])[0] != -1
+
+    def __iter__(self):
+        return iter(self.docids.tolist())
+
+    def __len__(self):
+        return len(self.docids)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.coll_fn!r}, {len(self)} documents)"
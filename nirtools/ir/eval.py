@@ -1,44 +1,254 @@
-from collections import OrderedDict
+import sys
+import traceback
+import multiprocessing
+from collections import OrderedDict, namedtuple
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
+import numpy as np
 import pytrec_eval
 from scipy import stats
-from . import load_qrels, load_runs
+from . import fileio, load_qrels, load_runs, as_dict, Run
+from . import metrics as native
+from .metric_cache import get_cache, content_hash
+
+
+def _evaluate(runs, qrels=None, evaluator=None, metric="map", cache=None, qrels_hash=None):
+    """
+    :param cache: None, True for the default `MetricCache`, or a `MetricCache`; requires the qrels
+    :param qrels_hash: str, the `content_hash` of the qrels, to hash dict qrels once for several runs
+    :return: dict in format {qid: {metric: value}}, same as `pytrec_eval.RelevanceEvaluator.evaluate`
+    """
+    if qrels is None and evaluator is None:
+        raise ValueError(f"Should give one of qrels or evaluator")
+
+    def evaluate():
+        native_metric = native.from_trec_eval_name(metric)
+        if qrels is not None and isinstance(runs, Run) and native_metric is not None:
+            # skip the conversion of array-backed runs into nested dicts; same as trec_eval, only the
+            # queries in both the run and the qrels are kept
+            qids, values = native.calc_per_query(runs, qrels, [native_metric])
+            return {
+                qid: {metric: value} for qid, value in zip(qids.tolist(), values[native_metric].tolist()) if qid in runs
+            }
+        return (evaluator or pytrec_eval.RelevanceEvaluator(as_dict(qrels), {metric})).evaluate(as_dict(runs))
+
+    cache = get_cache(cache)
+    if cache is None:
+        return evaluate()
+    if qrels is None:
+        raise ValueError(f"The metric cache needs the qrels to identify the evaluation")
+
+    def compute(_):
+        return {key: {qid: scores[metric] for qid, scores in evaluate().items()}}
+
+    key = f"pytrec_eval:{metric}"
+    qid2score = cache.get_or_compute(qrels, runs, [key], compute, qrels_hash=qrels_hash)[key]
+    return {qid: {metric: score} for qid, score in qid2score.items()}
 
 
 def query_wise_compare(
-    run1, run2, qrels, mark=False, output_fn="query_wise_compare.txt", metrics="map"
+    run1, run2, qrels, mark=False, output_fn="query_wise_compare.txt", metrics="map", cache=None
 ):
-    evaluator = pytrec_eval.RelevanceEvaluator(qrels, {metrics})
-    id2score_1 = evaluator.evaluate(run1)
-    id2score_2 = evaluator.evaluate(run2)
+    comparison = query_wise_scores({"run1": run1, "run2": run2}, qrels, metrics=[metrics], cache=cache)
+    lines = []
+    for qid, (s1, s2) in zip(comparison.qids.tolist(), comparison.scores[:, :, 0].tolist()):
+        line = f"{qid}\t{'--' if np.isnan(s1) else s1}\t{'--' if np.isnan(s2) else s2}"
+        if mark and not (np.isnan(s1) or np.isnan(s2)):
+            line += "\t<" if s1 <= s2 else "\t>"
+        lines.append(line + "\n")
 
     with open(output_fn, "w") as f:
-        for qid in set(id2score_1) | set(id2score_2):
-            s1 = id2score_1.get(qid, {metrics: "--"})[metrics]
-            s2 = id2score_2.get(qid, {metrics: "--"})[metrics]
-            if not mark or s1 == "--" or s2 == "--":
-                line = f"{qid}\t{s1}\t{s2}"
-            else:
-                line = line + "\t<" if s1 <= s2 else "\t>"
-            f.write(line + "\n")
+        f.write("".join(lines))
 
 
 def query_wise_compare_runfiles(
     runfile1, runfile2, qrelfile, output_fn="query_wise_compare.txt", metrics="map"
 ):
-    run1, run2 = load_runs(runfile1), load_runs(runfile2)
-    qrels = load_qrels(qrelfile)
-    query_wise_compare(run1, run2, qrels, output_fn, metrics)
+    run1, run2 = load_runs(runfile1, as_array=True), load_runs(runfile2, as_array=True)
+    qrels = load_qrels(qrelfile, as_array=True)
+    query_wise_compare(run1, run2, qrels, output_fn=output_fn, metrics=metrics)
 
 
-def _calc_scores(runs, qrels=None, evaluator=None, metric="map", return_qid=False):
-    if qrels is None and evaluator is None:
-        raise ValueError(f"Should give one of qrels or evaluator")
+def _evaluate_metrics(runs, qrels, metrics, evaluator=None):
+    """
+    Evaluate all the metrics in one pass over the run
+
+    :param evaluator: `pytrec_eval.RelevanceEvaluator` built for all the metrics, used when some metric
+        has no native implementation
+    :return: dict in format {metric: {qid: value}}, only the queries in both the run and the qrels
+    """
+    native_metrics = [native.from_trec_eval_name(metric) for metric in metrics]
+    if isinstance(runs, Run) and all(native_metrics):
+        qids, values = native.calc_per_query(runs, qrels, native_metrics)
+        kept = np.isin(qids, runs.qids)  # same as trec_eval, skip the queries missing in the run
+        qids = qids[kept].tolist()
+        return {metric: dict(zip(qids, values[name][kept].tolist())) for metric, name in zip(metrics, native_metrics)}
+
+    evaluator = evaluator or pytrec_eval.RelevanceEvaluator(as_dict(qrels), set(metrics))
+    qid2scores = evaluator.evaluate(as_dict(runs))
+    return {metric: {qid: scores[metric] for qid, scores in qid2scores.items()} for metric in metrics}
+
+
+QueryWiseScores = namedtuple("QueryWiseScores", ["qids", "runs", "metrics", "scores"])
+WinTieLoss = namedtuple("WinTieLoss", ["wins", "ties", "losses"])
+
+
+def query_wise_scores(runs, qrels, metrics=("map",), workers=None, cache=None):
+    """
+    Evaluate every run once on all the metrics and gather the per-query values into one matrix
+
+    :param runs: dict in format {name: run}, or list of runs named by their path or position, where each
+        run is a runfile path, `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param qrels: qrels path, `Qrels` or dict in format {qid: {docid: label, ...}, ...}
+    :param metrics: list of str, pytrec_eval measure names
+    :param workers: int, evaluate the runfile paths in this many processes, see `evaluate_many`
+    :param cache: None, True for the default `MetricCache`, or a `MetricCache`; only for in-memory runs
+    :return: `QueryWiseScores(qids, runs, metrics, scores)`, where qids is the sorted np.ndarray of the
+        queries evaluated in any run, and scores the np.ndarray of shape (n_qids, n_runs, n_metrics),
+        NaN where a run misses the query
+    """
+    runs = dict(runs) if isinstance(runs, dict) else {
+        run if isinstance(run, str) else str(i): run for i, run in enumerate(runs)
+    }
+    metrics = list(metrics)
+    qrels = load_qrels(qrels, as_array=True) if isinstance(qrels, str) else qrels
+
+    results = {}
+    runfiles = {run: name for name, run in runs.items() if isinstance(run, str)}
+    if runfiles:
+        for result in evaluate_many(list(runfiles), qrels, metrics, workers=workers, per_query=True):
+            if result.error is not None:
+                raise RuntimeError(f"Failed to evaluate {result.runfile}:\n{result.error}")
+            results[runfiles[result.runfile]] = result.per_query
+
+    evaluator = None
+    cache = get_cache(cache)
+    qrels_hash = None if cache is None else content_hash(qrels)  # once for all the runs
+    for name, run in runs.items():
+        if name in results:
+            continue
+        native_run = isinstance(run, Run) and all(native.from_trec_eval_name(metric) for metric in metrics)
+        if evaluator is None and not native_run:
+            evaluator = pytrec_eval.RelevanceEvaluator(as_dict(qrels), set(metrics))
+
+        def compute(keys):
+            todo = [key.split(":", 1)[1] for key in keys]
+            return {f"pytrec_eval:{metric}": qid2score for metric, qid2score in
+                    _evaluate_metrics(run, qrels, todo, None if native_run else evaluator).items()}
+
+        keys = [f"pytrec_eval:{metric}" for metric in metrics]
+        if cache is None:
+            computed = compute(keys)
+        else:
+            computed = cache.get_or_compute(qrels, run, keys, compute, qrels_hash=qrels_hash)
+        results[name] = {metric: computed[key] for metric, key in zip(metrics, keys)}
+
+    names = list(runs)
+    qids = np.unique(np.array(
+        [qid for name in names for qid2score in results[name].values() for qid in qid2score], dtype=str
+    ))
+    scores = np.full((len(qids), len(names), len(metrics)), np.nan)
+    for i, name in enumerate(names):
+        for j, metric in enumerate(metrics):
+            qid2score = results[name][metric]
+            if qid2score:
+                scores[np.searchsorted(qids, list(qid2score)), i, j] = list(qid2score.values())
+    return QueryWiseScores(qids, names, metrics, scores)
+
+
+def _baseline_index(comparison, baseline):
+    return comparison.runs.index(baseline) if isinstance(baseline, str) else baseline
+
+
+def win_tie_loss(comparison, baseline=0, tol=0.0):
+    """
+    Count the queries where each run beats, ties or loses to the baseline, over the queries evaluated
+    in both
+
+    :param comparison: `QueryWiseScores`
+    :param baseline: str or int, name or position of the baseline run
+    :param tol: float, differences up to tol count as ties
+    :return: `WinTieLoss(wins, ties, losses)`, each an np.ndarray of shape (n_runs, n_metrics)
+    """
+    scores = comparison.scores
+    diff = scores - scores[:, [_baseline_index(comparison, baseline)], :]
+    both = ~np.isnan(diff)
+    return WinTieLoss(
+        wins=(both & (diff > tol)).sum(axis=0),
+        ties=(both & (np.abs(diff) <= tol)).sum(axis=0),
+        losses=(both & (diff < -tol)).sum(axis=0),
+    )
 
-    if not evaluator:
-        evaluator = pytrec_eval.RelevanceEvaluator(qrels, {metric})
-    scores = evaluator.evaluate(runs)
+
+def top_changes(comparison, baseline=0, n=10):
+    """
+    Find the queries with the largest gains and losses of each run against the baseline
+
+    :param comparison: `QueryWiseScores`
+    :param baseline: str or int, name or position of the baseline run
+    :param n: int, number of queries per direction
+    :return: dict in format {(run, metric): (gains, losses)}, where gains and losses are lists of
+        (qid, difference), from the largest change on, skipping zero changes
+    """
+    scores = comparison.scores
+    diff = scores - scores[:, [_baseline_index(comparison, baseline)], :]
+    diff = np.where(np.isnan(diff), 0.0, diff)
+    order = np.argsort(diff, axis=0, kind="stable")  # losses first, gains last
+    qids = comparison.qids.tolist()
+
+    changes = {}
+    for i, name in enumerate(comparison.runs):
+        for j, metric in enumerate(comparison.metrics):
+            column, ranked = diff[:, i, j], order[:, i, j]
+            gains = [(qids[q], float(column[q])) for q in ranked[::-1][:n].tolist() if column[q] > 0]
+            losses = [(qids[q], float(column[q])) for q in ranked[:n].tolist() if column[q] < 0]
+            changes[(name, metric)] = (gains, losses)
+    return changes
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Writing .parquet files requires the pyarrow package: pip install pyarrow")
+    return pyarrow
+
+
+def write_query_wise_scores(comparison, outp_fn, fmt=None):
+    """
+    Write the per-query matrix in one go, with a qid column and one "run:metric" column per run and
+    metric. Missing values are written as nan (null in parquet).
+
+    :param comparison: `QueryWiseScores`
+    :param outp_fn: output path; tsv and csv are compressed according to the extension
+    :param fmt: str, "tsv", "csv" or "parquet", guessed from the extension by default
+    """
+    columns = [f"{name}:{metric}" for name in comparison.runs for metric in comparison.metrics]
+    values = comparison.scores.reshape(len(comparison.qids), -1)
+    if fmt is None:
+        ext = outp_fn.split(".")
+        fmt = ext[-2] if ext[-1] in ("gz", "bz2", "xz", "zst") and len(ext) > 2 else ext[-1]
+    if fmt == "parquet":
+        pa = _import_pyarrow()
+        table = pa.table({"qid": comparison.qids, **{column: values[:, i] for i, column in enumerate(columns)}})
+        pa.parquet.write_table(table, outp_fn)
+        return
+    if fmt not in ("tsv", "csv"):
+        raise ValueError(f"Unexpected output format {fmt}, expected 'tsv', 'csv' or 'parquet'")
+
+    sep = "\t" if fmt == "tsv" else ","
+    cells = np.char.mod("%.4f", values)
+    rows = [sep.join(["qid", *columns])]
+    rows.extend(sep.join([qid, *row]) for qid, row in zip(comparison.qids.tolist(), cells.tolist()))
+    with fileio.open_output(outp_fn, "wt") as f:
+        f.write("\n".join(rows) + "\n")
+
+
+def _calc_scores(runs, qrels=None, evaluator=None, metric="map", return_qid=False, cache=None, qrels_hash=None):
+    scores = _evaluate(runs, qrels, evaluator, metric=metric, cache=cache, qrels_hash=qrels_hash)
     scores = sorted(scores.items(), key=lambda kv: kv[0])
 
     score_values = [v[metric] for k, v in scores]
@@ -49,30 +259,152 @@ def _calc_scores(runs, qrels=None, evaluator=None, metric="map", return_qid=Fals
     return qids, score_values
 
 
-def sig_test_from_runs(qrels, runs1, runs2, metric="map"):
+def sig_test_from_runs(qrels, runs1, runs2, metric="map", cache=None):
     if set(runs1) != set(runs2):
         raise ValueError(f"Expect same keys from two run objects.")
 
-    evaluator = pytrec_eval.RelevanceEvaluator(qrels, {metric})
-    scores1 = _calc_scores(runs1, metric=metric, evaluator=evaluator)
-    scores2 = _calc_scores(runs2, metric=metric, evaluator=evaluator)
+    evaluator = pytrec_eval.RelevanceEvaluator(as_dict(qrels), {metric})
+    cache = get_cache(cache)
+    qrels_hash = None if cache is None else content_hash(qrels)  # once for both runs
+    scores1 = _calc_scores(runs1, qrels=qrels, metric=metric, evaluator=evaluator, cache=cache, qrels_hash=qrels_hash)
+    scores2 = _calc_scores(runs2, qrels=qrels, metric=metric, evaluator=evaluator, cache=cache, qrels_hash=qrels_hash)
     t, p = stats.ttest_rel(scores1, scores2)
     return t, p
 
 
-def sig_test_from_files(qrelfile, runfile1, runfile2, metric="map"):
+def sig_test_from_files(qrelfile, runfile1, runfile2, metric="map", cache=None):
     qrels = load_qrels(qrelfile)
     runs1, runs2 = load_runs(runfile1), load_runs(runfile2)
-    return sig_test_from_runs(qrels, runs1, runs2, metric=metric)
+    return sig_test_from_runs(qrels, runs1, runs2, metric=metric, cache=cache)
+
+
+EvalResult = namedtuple("EvalResult", ["runfile", "scores", "per_query", "error"])
+
+# qrels and evaluator of the current worker process, set once by `_init_worker`
+_worker_state = {}
+
+
+def _init_worker(qrels, metrics):
+    _worker_state.update(qrels=qrels, metrics=metrics, evaluator=None)
+
+
+def _evaluate_runfile(runfile, per_query=False):
+    """
+    Evaluate one runfile against the qrels of the worker, reporting any failure in the result
+    """
+    qrels, metrics = _worker_state["qrels"], _worker_state["metrics"]
+    try:
+        runs = load_runs(runfile, as_array=True)
+        if _worker_state["evaluator"] is None and not all(native.from_trec_eval_name(metric) for metric in metrics):
+            _worker_state["evaluator"] = pytrec_eval.RelevanceEvaluator(as_dict(qrels), set(metrics))
+        results = _evaluate_metrics(runs, qrels, metrics, _worker_state["evaluator"])
+    except Exception:
+        return EvalResult(runfile, None, None, traceback.format_exc())
+
+    scores = {
+        metric: float(np.mean(list(qid2score.values()))) if qid2score else 0.0 for metric, qid2score in results.items()
+    }
+    return EvalResult(runfile, scores, results if per_query else None, None)
+
+
+def _mp_context():
+    # forked workers share the loaded qrels copy-on-write instead of unpickling a copy each
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def evaluate_many(runfiles, qrels, metrics=("map",), workers=None, per_query=False):
+    """
+    Evaluate many runfiles against the same qrels in worker processes. The qrels are loaded once and
+    each worker builds its evaluator once; the results are yielded as soon as each runfile is done.
+    A failing runfile is reported in its `EvalResult.error` without stopping the others, and the files
+    in flight when a worker process dies are retried in a fresh pool.
+
+    :param runfiles: list of runfile paths
+    :param qrels: qrels path, `Qrels` or dict in format {qid: {docid: label, ...}, ...}
+    :param metrics: list of str, pytrec_eval measure names, e.g. ["map", "ndcg_cut_10", "P_5"]
+    :param workers: int, number of processes, default to the number of cpus
+    :param per_query: bool, also return the per-query values
+    :return: a iterator yielding `EvalResult(runfile, scores, per_query, error)` in completion order,
+        where scores is in format {metric: mean value} and per_query in format {metric: {qid: value}}
+    """
+    qrels = load_qrels(qrels, as_array=True) if isinstance(qrels, str) else qrels
+    metrics = list(metrics)
+    runfiles = list(runfiles)
+    workers = min(workers or multiprocessing.cpu_count(), max(len(runfiles), 1))
+    if workers == 1:
+        _init_worker(qrels, metrics)
+        for runfile in runfiles:
+            yield _evaluate_runfile(runfile, per_query)
+        return
+
+    pending, isolate = runfiles, False
+    while pending:
+        # after a round without progress, each remaining file gets a pool of its own to find the culprits
+        batches = [[runfile] for runfile in pending] if isolate else [pending]
+        failed = []
+        for batch in batches:
+            executor = ProcessPoolExecutor(
+                max_workers=min(workers, len(batch)), mp_context=_mp_context(), initializer=_init_worker,
+                initargs=(qrels, metrics),
+            )
+            futures = {}
+            try:
+                futures = {executor.submit(_evaluate_runfile, runfile, per_query): runfile for runfile in batch}
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        failed.append(futures[future])
+                        continue
+                    yield result
+            finally:
+                for future in futures:  # shutdown(cancel_futures=True) needs python 3.9
+                    future.cancel()
+                executor.shutdown(wait=True)
+
+        if isolate:
+            for runfile in failed:
+                yield EvalResult(runfile, None, None, "The worker process evaluating this runfile died")
+            break
+        isolate = len(failed) == len(pending)
+        pending = failed
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--qrels", "-q", required=True, type=str)
-    parser.add_argument("--runfile1", "-r1", required=True, type=str)
-    parser.add_argument("--runfile2", "-r2", required=True, type=str)
-    parser.add_argument("--metric", "-m", required=True, type=str)
+    parser.add_argument("--runfile1", "-r1", type=str)
+    parser.add_argument("--runfile2", "-r2", type=str)
+    parser.add_argument("--metric", "-m", type=str)
+    parser.add_argument("--runfiles", nargs="+", type=str, help="evaluate all these runfiles instead of a sig test")
+    parser.add_argument("--metrics", nargs="+", default=["map"], type=str)
+    parser.add_argument("--workers", "-w", type=int)
+    parser.add_argument("--compare_output", type=str, help="write the query-wise scores of --runfiles there instead")
     args = parser.parse_args()
 
+    if args.runfiles and args.compare_output:
+        comparison = query_wise_scores(args.runfiles, args.qrels, metrics=args.metrics, workers=args.workers)
+        write_query_wise_scores(comparison, args.compare_output)
+        wtl = win_tie_loss(comparison)
+        for i, runfile in enumerate(args.runfiles[1:], 1):
+            for j, metric in enumerate(args.metrics):
+                print(f"{runfile}\t{metric}\t{wtl.wins[i, j]}/{wtl.ties[i, j]}/{wtl.losses[i, j]} (win/tie/loss)")
+        sys.exit(0)
+
+    if args.runfiles:
+        n_failed = 0
+        for result in evaluate_many(args.runfiles, args.qrels, metrics=args.metrics, workers=args.workers):
+            if result.error is not None:
+                n_failed += 1
+                print(f"Failed to evaluate {result.runfile}:\n{result.error}", file=sys.stderr)
+                continue
+            for metric, score in result.scores.items():
+                print(f"{result.runfile}\t{metric}\t{score:.4f}", flush=True)
+        sys.exit(1 if n_failed else 0)
+
+    if not (args.runfile1 and args.runfile2 and args.metric):
+        parser.error("Either --runfiles, or all of --runfile1, --runfile2 and --metric are required")
     t, p = sig_test_from_files(qrelfile=args.qrels, runfile1=args.runfile1, runfile2=args.runfile2, metric=args.metric)
     print("t value:", t, "p value: ", p)
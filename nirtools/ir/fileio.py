@@ -0,0 +1,140 @@
+"""
+Shared file layer of the nirtools.ir readers and writers: picks the (de)compressor from the file
+extension (or the magic bytes when reading) and wraps it with large buffers. Gzip input is read with
+python-isal when it is installed, which decompresses several times faster than the zlib-based gzip
+module, and .zst files require the zstandard package.
+"""
+import io
+import os
+import bz2
+import gzip
+import lzma
+
+BUFFER_SIZE = 1 << 20
+
+COMPRESSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz", ".zst": "zstd"}
+
+MAGIC_BYTES = {
+    "gzip": b"\x1f\x8b",
+    "bz2": b"BZh",
+    "xz": b"\xfd7zXZ\x00",
+    "zstd": b"\x28\xb5\x2f\xfd",
+}
+
+
+def get_compression(fn):
+    """
+    :return: str, one of "gzip", "bz2", "xz", "zstd", or None for an uncompressed file name
+    """
+    return COMPRESSIONS.get(os.path.splitext(fn)[1].lower())
+
+
+def detect_compression(fn):
+    """
+    :return: str, the compression of an existing file according to its extension, or else its magic bytes
+    """
+    compression = get_compression(fn)
+    if compression is not None:
+        return compression
+
+    with open(fn, "rb") as f:
+        head = f.read(8)
+    for compression, magic in MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading or writing .zst files requires the zstandard package: pip install zstandard")
+    return zstandard
+
+
+def _open_gzip_reader(fn, threads):
+    try:
+        from isal import igzip, igzip_threaded
+    except ImportError:
+        return gzip.open(fn, "rb")
+
+    if threads is not None and threads > 0:
+        return igzip_threaded.open(fn, "rb", threads=threads)
+    return igzip.open(fn, "rb")
+
+
+def open_input(fn, mode="rb", buffer_size=BUFFER_SIZE, threads=None):
+    """
+    Open a file for reading, decompressing gzip, bz2, xz or zstd input on the fly
+
+    :param fn: input path
+    :param mode: str, "rb" or "rt"
+    :param buffer_size: int, size of the read buffer
+    :param threads: int, number of background decompression threads for gzip input (python-isal only)
+    :return: file object, the text mode decodes utf-8
+    """
+    if mode not in ("rb", "rt"):
+        raise ValueError(f"Unexpected mode {mode}, expected 'rb' or 'rt'")
+
+    compression = detect_compression(fn)
+    if compression is None:
+        f = open(fn, "rb", buffering=buffer_size)
+    else:
+        if compression == "gzip":
+            raw = _open_gzip_reader(fn, threads)
+        elif compression == "bz2":
+            raw = bz2.open(fn, "rb")
+        elif compression == "xz":
+            raw = lzma.open(fn, "rb")
+        else:
+            dctx = _import_zstandard().ZstdDecompressor()
+            raw = dctx.stream_reader(open(fn, "rb"), read_across_frames=True, closefd=True)
+        f = io.BufferedReader(raw, buffer_size=buffer_size)
+
+    if mode == "rb":
+        return f
+    return io.TextIOWrapper(f, encoding="utf-8")
+
+
+def _open_zstd_writer(fn, level):
+    cctx = _import_zstandard().ZstdCompressor(level=3 if level is None else level, threads=-1)
+    return cctx.stream_writer(open(fn, "wb"), closefd=True)
+
+
+def open_output(fn, mode="wt", compresslevel=None, buffer_size=BUFFER_SIZE):
+    """
+    Open a file for writing, compressed according to its extension (.gz, .bz2, .xz, .zst)
+    and creating the parent directory if needed
+
+    :param fn: output path
+    :param mode: str, "wt" or "wb"
+    :param compresslevel: int, compression level, default to 6 for gzip and the library default otherwise
+    :param buffer_size: int, size of the write buffer
+    :return: file object
+    """
+    if mode not in ("wt", "wb"):
+        raise ValueError(f"Unexpected mode {mode}, expected 'wt' or 'wb'")
+
+    outp_dir = os.path.dirname(fn)
+    if outp_dir:
+        os.makedirs(outp_dir, exist_ok=True)
+
+    compression = get_compression(fn)
+    if compression is None:
+        f = open(fn, "wb", buffering=buffer_size)
+    else:
+        level = {} if compresslevel is None else {"compresslevel": compresslevel}
+        if compression == "gzip":
+            raw = gzip.open(fn, "wb", compresslevel=6 if compresslevel is None else compresslevel)
+        elif compression == "bz2":
+            raw = bz2.open(fn, "wb", **level)
+        elif compression == "xz":
+            raw = lzma.open(fn, "wb", preset=compresslevel)
+        else:
+            raw = _open_zstd_writer(fn, compresslevel)
+        f = io.BufferedWriter(raw, buffer_size=buffer_size)
+
+    if mode == "wb":
+        return f
+    return io.TextIOWrapper(f, encoding="utf-8", write_through=True)
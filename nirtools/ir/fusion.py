@@ -0,0 +1,265 @@
+"""
+Fusion of several runs into one: reciprocal rank fusion, CombSUM / CombMNZ and linear interpolation of
+min-max or z-score normalized scores.
+
+The runs are first aligned onto the union of their (qid, docid) pairs, giving one row of scores and
+ranks per run over the same entries, so each fusion method is a few vectorized operations over the
+rows. Every method is linear in the run weights given the aligned rows (see `fusion_matrix`), which
+lets `grid_search` try many weights with one matrix product each instead of fusing from scratch.
+"""
+import itertools
+from collections import namedtuple
+
+import numpy as np
+
+from . import load_runs, write_runs
+from .containers import Run, _code_dtype
+from .metrics import _ranked_within, _sort_within
+
+METHODS = ("rrf", "combsum", "combmnz", "interpolate")
+NORMS = ("minmax", "zscore", None)
+RRF_K = 60
+
+AlignedRuns = namedtuple("AlignedRuns", ["union", "scores", "ranks"])
+AlignedRuns.__doc__ = """
+:param union: `Run` holding the union of the (qid, docid) pairs, with zero scores
+:param scores: np.ndarray of shape (n_runs, n_entries), the scores of each run aligned with the union
+    entries, NaN where the run does not retrieve the document
+:param ranks: np.ndarray of shape (n_runs, n_entries), the 1-based rank of each document in each run,
+    inf where the run does not retrieve the document
+"""
+
+
+def _as_run(run, depth=None):
+    if isinstance(run, str):
+        return load_runs(run, topk=depth, as_array=True)
+    run = run if isinstance(run, Run) else Run.from_dict(run)
+    return run if depth is None else run.topk(depth)
+
+
+def _ranks(run):
+    """
+    :return: np.ndarray, the 1-based rank of every entry within its query, ties keep their storage order
+    """
+    qcodes = run.query_codes()
+    order = _sort_within(_ranked_within(qcodes), (np.arange(len(qcodes)), -run.values))
+    ranks = np.empty(len(order), dtype=np.float64)
+    ranks[order] = np.arange(len(order)) - run.offsets[qcodes] + 1
+    return ranks
+
+
+def _unique(arr):
+    # sort-based, np.unique hashes large integer arrays which is several times slower
+    arr = np.sort(arr)
+    return arr[np.concatenate([[True], arr[1:] != arr[:-1]])[: len(arr)]]
+
+
+def align_runs(runs, depth=None):
+    """
+    Align the runs onto the union of their (qid, docid) pairs. Runs given as paths are loaded one at a
+    time into the array-backed `Run`.
+
+    :param runs: iterable of runfile paths, `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param depth: int, only keep the top depth documents of each run
+    :return: `AlignedRuns`, where the union keeps the queries in order of first appearance and the
+        documents of each query sorted by docid
+    """
+    runs = [_as_run(run, depth) for run in runs]
+    if not runs:
+        raise ValueError(f"Expect at least one run to fuse.")
+
+    docids = _unique(np.concatenate([run.docids for run in runs]))
+    qid2code = {}
+    for run in runs:
+        for qid in run.qids.tolist():
+            qid2code.setdefault(qid, len(qid2code))
+
+    n_docs = max(len(docids), 1)
+    keys = []
+    for run in runs:
+        query_map = np.array([qid2code[qid] for qid in run.qids.tolist()], dtype=np.int64)
+        doc_map = np.searchsorted(docids, run.docids)
+        keys.append(query_map[run.query_codes()] * n_docs + doc_map[run.doc_codes])
+    union_keys = _unique(np.concatenate(keys))
+
+    scores = np.full((len(runs), len(union_keys)), np.nan)
+    ranks = np.full((len(runs), len(union_keys)), np.inf)
+    for i, (run, run_keys) in enumerate(zip(runs, keys)):
+        positions = np.searchsorted(union_keys, run_keys)
+        scores[i, positions] = run.values
+        ranks[i, positions] = _ranks(run)
+
+    counts = np.bincount(union_keys // n_docs, minlength=len(qid2code))
+    union = Run(
+        qids=np.array(list(qid2code), dtype=str),
+        docids=docids,
+        offsets=np.concatenate([[0], np.cumsum(counts)]),
+        doc_codes=(union_keys % n_docs).astype(_code_dtype(len(docids))),
+        values=np.zeros(len(union_keys)),
+    )
+    return AlignedRuns(union, scores, ranks)
+
+
+def _per_query(ufunc, arr, union):
+    """
+    :return: np.ndarray shaped as arr, the reduction of each query broadcast back to its entries
+    """
+    return ufunc.reduceat(arr, union.offsets[:-1], axis=1)[:, union.query_codes()]
+
+
+def normalize_scores(aligned, norm="minmax"):
+    """
+    Normalize the scores of each run per query. Min-max maps a query whose documents all share a
+    score to 1, z-score maps it to 0.
+
+    :param aligned: `AlignedRuns`
+    :param norm: str, "minmax" or "zscore", or None to keep the raw scores
+    :return: np.ndarray shaped as `aligned.scores`, NaN where the run does not retrieve the document
+    """
+    if norm not in NORMS:
+        raise ValueError(f"Unexpected normalization {norm}, expected one of {NORMS}")
+    scores, union = aligned.scores, aligned.union
+    if norm is None or scores.size == 0:
+        return scores.copy()
+
+    missing = np.isnan(scores)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if norm == "minmax":
+            low, high = _per_query(np.fmin, scores, union), _per_query(np.fmax, scores, union)
+            normalized = np.where(high > low, (scores - low) / (high - low), 1.0)
+        else:
+            count = _per_query(np.add, (~missing).astype(np.float64), union)
+            mean = _per_query(np.add, np.where(missing, 0, scores), union) / count
+            std = np.sqrt(_per_query(np.add, np.where(missing, 0, (scores - mean) ** 2), union) / count)
+            normalized = np.where(std > 0, (scores - mean) / std, 0.0)
+    normalized[missing] = np.nan
+    return normalized
+
+
+def fusion_matrix(aligned, method="rrf", norm="minmax", k=RRF_K):
+    """
+    The per-run contributions of the fusion, such that the fused scores with weights w are
+    `w @ matrix * multiplier`
+
+    - rrf: 1 / (k + rank), 0 for missing documents
+    - combsum: the normalized scores, 0 for missing documents
+    - combmnz: same as combsum, multiplied by the number of runs retrieving the document
+    - interpolate: the normalized scores, missing documents get the lowest score of the run for the query
+
+    :param aligned: `AlignedRuns`
+    :param method: str, one of `METHODS`
+    :param norm: str, see `normalize_scores`, ignored by rrf
+    :param k: int, the rank offset of rrf
+    :return: (matrix, multiplier), where matrix has the shape of `aligned.scores` and multiplier is an
+        np.ndarray over the union entries or None
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unexpected fusion method {method}, expected one of {METHODS}")
+    if method == "rrf":
+        return 1.0 / (k + aligned.ranks), None
+
+    normalized = normalize_scores(aligned, norm)
+    missing = np.isnan(normalized)
+    if method == "interpolate":
+        lowest = _per_query(np.fmin, normalized, aligned.union) if normalized.size else normalized
+        return np.where(missing, np.nan_to_num(lowest), normalized), None
+
+    multiplier = (~missing).sum(axis=0).astype(np.float64) if method == "combmnz" else None
+    return np.where(missing, 0.0, normalized), multiplier
+
+
+def _check_weights(weights, n_runs):
+    weights = np.ones(n_runs) if weights is None else np.asarray(weights, dtype=np.float64)
+    if weights.shape[-1] != n_runs:
+        raise ValueError(f"Expect {n_runs} weights, one per run, but got {weights.shape[-1]}")
+    return weights
+
+
+def _with_scores(union, scores):
+    return Run(union.qids, union.docids, union.offsets, union.doc_codes, scores)
+
+
+def fuse(runs, method="rrf", weights=None, norm="minmax", k=RRF_K, depth=None, topk=None):
+    """
+    Fuse the runs into one
+
+    >>> fused = fuse(["bm25.trec", "reranker1.trec", "reranker2.trec"], method="rrf")
+    >>> fused = fuse([bm25, reranker], method="interpolate", weights=[0.3, 0.7], norm="zscore")
+
+    :param runs: iterable of runfile paths, `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param method: str, one of `METHODS`, see `fusion_matrix`
+    :param weights: list of float, one per run, default to equal weights
+    :param norm: str, "minmax" or "zscore", or None to keep the raw scores; ignored by rrf
+    :param k: int, the rank offset of rrf
+    :param depth: int, only fuse the top depth documents of each run
+    :param topk: int, only keep the top k documents of the fused run
+    :return: `Run`
+    """
+    aligned = align_runs(runs, depth=depth)
+    weights = _check_weights(weights, len(aligned.scores))
+    matrix, multiplier = fusion_matrix(aligned, method=method, norm=norm, k=k)
+    scores = weights @ matrix
+    if multiplier is not None:
+        scores = scores * multiplier
+    fused = _with_scores(aligned.union, scores)
+    return fused if topk is None else fused.topk(topk)
+
+
+def fuse_runfiles(runfiles, outp_fn, label="fusion", **kwargs):
+    """
+    Fuse the runfiles and write the result in trec format
+
+    :param runfiles: list of runfile paths
+    :param outp_fn: output path, compressed according to its extension
+    :param label: str, the run tag in the last column
+    :param kwargs: passed to `fuse`
+    """
+    write_runs(fuse(runfiles, **kwargs), outp_fn, label=label)
+
+
+def weight_grid(n_runs, step=0.1):
+    """
+    :return: np.ndarray of shape (n_weights, n_runs), all the non-negative weights on the given step
+        summing to 1, e.g. [[0, 1], [0.1, 0.9], ..., [1, 0]] for two runs
+    """
+    n_steps = int(round(1 / step))
+    grid = [
+        combo + (n_steps - sum(combo),)
+        for combo in itertools.product(range(n_steps + 1), repeat=n_runs - 1)
+        if sum(combo) <= n_steps
+    ]
+    return np.array(grid, dtype=np.float64).reshape(-1, n_runs) / n_steps
+
+
+def grid_search(runs, qrels, metric="AP", method="interpolate", weights=None, step=0.1, norm="minmax", k=RRF_K,
+                depth=None):
+    """
+    Find the fusion weights maximizing the metric. The runs are aligned and normalized once, so each
+    weight combination only costs a matrix product and an evaluation.
+
+    :param runs: iterable of runfile paths, `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param qrels: `Qrels` or dict in format {qid: {docid: label, ...}, ...}
+    :param metric: str, see `metrics.parse_metric`
+    :param method, norm, k, depth: see `fuse`
+    :param weights: array of shape (n_weights, n_runs), the weights to try, default to `weight_grid`
+    :param step: float, the step of the default grid
+    :return: (best_weights, results), where results is a list of (weights, value) in grid order
+    """
+    from .containers import Qrels
+    from .metrics import calc_aggregate
+
+    aligned = align_runs(runs, depth=depth)
+    qrels = qrels if isinstance(qrels, Qrels) else Qrels.from_dict(qrels)
+    n_runs = len(aligned.scores)
+    weights = _check_weights(weight_grid(n_runs, step) if weights is None else weights, n_runs).reshape(-1, n_runs)
+    matrix, multiplier = fusion_matrix(aligned, method=method, norm=norm, k=k)
+
+    results = []
+    for w in weights:
+        scores = w @ matrix
+        if multiplier is not None:
+            scores = scores * multiplier
+        value = calc_aggregate(_with_scores(aligned.union, scores), qrels, [metric])[str(metric)]
+        results.append((w.tolist(), value))
+    best_weights, _ = max(results, key=lambda result: result[1])
+    return best_weights, results
@@ -0,0 +1,209 @@
+"""
+On-disk cache of per-query metric values, keyed by the content hash of the qrels and the run plus the
+metric name, so repeated evaluations of the same runs (e.g. in another script or a notebook re-run)
+skip the evaluation, and adding a metric only computes the new one.
+
+Each (qrels, run, metric) entry is a small json file written to a temporary name and moved in place,
+so several processes can share the cache directory: readers never see partial files and concurrent
+writers of the same entry write the same content. Reading an entry refreshes its mtime, and the oldest
+entries are deleted once the directory grows beyond the size limit. The size is counted up by each
+writer from one initial scan, so the directory is only walked again when the limit is passed; the
+writes of other processes are only seen then, which makes the limit approximate.
+"""
+import os
+import json
+import weakref
+import hashlib
+
+import numpy as np
+
+from .containers import Run, Qrels
+
+CACHE_ENV = "NIRTOOLS_CACHE"
+MAX_SIZE = 1 << 30
+EVICT_RATIO = 0.9
+
+_file_hashes = {}
+_default_caches = {}  # cache_dir -> the `MetricCache` shared by the callers passing cache=True
+_object_hashes = {}  # id(obj) -> (weak reference to obj, hash) of the `Run` and `Qrels` hashed so far
+
+
+def default_cache_dir():
+    """
+    :return: str, $NIRTOOLS_CACHE if set, otherwise ~/.cache/nirtools, with a metrics/ subdirectory
+    """
+    root = os.environ.get(CACHE_ENV) or os.path.join(os.path.expanduser("~"), ".cache", "nirtools")
+    return os.path.join(root, "metrics")
+
+
+def _file_hash(fn):
+    stat = os.stat(fn)
+    key = (os.path.abspath(fn), stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hashes:
+        h = hashlib.blake2b(digest_size=16)
+        with open(fn, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _file_hashes[key] = "file-" + h.hexdigest()
+    return _file_hashes[key]
+
+
+def content_hash(obj):
+    """
+    Fingerprint a run or qrels independent of the order of queries and documents
+
+    :param obj: dict in format {qid: {docid: value, ...}, ...}, `Run`, `Qrels`, or a file path, which is
+        hashed by its raw content (so a file and the dict loaded from it get different hashes). `Run` and
+        `Qrels`, which are not modified in place, are hashed once per object; dicts, which may be, every time,
+        so callers evaluating several runs against the same dict qrels hash them once and pass the hash
+        to `MetricCache.get_or_compute`
+    :return: str
+    """
+    if isinstance(obj, (str, os.PathLike)):
+        return _file_hash(obj)
+
+    if isinstance(obj, (Run, Qrels)):
+        ref, obj_hash = _object_hashes.get(id(obj), (None, None))
+        if ref is not None and ref() is obj:
+            return obj_hash
+        qids, docids, values = obj.to_records()
+    else:
+        qids = np.array([qid for qid, docs in obj.items() for _ in docs], dtype=str)
+        docids = np.array([docid for docs in obj.values() for docid in docs], dtype=str)
+        values = np.array([value for docs in obj.values() for value in docs.values()], dtype=np.float64)
+    order = np.lexsort((docids, qids))
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update("\0".join(qids[order].tolist()).encode("utf-8"))
+    h.update(b"\1")
+    h.update("\0".join(docids[order].tolist()).encode("utf-8"))
+    h.update(np.asarray(values, dtype=np.float64)[order].tobytes())
+    obj_hash = "obj-" + h.hexdigest()
+
+    if isinstance(obj, (Run, Qrels)):
+        key = id(obj)
+        _object_hashes[key] = (weakref.ref(obj, lambda _: _object_hashes.pop(key, None)), obj_hash)
+    return obj_hash
+
+
+class MetricCache:
+    """
+    Per-query metric values on disk, shared by processes and bounded in size
+
+    >>> cache = MetricCache()
+    >>> qid2score = cache.get_or_compute(qrels, run, ["map"], lambda metrics: evaluate(metrics))["map"]
+    """
+
+    def __init__(self, cache_dir=None, max_size=MAX_SIZE):
+        """
+        :param cache_dir: str, default to `default_cache_dir()`
+        :param max_size: int, the size in bytes above which the least recently used entries are deleted,
+            down to `EVICT_RATIO * max_size`
+        """
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_size = max_size
+        self._size = None  # the size of the directory, from one scan plus the entries written since
+
+    def _path(self, qrels_hash, run_hash, metric):
+        key = hashlib.blake2b(f"{qrels_hash}\0{run_hash}\0{metric}".encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, qrels_hash, run_hash, metric):
+        """
+        :return: dict in format {qid: value}, or None if the entry is not cached
+        """
+        path = self._path(qrels_hash, run_hash, metric)
+        try:
+            with open(path) as f:
+                qid2value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return qid2value
+
+    def put(self, qrels_hash, run_hash, metric, qid2value):
+        path = self._path(qrels_hash, run_hash, metric)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self._size is None:
+            self._size = self._scan()[1]
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({qid: float(value) for qid, value in qid2value.items()}, f)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self._size += size - replaced
+        if self._size > self.max_size:
+            self.evict()
+
+    def _scan(self):
+        """
+        :return: (entries, total), the list of (mtime, size, path) of the entries and their total size
+        """
+        entries, total = [], 0
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # deleted by another process
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+                total += stat.st_size
+        return entries, total
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits into `EVICT_RATIO * max_size`, which
+        leaves room for the next entries before the directory is walked again
+        """
+        entries, total = self._scan()
+        for _, size, path in sorted(entries):
+            if total <= self.max_size * EVICT_RATIO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+    def get_or_compute(self, qrels, run, metrics, compute_fn, qrels_hash=None, run_hash=None):
+        """
+        :param qrels, run: anything accepted by `content_hash`
+        :param metrics: list of str, the metric names, made unique per evaluator by the caller
+        :param compute_fn: callable taking the list of uncached metrics and returning
+            {metric: {qid: value}} for each of them
+        :param qrels_hash, run_hash: str, the `content_hash` of the qrels and the run if already known
+        :return: dict in format {metric: {qid: value}}
+        """
+        qrels_hash = qrels_hash or content_hash(qrels)
+        run_hash = run_hash or content_hash(run)
+        results = {metric: self.get(qrels_hash, run_hash, metric) for metric in metrics}
+        missing = [metric for metric, qid2value in results.items() if qid2value is None]
+        if missing:
+            computed = compute_fn(missing)
+            for metric in missing:
+                results[metric] = computed[metric]
+                self.put(qrels_hash, run_hash, metric, computed[metric])
+        return results
+
+
+def get_cache(cache):
+    """
+    :param cache: None or False for no cache, True for the default `MetricCache`, or a `MetricCache`
+    :return: MetricCache or None
+    """
+    if cache is None or cache is False:
+        return None
+    if cache is not True:
+        return cache
+    cache_dir = default_cache_dir()
+    if cache_dir not in _default_caches:
+        _default_caches[cache_dir] = MetricCache(cache_dir)
+    return _default_caches[cache_dir]
@@ -0,0 +1,322 @@
+"""
+Vectorized trec_eval metrics computed directly on the array-backed `Run` and `Qrels`.
+
+The run entries are joined with the qrels on (qid, docid) codes through sorted keys, ranked per query
+with one lexsort (score from large to small, ties broken by docid from large to small like trec_eval),
+and every metric is then a weighted bincount over the ranked entries. Same as ir_measures, every query
+of the qrels is evaluated (a query missing in the run scores 0) and queries only in the run are ignored.
+Documents with a label >= 1 are relevant, and the labels are the nDCG gains (negative labels count as 0).
+"""
+import re
+
+import numpy as np
+
+from . import fileio
+from .containers import Run, Qrels
+
+METRIC_PATTERN = re.compile(r"^(AP|nDCG|RR|P|R|Rprec)(?:@(\d+))?$")
+BATCH_ENTRIES = 1000000
+
+
+def parse_metric(metric):
+    """
+    :param metric: str, one of "AP", "nDCG", "RR", "Rprec", or "nDCG@k", "RR@k", "P@k", "R@k" (also
+        accepts the ir_measures objects of these metrics)
+    :return: (name, cutoff), cutoff is None if not given
+    """
+    match = METRIC_PATTERN.match(str(metric))
+    if match is None:
+        raise ValueError(f"Unsupported metric {metric}, expected one of AP, nDCG@k, RR@k, P@k, R@k, Rprec")
+    name, cutoff = match.group(1), match.group(2)
+    if name in ("P", "R") and cutoff is None:
+        raise ValueError(f"Metric {metric} requires a cutoff, e.g. {name}@10")
+    if name in ("AP", "Rprec") and cutoff is not None:
+        raise ValueError(f"Metric {name} does not support a cutoff")
+    return name, None if cutoff is None else int(cutoff)
+
+
+_TREC_EVAL_NAMES = {"map": "AP", "Rprec": "Rprec", "recip_rank": "RR", "ndcg": "nDCG"}
+_TREC_EVAL_CUTOFFS = {"ndcg_cut": "nDCG", "P": "P", "recall": "R"}
+
+
+def from_trec_eval_name(name):
+    """
+    :param name: str, a trec_eval (pytrec_eval) measure name, e.g. "map", "ndcg_cut_10", "P_5", "recall_100"
+    :return: str, the corresponding metric of `calc_per_query`, or None if it is not supported
+    """
+    if name in _TREC_EVAL_NAMES:
+        return _TREC_EVAL_NAMES[name]
+    prefix, _, cutoff = name.rpartition("_")
+    if prefix in _TREC_EVAL_CUTOFFS and cutoff.isdigit():
+        return f"{_TREC_EVAL_CUTOFFS[prefix]}@{cutoff}"
+    return None
+
+
+def is_supported(metric):
+    """
+    :return: bool, whether the metric can be computed by `calc_per_query`
+    """
+    try:
+        parse_metric(metric)
+    except ValueError:
+        return False
+    return True
+
+
+def _map_codes(vocab, values):
+    """
+    :return: np.ndarray, the position of each value in the sorted vocab, -1 if it is absent
+    """
+    if not len(vocab):
+        return np.full(len(values), -1)
+    pos = np.minimum(np.searchsorted(vocab, values), len(vocab) - 1)
+    return np.where(vocab[pos] == values, pos, -1)
+
+
+def _per_query_sum(query_index, weights, n_queries):
+    return np.bincount(query_index, weights=weights, minlength=n_queries)
+
+
+def _ranked_within(query_index):
+    """
+    :param query_index: np.ndarray of int, where the entries of each query are contiguous
+    :return: np.ndarray, the 1-based position of every entry inside its query
+    """
+    positions = np.arange(len(query_index))
+    is_start = np.concatenate([[True], query_index[1:] != query_index[:-1]])[: len(query_index)]
+    return positions - np.maximum.accumulate(np.where(is_start, positions, 0)) + 1
+
+
+def _sort_within(ranks, keys):
+    """
+    Sort the entries of each contiguous query by the keys (the last key is the primary one, same as
+    np.lexsort), keeping the queries in place
+
+    :param ranks: np.ndarray, the position of each entry inside its query, see `_ranked_within`
+    :return: np.ndarray, the sorting permutation
+    """
+    if not len(ranks):
+        return np.arange(0)
+    n_rows, width = int(np.sum(ranks == 1)), int(ranks.max())
+    if n_rows * width > 2 * len(ranks) + 1024:  # too uneven to pad into a matrix
+        return np.lexsort((*keys, np.cumsum(ranks == 1)))
+
+    # sorting the short rows of a padded matrix is much faster than one long lexsort
+    if n_rows * width == len(ranks):  # queries of equal length are already laid out as a matrix
+        entries = np.arange(len(ranks)).reshape(n_rows, width)
+        padded_keys = [key.reshape(n_rows, width) for key in keys]
+    else:
+        rows, cols = np.cumsum(ranks == 1) - 1, ranks - 1
+        entries = np.full((n_rows, width), -1)
+        entries[rows, cols] = np.arange(len(ranks))
+        padded_keys = []
+        for key in keys:
+            padded = np.full((n_rows, width), np.inf)
+            padded[rows, cols] = key
+            padded_keys.append(padded)
+
+    # the secondary keys only matter for the rows with ties in the primary key
+    order = np.argsort(padded_keys[-1], axis=1)
+    primary = np.take_along_axis(padded_keys[-1], order, axis=1)
+    lengths = np.bincount(np.cumsum(ranks == 1) - 1, minlength=n_rows)
+    tied = ((primary[:, 1:] == primary[:, :-1]) & (np.arange(1, width) < lengths[:, None])).any(axis=1)
+    if tied.any():
+        order[tied] = np.lexsort([key[tied] for key in padded_keys], axis=1)
+    order = np.take_along_axis(entries, order, axis=1).reshape(-1)
+    return order[order != -1]
+
+
+def calc_per_query(run, qrels, metrics=("AP",)):
+    """
+    Compute the per-query metric values
+
+    :param run: `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param qrels: `Qrels` or dict in format {qid: {docid: label, ...}, ...}
+    :param metrics: list of str, see `parse_metric`
+    :return: (qids, results), where qids is the sorted np.ndarray of evaluated queries and results a
+        dict in format {metric: np.ndarray of values aligned with qids}
+    """
+    parsed = {str(metric): parse_metric(metric) for metric in metrics}
+    run = run if isinstance(run, Run) else Run.from_dict(run)
+    qrels = qrels if isinstance(qrels, Qrels) else Qrels.from_dict(qrels)
+
+    qids = np.unique(qrels.qids)
+    n_queries = len(qids)
+
+    # qrels entries of the evaluated queries, with the judged docids mapped onto the run vocabulary
+    qrels_query = _map_codes(qids, qrels.qids)[qrels.query_codes()]
+    judged = qrels_query != -1
+    qrels_query, labels = qrels_query[judged], qrels.values[judged].astype(np.int64)
+    qrels_doc = _map_codes(run.docids, qrels.docids)[qrels.doc_codes[judged]]
+    num_rel = _per_query_sum(qrels_query, labels >= 1, n_queries)
+
+    # run entries of the evaluated queries, labelled through the sorted (query, doc) keys of the qrels
+    run_query = _map_codes(qids, run.qids)[run.query_codes()]
+    retrieved = run_query != -1
+    run_query, doc_codes = run_query[retrieved], run.doc_codes[retrieved].astype(np.int64)
+    scores = run.values[retrieved].astype(np.float64)
+
+    n_docs = max(len(run.docids), 1)
+    in_run = qrels_doc != -1
+    qrels_keys = qrels_query[in_run] * n_docs + qrels_doc[in_run]
+    key_order = np.argsort(qrels_keys)
+    qrels_keys, qrels_labels = qrels_keys[key_order], labels[in_run][key_order]
+    run_keys = run_query * n_docs + doc_codes
+    pos = np.minimum(np.searchsorted(qrels_keys, run_keys), max(len(qrels_keys) - 1, 0))
+    run_labels = np.zeros(len(run_keys), dtype=np.int64)
+    if len(qrels_keys):
+        matched = qrels_keys[pos] == run_keys
+        run_labels[matched] = qrels_labels[pos[matched]]
+
+    # the entries of each query stay contiguous in storage order, so the ranks are their positions after
+    # sorting inside each query
+    ranks = _ranked_within(run_query)
+
+    def rank(docid_order):
+        """
+        :param docid_order: 1 or -1, ties broken by docid from small to large or from large to small
+        :return: (query, label, is relevant, number of relevant up to the rank) of every ranked entry
+        """
+        # docid codes follow the sorted docids
+        order = _sort_within(ranks, (docid_order * doc_codes, -scores))
+        query, labels_ = run_query[order], run_labels[order]
+        rel = labels_ >= 1
+        cum_rel = np.cumsum(rel)
+        cum_rel = cum_rel - np.concatenate([[0], cum_rel])[np.arange(len(query)) - ranks + 1]
+        return query, labels_, rel, cum_rel
+
+    ranked_query, ranked_labels, rel, cum_rel = rank(-1)
+
+    def safe_divide(a, b):
+        return np.divide(a, b, out=np.zeros(n_queries), where=b > 0)
+
+    def num_rel_at(k):
+        return _per_query_sum(ranked_query, rel & (ranks <= k), n_queries)
+
+    ideal_order = np.lexsort((-labels, qrels_query))
+    ideal_gains = np.maximum(labels[ideal_order], 0)
+    ideal_ranks = _ranked_within(qrels_query[ideal_order])
+
+    results = {}
+    for metric, (name, cutoff) in parsed.items():
+        k = np.inf if cutoff is None else cutoff
+        if name == "AP":
+            values = safe_divide(_per_query_sum(ranked_query, rel * cum_rel / ranks, n_queries), num_rel)
+        elif name == "P":
+            values = num_rel_at(k) / k
+        elif name == "R":
+            values = safe_divide(num_rel_at(k), num_rel)
+        elif name == "Rprec":
+            in_rprec = rel & (ranks <= num_rel[ranked_query])
+            values = safe_divide(_per_query_sum(ranked_query, in_rprec, n_queries), num_rel)
+        elif name == "RR":
+            query, rr_rel, rr_cum_rel = ranked_query, rel, cum_rel
+            if cutoff is not None:  # ir_measures computes RR@k with the MS MARCO script, which sorts docids upwards
+                query, _, rr_rel, rr_cum_rel = rank(1)
+            first = rr_rel & (rr_cum_rel == 1) & (ranks <= k)
+            values = _per_query_sum(query[first], 1 / ranks[first], n_queries)
+        else:
+            gains = np.maximum(ranked_labels, 0) / np.log2(ranks + 1) * (ranks <= k)
+            dcg = _per_query_sum(ranked_query, gains, n_queries)
+            ideal_weights = ideal_gains / np.log2(ideal_ranks + 1) * (ideal_ranks <= k)
+            values = safe_divide(dcg, _per_query_sum(qrels_query[ideal_order], ideal_weights, n_queries))
+        results[metric] = values
+    return qids, results
+
+
+def calc_aggregate(run, qrels, metrics=("AP",)):
+    """
+    :return: dict in format {metric: mean value over the evaluated queries}
+    """
+    qids, results = calc_per_query(run, qrels, metrics)
+    return {metric: float(values.mean()) if len(qids) else 0.0 for metric, values in results.items()}
+
+
+def _iter_batches(groups, batch_entries):
+    batch, size = [], 0
+    for group in groups:
+        batch.append(group)
+        size += len(group[1])
+        if size >= batch_entries:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def iter_calc_runfile(runfile, qrels, metrics=("AP",), fmt="trec", batch_entries=BATCH_ENTRIES):
+    """
+    Evaluate a runfile grouped by query without loading it: consecutive queries are evaluated together
+    in batches of about batch_entries lines, so the memory is bounded by the batch or the largest query.
+    Same as `calc_per_query`, queries of the qrels missing in the run score 0 and are yielded at the end.
+
+    :param runfile: runfile path, can be compressed, see `runops.iter_query_groups`
+    :param qrels: `Qrels` or dict in format {qid: {docid: label, ...}, ...}
+    :param metrics: list of str, see `parse_metric`
+    :param fmt: str, "trec" or "tsv"
+    :return: a iterator yielding (qid, {metric: value}) in file order
+    :raise ValueError: if the runfile is not grouped by query, see `runops.sort_runfile`
+    """
+    from .runops import iter_query_groups
+
+    metrics = [str(metric) for metric in metrics]
+    qrels = qrels if isinstance(qrels, Qrels) else Qrels.from_dict(qrels)
+    seen = set()
+    for batch in _iter_batches(iter_query_groups(runfile, fmt=fmt), batch_entries):
+        batch_qids = [qid for qid, _, _ in batch]
+        seen.update(batch_qids)
+        run = Run.from_records(
+            np.repeat(batch_qids, [len(docids) for _, docids, _ in batch]),
+            np.concatenate([docids for _, docids, _ in batch]),
+            np.concatenate([scores for _, _, scores in batch]),
+        )
+        qids, results = calc_per_query(run, qrels.subset(batch_qids), metrics)
+        qid2idx = {qid: i for i, qid in enumerate(qids.tolist())}
+        for qid in batch_qids:
+            if qid in qid2idx:
+                yield qid, {metric: float(results[metric][qid2idx[qid]]) for metric in metrics}
+
+    for qid in qrels:
+        if qid not in seen:
+            yield qid, {metric: 0.0 for metric in metrics}
+
+
+def calc_runfile(runfile, qrels, metrics=("AP",), outp_fn=None, fmt="trec", batch_entries=BATCH_ENTRIES, tmp_dir=None):
+    """
+    Evaluate a runfile too large to load, keeping only running aggregates in memory. A runfile that is
+    not grouped by query is grouped with an external sort first.
+
+    :param runfile: runfile path, can be compressed
+    :param qrels: `Qrels` or dict in format {qid: {docid: label, ...}, ...}
+    :param metrics: list of str, see `parse_metric`
+    :param outp_fn: str, write the per-query values there as trec_eval -q does ("metric\tqid\tvalue",
+        followed by the "all" lines)
+    :param fmt: str, "trec" or "tsv"
+    :param batch_entries: int, see `iter_calc_runfile`
+    :param tmp_dir: str, directory of the temporary files of the external sort
+    :return: dict in format {metric: mean value over the evaluated queries}
+    """
+    from .runops import _with_sorted_fallback
+
+    metrics = [str(metric) for metric in metrics]
+    qrels = qrels if isinstance(qrels, Qrels) else Qrels.from_dict(qrels)
+
+    def run(fn):
+        totals, count = dict.fromkeys(metrics, 0.0), 0
+        outp = fileio.open_output(outp_fn, "wt") if outp_fn else None
+        try:
+            for qid, values in iter_calc_runfile(fn, qrels, metrics, fmt=fmt, batch_entries=batch_entries):
+                count += 1
+                for metric, value in values.items():
+                    totals[metric] += value
+                if outp is not None:
+                    outp.write("".join(f"{metric}\t{qid}\t{value:.4f}\n" for metric, value in values.items()))
+            means = {metric: total / count if count else 0.0 for metric, total in totals.items()}
+            if outp is not None:
+                outp.write("".join(f"{metric}\tall\t{value:.4f}\n" for metric, value in means.items()))
+        finally:
+            if outp is not None:
+                outp.close()
+        return means
+
+    return _with_sorted_fallback(lambda fns: run(fns[0]), [runfile], tmp_dir=tmp_dir)
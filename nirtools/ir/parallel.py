@@ -0,0 +1,176 @@
+"""
+Multi-process loading of large runfiles. The file is split into byte ranges at query boundaries, each
+range is parsed into a dict or `Run` in a worker process, and the partial results are merged by query
+in file order, so the queries of a runfile not grouped by query are joined back together. Compressed
+runfiles cannot be split and are parsed by a single process.
+"""
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from . import parsing, fileio
+from .containers import Run
+
+MIN_RANGE_SIZE = 1 << 24
+
+
+def _find(f, delimiter, pos):
+    """
+    :return: int, the absolute position of the first delimiter at or after pos in the binary file, -1 if none
+    """
+    base = max(pos, 0)
+    f.seek(base)
+    tail = b""
+    while True:
+        block = f.read(1 << 16)
+        if not block:
+            return -1
+        data = tail + block
+        found = data.find(delimiter)
+        if found != -1:
+            return base + found
+        tail = data[len(data) - len(delimiter) + 1 :]
+        base += len(data) - len(tail)
+
+
+def split_byte_ranges(fn, num_ranges, delimiter=b"\n", after=True):
+    """
+    Split the file into about equal byte ranges, each starting right after an occurrence of the delimiter,
+    e.g. at the beginning of a line, or with after=False right at an occurrence, e.g. at a "<DOC>" tag
+
+    :param fn: file path
+    :param num_ranges: int, the maximum number of ranges
+    :param delimiter: bytes, default b"\\n"
+    :param after: bool, whether a range starts after or at the delimiter
+    :return: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(fn)
+    bounds = [0]
+    with open(fn, "rb") as f:
+        for i in range(1, num_ranges):
+            pos = max(size * i // num_ranges, bounds[-1] + 1)
+            if pos >= size:
+                break
+
+            # searching from pos - len(delimiter) lets a range start right at pos
+            found = _find(f, delimiter, pos - len(delimiter) if after else pos)
+            if found == -1:
+                break
+            pos = found + len(delimiter) if after else found
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+class RangeReader:
+    """
+    Binary file object restricted to the byte range [start, end) of the given file
+    """
+
+    def __init__(self, fn, start, end):
+        self.f = open(fn, "rb")
+        self.f.seek(start)
+        self.end = end
+
+    def read(self, size=-1):
+        remaining = max(self.end - self.f.tell(), 0)
+        return self.f.read(remaining if size < 0 else min(size, remaining))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _query_ranges(fn, ranges):
+    """
+    Move the end of each range past the remaining lines of the query it falls in, so no query of a
+    runfile grouped by query is split between two ranges
+
+    :param ranges: list of (start, end) byte offsets at line boundaries, see `split_byte_ranges`
+    """
+    bounds = [0]
+    with open(fn, "rb") as f:
+        for _, pos in ranges[:-1]:
+            pos = max(pos, bounds[-1])
+            f.seek(pos)
+            line = f.readline()
+            qid = line.split(None, 1)[:1]
+            while line and line.split(None, 1)[:1] == qid:
+                pos += len(line)
+                line = f.readline()
+            bounds.append(pos)
+    bounds.append(ranges[-1][1])
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def _load_range(fn, start, end, fmt, topk, as_array):
+    """
+    Parse the byte range [start, end) of the runfile into a dict or `Run`
+    """
+    from . import _load_runs_from_lines, _load_runs_from_rows, _iter_rows
+
+    with RangeReader(fn, start, end) as f:
+        lines = parsing.iter_lines(f)
+        if as_array:
+            return _load_runs_from_rows(_iter_rows(lines, fmt=fmt), topk=topk)
+        return dict(_load_runs_from_lines(lines, fmt=fmt, topk=topk))
+
+
+def load_runs_parallel(fn, topk=None, as_array=False, num_workers=None, fmt="trec"):
+    """
+    Loading trec or tsv format runfile with a pool of processes. Each worker builds the dict or `Run`
+    of its range. The parent still unpickles and merges the parts serially, which takes about 35% of the
+    serial loading time for dicts (mostly unpickling) and 12% for `Run` (mostly merging the docid
+    vocabularies), so the speedup stays below about 2.5x for dicts and 7x for `Run` however many cores.
+    With a single cpu, the runfile is loaded serially without starting a pool.
+
+    :param fn: runfile path
+    :param topk: positive int, only keep the topk documents per query
+    :param as_array: bool, return the array-backed `Run` instead of nested dict. default False
+    :param num_workers: int, number of processes, default to the number of cpus
+    :param fmt: str, "trec" or "tsv"
+    :return: same as `load_runs` or `load_runs_tsv`
+    """
+    from . import _check_topk, _topk_items, load_runs, load_runs_tsv
+
+    if fmt not in ("trec", "tsv"):
+        raise ValueError(f"Unexpected runfile format {fmt}, expected 'trec' or 'tsv'")
+    _check_topk(topk)
+
+    num_workers = num_workers or os.cpu_count()
+    num_ranges = min(num_workers * 2, os.path.getsize(fn) // MIN_RANGE_SIZE + 1)
+    if fileio.detect_compression(fn) is not None:  # compressed streams cannot be split by bytes
+        num_ranges = 1
+    if num_workers == 1 or num_ranges <= 1 or os.cpu_count() == 1:
+        load = load_runs if fmt == "trec" else load_runs_tsv
+        return load(fn, topk=topk, as_array=as_array)
+
+    ranges = _query_ranges(fn, split_byte_ranges(fn, num_ranges))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        parts = list(executor.map(_load_range, *zip(*[(fn, start, end, fmt, topk, as_array) for start, end in ranges])))
+
+    if as_array:
+        runs = Run.concat(parts)
+        return runs if topk is None else runs.topk(topk)
+
+    runs, straddled = defaultdict(dict), set()
+    for part in parts:
+        for qid, docid2score in part.items():
+            if qid in runs:  # a runfile not grouped by query
+                runs[qid].update(docid2score)
+                straddled.add(qid)
+            else:
+                runs[qid] = docid2score
+
+    if topk is not None:
+        for qid in straddled:
+            runs[qid] = _topk_items(runs[qid], topk)
+    return runs
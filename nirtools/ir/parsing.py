@@ -0,0 +1,44 @@
+"""
+Chunked reading of large text files: runfiles, qrels and collections are read in large blocks cut at
+line boundaries instead of line by line.
+"""
+import io
+
+CHUNK_SIZE = 1 << 24
+
+
+def iter_chunks(f, chunk_size=CHUNK_SIZE):
+    """
+    Read a binary file in large chunks, each ending at a line boundary
+
+    :param f: file object opened in binary mode
+    :param chunk_size: int, approximate number of bytes per chunk
+    :return: a iterator yielding bytes
+    """
+    remainder = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+
+        end = chunk.rfind(b"\n") + 1
+        if end == 0:
+            remainder += chunk
+            continue
+        yield remainder + chunk[:end]
+        remainder = chunk[end:]
+
+    if remainder:
+        yield remainder
+
+
+def iter_lines(f, chunk_size=CHUNK_SIZE):
+    """
+    Decode the binary file into str lines, same as iterating over the file in text mode, e.g. for a
+    `parallel.RangeReader` which cannot be wrapped into a text file
+
+    :param f: file object opened in binary mode
+    :return: a iterator yielding str
+    """
+    for chunk in iter_chunks(f, chunk_size=chunk_size):
+        yield from io.StringIO(chunk.decode("utf-8"), newline=None)
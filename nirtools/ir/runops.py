@@ -0,0 +1,274 @@
+"""
+Streaming operations on runfiles that are too large to load at once. Trec runfiles are normally
+grouped by query, i.e. all the lines of a query are consecutive, so a runfile can be processed one
+query at a time with the memory bounded by the largest query. Runfiles that are not grouped can be
+grouped first with an external sort.
+
+`cut`, `filter_qids`, `intersect_qids` and `merge_shards` work file to file when given paths, and on
+the array-backed `Run` otherwise, where all but the merge return views sharing the arrays of the run.
+"""
+import os
+import heapq
+import tempfile
+from operator import itemgetter
+from itertools import islice, groupby
+
+import numpy as np
+
+from . import fileio, write_runs, _qid_key, _iter_rows
+from .containers import Run, ArrayView
+
+SORT_LINES = 1000000
+
+
+def iter_query_groups(fn, fmt="trec"):
+    """
+    Yield the runfile one query at a time, without holding more than one query in memory
+
+    :param fn: runfile path, can be compressed
+    :param fmt: str, "trec" or "tsv" (whose ranks are turned into negative scores, same as `load_runs_tsv`)
+    :return: a iterator yielding (qid, docids, scores), where docids and scores are aligned np.ndarray
+        in file order
+    :raise ValueError: if the lines of a query are not consecutive, see `sort_runfile`
+    """
+    if fmt not in ("trec", "tsv"):
+        raise ValueError(f"Unexpected runfile format {fmt}, expected 'trec' or 'tsv'")
+
+    seen = set()
+    with fileio.open_input(fn, mode="rt") as f:
+        for qid, rows in groupby(_iter_rows(f, fmt=fmt), key=itemgetter(0)):
+            if qid in seen:
+                raise ValueError(f"{fn} is not grouped by query: {qid} appears again after other queries")
+            seen.add(qid)
+            _, docids, scores = zip(*rows)
+            yield qid, np.array(docids, dtype=str), np.array(scores)
+
+
+def _qid_of(line):
+    return line.split(None, 1)[0]
+
+
+def _line_key(line):
+    return _qid_key(_qid_of(line))
+
+
+def sort_runfile(fn, outp_fn=None, max_lines=SORT_LINES, tmp_dir=None):
+    """
+    Group the lines of a runfile by query with an external merge sort: sorted runs of at most max_lines
+    lines are written to temporary files and merged. The queries come in the order of `write_runs`, integer
+    qids by their int value, and the lines of each query keep their file order.
+
+    :param fn: runfile path, can be compressed
+    :param outp_fn: output path, compressed according to its extension; default to a temporary file
+        next to the other temporary files, which the caller should remove
+    :param max_lines: int, number of lines held in memory at a time
+    :param tmp_dir: str, directory of the temporary files
+    :return: str, the output path
+    """
+    part_fns = []
+    try:
+        with fileio.open_input(fn, "rt") as f:
+            while True:
+                lines = [line if line.endswith("\n") else line + "\n" for line in islice(f, max_lines) if line.strip()]
+                if not lines:
+                    break
+                lines.sort(key=_line_key)  # stable, so the lines of a query keep their order
+                fd, part_fn = tempfile.mkstemp(suffix=".run", dir=tmp_dir)
+                part_fns.append(part_fn)
+                with os.fdopen(fd, "w", buffering=fileio.BUFFER_SIZE) as fout:
+                    fout.writelines(lines)
+
+        if outp_fn is None:
+            fd, outp_fn = tempfile.mkstemp(suffix=".run", dir=tmp_dir)
+            os.close(fd)
+        parts = [open(part_fn, buffering=fileio.BUFFER_SIZE) for part_fn in part_fns]
+        try:
+            with fileio.open_output(outp_fn, "wt") as fout:
+                # heapq.merge takes equal keys from the earlier part first, which keeps the file order
+                fout.writelines(heapq.merge(*parts, key=_line_key))
+        finally:
+            for part in parts:
+                part.close()
+    finally:
+        for part_fn in part_fns:
+            os.remove(part_fn)
+    return outp_fn
+
+
+def _is_unordered(e):
+    return "is not grouped by query" in str(e) or "is not sorted by query" in str(e)
+
+
+def _with_sorted_fallback(write, fns, tmp_dir=None):
+    """
+    Run write(fns), and if a runfile turns out not to be grouped (or sorted) by query, sort all of them
+    with `sort_runfile` and run it again on the sorted copies
+    """
+    try:
+        return write(fns)
+    except ValueError as e:
+        if not _is_unordered(e):
+            raise
+
+    sorted_fns = []
+    try:
+        for fn in fns:
+            sorted_fns.append(sort_runfile(fn, tmp_dir=tmp_dir))
+        return write(sorted_fns)
+    finally:
+        for fn in sorted_fns:
+            os.remove(fn)
+
+
+def _topk_group(docids, scores, topk):
+    order = np.argsort(-scores, kind="stable")[:topk]
+    return dict(zip(docids[order].tolist(), scores[order].tolist()))
+
+
+def _as_run(run):
+    return run if isinstance(run, (Run, ArrayView)) else Run.from_dict(run)
+
+
+def cut(run, topk, outp_fn=None, label="test", tmp_dir=None):
+    """
+    Keep the topk documents of each query
+
+    :param run: runfile path, or `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param topk: positive int
+    :param outp_fn: output path, required for a runfile path
+    :param label: str, the run tag of the output lines
+    :param tmp_dir: str, directory of the temporary files if the runfile needs sorting
+    :return: outp_fn for a runfile path, otherwise an `ArrayView` of the run
+    """
+    if topk <= 0:
+        raise ValueError(f"Expect a positive topk, but got {topk}")
+    if not isinstance(run, str):
+        return _as_run(run).view(depth=topk)
+    if outp_fn is None:
+        raise ValueError(f"Expect outp_fn to cut the runfile {run}")
+
+    def write(fns):
+        groups = iter_query_groups(fns[0])
+        write_runs(((qid, _topk_group(docids, scores, topk)) for qid, docids, scores in groups), outp_fn, label=label)
+        return outp_fn
+
+    return _with_sorted_fallback(write, [run], tmp_dir=tmp_dir)
+
+
+def iter_qids(fn):
+    """
+    :param fn: trec-format runfile or qrels path, can be compressed
+    :return: a iterator yielding the qid of every line
+    """
+    with fileio.open_input(fn, "rt") as f:
+        for line in f:
+            if line.strip():
+                yield _qid_of(line)
+
+
+def _qid_set(qids):
+    if isinstance(qids, str):  # a runfile or qrels path
+        return set(iter_qids(qids))
+    return set(qids)
+
+
+def filter_qids(run, qids, outp_fn=None):
+    """
+    Keep the queries in qids, e.g. the ones in the qrels before a significance test. Runfile lines
+    are copied unchanged.
+
+    :param run: runfile path, or `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param qids: iterable of str, or the path of a runfile or qrels file to take the qids from
+    :param outp_fn: output path, required for a runfile path
+    :return: outp_fn for a runfile path, otherwise an `ArrayView` of the run, in run order
+    """
+    qids = _qid_set(qids)
+    if not isinstance(run, str):
+        run = _as_run(run)
+        return run.view(qids=[qid for qid in run if qid in qids])
+    if outp_fn is None:
+        raise ValueError(f"Expect outp_fn to filter the runfile {run}")
+
+    with fileio.open_input(run, "rt") as f, fileio.open_output(outp_fn, "wt") as fout:
+        for lines in iter(lambda: list(islice(f, SORT_LINES)), []):
+            fout.writelines(
+                line if line.endswith("\n") else line + "\n" for line in lines if line.strip() and _qid_of(line) in qids
+            )
+    return outp_fn
+
+
+def intersect_qids(run1, run2, outp_fn1=None, outp_fn2=None):
+    """
+    Keep the queries found in both runs, e.g. before `eval.sig_test_from_runs`
+
+    :param run1, run2: runfile paths, or `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param outp_fn1, outp_fn2: output paths, required for runfile paths
+    :return: (outp_fn1, outp_fn2) for runfile paths, otherwise two `ArrayView` in the query order of run1
+    """
+    if isinstance(run1, str) != isinstance(run2, str):
+        raise TypeError(f"Expect two runfile paths or two runs.")
+    qids = _qid_set(run1) & _qid_set(run2)
+    if isinstance(run1, str):
+        return filter_qids(run1, qids, outp_fn1), filter_qids(run2, qids, outp_fn2)
+
+    run1, run2 = _as_run(run1), _as_run(run2)
+    common = [qid for qid in run1 if qid in qids]
+    return run1.view(qids=common), run2.view(qids=common)
+
+
+def _iter_sorted_groups(fn):
+    prev = None
+    for qid, docids, scores in iter_query_groups(fn):
+        if prev is not None and _qid_key(qid) < _qid_key(prev):
+            raise ValueError(f"{fn} is not sorted by query: {qid} comes after {prev}")
+        prev = qid
+        yield qid, docids, scores
+
+
+def _merge_group(groups, topk):
+    groups = list(groups)
+    docids = np.concatenate([docids for _, docids, _ in groups])
+    scores = np.concatenate([scores for _, _, scores in groups])
+    if topk is not None:
+        return _topk_group(docids, scores, topk)
+    return dict(zip(docids.tolist(), scores.tolist()))
+
+
+def merge_shards(runs, outp_fn=None, topk=None, label="test", tmp_dir=None):
+    """
+    Merge runs holding different queries or different documents of the same queries, e.g. the shards
+    of a distributed reranking. A document found in several shards keeps the score of the last one.
+    The runfiles are merged k-way by qid, holding one query per shard in memory; shards not sorted by
+    qid in the order of `write_runs` (integer qids by their int value) are sorted first.
+
+    :param runs: list of runfile paths, or list of `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param outp_fn: output path, required for runfile paths
+    :param topk: int, keep the topk documents of each merged query
+    :param label: str, the run tag of the output lines
+    :param tmp_dir: str, directory of the temporary files if the runfiles need sorting
+    :return: outp_fn for runfile paths, otherwise a new `Run` with the queries in the same order
+    """
+    runs = list(runs)
+    if not all(isinstance(run, str) for run in runs):
+        records = [_as_run(run) for run in runs]
+        records = [run.materialize() if isinstance(run, ArrayView) else run for run in records]
+        records = [np.concatenate(columns) for columns in zip(*(run.to_records() for run in records))]
+        qids, inverse = np.unique(records[0], return_inverse=True)
+        rank = np.empty(len(qids), dtype=np.int64)
+        rank[sorted(range(len(qids)), key=lambda i: _qid_key(qids[i]))] = np.arange(len(qids))
+        order = np.argsort(rank[inverse.reshape(-1)], kind="stable")
+        merged = Run.from_records(*(column[order] for column in records))
+        return merged if topk is None else merged.topk(topk)
+    if outp_fn is None:
+        raise ValueError(f"Expect outp_fn to merge the runfiles.")
+
+    def write(fns):
+        groups = heapq.merge(*[_iter_sorted_groups(fn) for fn in fns], key=lambda group: _qid_key(group[0]))
+        write_runs(
+            ((qid, _merge_group(same_qid, topk)) for qid, same_qid in groupby(groups, key=lambda group: group[0])),
+            outp_fn,
+            label=label,
+        )
+        return outp_fn
+
+    return _with_sorted_fallback(write, runs, tmp_dir=tmp_dir)
@@ -1,22 +1,53 @@
 """ A comparison between each significant test can be found here: https://ciir-publications.cs.umass.edu/getpdf.php?id=744#:~:text=Information%20retrieval%20(IR)%20researchers%20commonly,test%2C%20and%20the%20sign%20test.&text=Both%20the%20Wilcoxon%20and%20sign,to%20false%20detections%20of%20significance. """
 from argparse import ArgumentParser
+from collections import namedtuple
 
 import numpy as np
 import ir_measures
 from ir_measures import *
 
 from scipy import stats
-from nirtools.ir import load_qrels, load_runs
+from nirtools.ir import load_qrels, load_runs, as_dict, Run
+from nirtools.ir import metrics as native
+from nirtools.ir.metric_cache import get_cache, content_hash
 
 
-def _calc_scores(runs, qrels, metric="AP", return_qid=False):
+def _calc_per_query(qrels, runs, metrics, cache=None, qrels_hash=None):
+    """
+    :param metrics: list of ir_measures metrics
+    :param cache: None, True for the default `MetricCache`, or a `MetricCache`
+    :param qrels_hash: str, the `content_hash` of the qrels, to hash dict qrels once for several runs
+    :return: list of dict in format {qid: value}, one per metric
+    """
+    def compute(names):
+        todo = [metric for metric in metrics if f"ir_measures:{metric}" in names]
+        if isinstance(runs, Run) and all(native.is_supported(metric) for metric in todo):
+            # skip the conversion of array-backed runs into nested dicts, the values are the same
+            qids, values = native.calc_per_query(runs, qrels, [str(metric) for metric in todo])
+            return {f"ir_measures:{metric}": dict(zip(qids.tolist(), values[str(metric)].tolist())) for metric in todo}
+
+        results = {f"ir_measures:{metric}": {} for metric in todo}
+        for m in ir_measures.iter_calc(todo, as_dict(qrels), as_dict(runs)):
+            results[f"ir_measures:{m.measure}"][m.query_id] = m.value
+        return results
+
+    names = [f"ir_measures:{metric}" for metric in metrics]
+    cache = get_cache(cache)
+    if cache is None:
+        results = compute(names)
+    else:
+        results = cache.get_or_compute(qrels, runs, names, compute, qrels_hash=qrels_hash)
+    return [results[name] for name in names]
+
+
+def _calc_scores(runs, qrels, metric="AP", return_qid=False, cache=None, qrels_hash=None):
     if isinstance(metric, str):
         metric = eval(metric)
         # todo: ensure the metric is from ir_measures
 
     # return ir_measures.calc_aggregate([metric], qrels, runs)[metric]
-    qids_scores = [(m.query_id, m.value) for m in ir_measures.iter_calc([metric], qrels, runs)]
-    qids_scores = sorted(qids_scores, key=lambda kv: kv[0])
+    (qid2score,) = _calc_per_query(qrels, runs, [metric], cache=cache, qrels_hash=qrels_hash)
+    qids_scores = sorted(qid2score.items(), key=lambda kv: kv[0])
     qids, scores = zip(*qids_scores)
 
     if not return_qid:
@@ -25,22 +56,278 @@ def _calc_scores(runs, qrels, metric="AP", return_qid=False):
         return qids, scores
 
 
-def sig_test_from_runs(qrels, runs1, runs2, metric="AP", return_scores=False):
+def sig_test_from_runs(qrels, runs1, runs2, metric="AP", return_scores=False, cache=None):
     if set(runs1) != set(runs2):
         raise ValueError(f"Expect same keys from two run objects.")
 
-    scores1 = _calc_scores(runs1, qrels=qrels, metric=metric, return_qid=False)
-    scores2 = _calc_scores(runs2, qrels=qrels, metric=metric, return_qid=False)
+    cache = get_cache(cache)
+    qrels_hash = None if cache is None else content_hash(qrels)  # once for both runs
+    scores1 = _calc_scores(runs1, qrels=qrels, metric=metric, return_qid=False, cache=cache, qrels_hash=qrels_hash)
+    scores2 = _calc_scores(runs2, qrels=qrels, metric=metric, return_qid=False, cache=cache, qrels_hash=qrels_hash)
     t, p = stats.ttest_rel(scores1, scores2)
     if return_scores:
         return t, p, np.mean(scores1), np.mean(scores2)
     return t, p
 
 
-def sig_test_from_files(qrelfile, runfile1, runfile2, metric="AP", return_scores=False):
+def sig_test_from_files(qrelfile, runfile1, runfile2, metric="AP", return_scores=False, cache=None):
     qrels = load_qrels(qrelfile)
     runs1, runs2 = load_runs(runfile1), load_runs(runfile2)
-    return sig_test_from_runs(qrels, runs1, runs2, metric=metric, return_scores=return_scores)
+    return sig_test_from_runs(qrels, runs1, runs2, metric=metric, return_scores=return_scores, cache=cache)
+
+
+N_SAMPLES = 10000
+CHUNK_SIZE = 1000
+
+SigTestResult = namedtuple(
+    "SigTestResult",
+    ["run1", "run2", "metric", "test", "mean1", "mean2", "statistic", "pvalue", "pvalue_adjusted"],
+    defaults=(None,),
+)
+
+
+def _parse_metric(metric):
+    return ir_measures.parse_measure(metric) if isinstance(metric, str) else metric
+
+
+def calc_score_matrix(qrels, runs, metrics=("AP",), qids=None, cache=None):
+    """
+    Evaluate every run once on all the metrics and collect the per-query scores
+
+    :param qrels: dict in format {qid: {docid: label, ...}, ...} or `Qrels`
+    :param runs: list of runs, each a dict in format {qid: {docid: score, ...}, ...} or `Run`
+    :param metrics: list of ir_measures metrics or their names, e.g. ["AP", "nDCG@10"]
+    :param qids: list of str, the queries to align on, default to every query evaluated in any run.
+        A query evaluated in the qrels but missing in a run scores 0 for that run.
+    :param cache: None, True for the default `MetricCache`, or a `MetricCache` to reuse the per-query
+        values of earlier evaluations
+    :return: (qids, scores), where scores[i, j, k] is metric j of runs[i] on qids[k]
+    """
+    metrics = [_parse_metric(metric) for metric in metrics]
+    cache = get_cache(cache)
+    qrels_hash = None if cache is None else content_hash(qrels)  # once for all the runs
+    per_run = [_calc_per_query(qrels, run, metrics, cache=cache, qrels_hash=qrels_hash) for run in runs]
+
+    if qids is None:
+        qids = sorted({qid for per_metric in per_run for qid2score in per_metric for qid in qid2score})
+    scores = np.zeros((len(per_run), len(metrics), len(qids)))
+    for i, per_metric in enumerate(per_run):
+        for j, qid2score in enumerate(per_metric):
+            scores[i, j] = [qid2score.get(qid, 0.0) for qid in qids]
+    return list(qids), scores
+
+
+def _ttest(a, b):
+    return stats.ttest_rel(a, b, axis=1)
+
+
+def _wilcoxon(a, b):
+    # one call per pair: scipy picks the exact or approximate method and handles zeros and ties
+    # once per call, so batching the pairs would let one pair change the p-value of another
+    diffs = a - b
+    statistic, pvalue = np.full(len(diffs), np.nan), np.ones(len(diffs))
+    for i in np.flatnonzero((diffs != 0).any(axis=1)):  # identical scores on every query, nothing to rank
+        statistic[i], pvalue[i] = stats.wilcoxon(diffs[i])
+    return statistic, pvalue
+
+
+def _sign_test(a, b):
+    wins, losses = (a > b).sum(axis=1), (a < b).sum(axis=1)
+    pvalue = np.minimum(2 * stats.binom.cdf(np.minimum(wins, losses), wins + losses, 0.5), 1.0)
+    return wins - losses, pvalue
+
+
+def _resample_pvalue(diffs, resampled, draw, n_samples, chunk_size):
+    """
+    :param diffs: np.ndarray in shape (n_pairs, n_queries), the observed differences
+    :param resampled: np.ndarray in shape (n_pairs, n_queries), the differences under the null hypothesis
+    :param draw: callable returning the (n, n_queries) weights of n resampled means of `resampled`
+    :return: np.ndarray, the fraction of resampled |mean| at least as large as the observed one,
+        counting the observation itself
+    """
+    observed = np.abs(diffs.mean(axis=1))
+    tolerance = 1e-12 * np.maximum(observed, 1)
+    exceed = np.zeros(len(diffs), dtype=np.int64)
+    for start in range(0, n_samples, chunk_size):
+        weights = draw(min(chunk_size, n_samples - start))
+        means = np.abs(weights @ resampled.T) / diffs.shape[1]
+        exceed += (means >= observed - tolerance).sum(axis=0)
+    return (exceed + 1) / (n_samples + 1)
+
+
+def randomization_test(scores1, scores2, n_samples=N_SAMPLES, seed=None, chunk_size=CHUNK_SIZE):
+    """
+    Paired two-sided Fisher randomization test on the mean difference. Each sample flips the sign of
+    the per-query differences at random, the same samples are shared by every pair.
+
+    :param scores1, scores2: np.ndarray in shape (n_pairs, n_queries), the aligned per-query scores
+    :param n_samples: int, number of random sign assignments
+    :param seed: int or np.random.Generator
+    :param chunk_size: int, number of samples drawn at a time, bounds the memory to chunk_size * n_queries
+    :return: (mean differences, pvalues), each a np.ndarray in shape (n_pairs,)
+    """
+    diffs = np.atleast_2d(scores1) - np.atleast_2d(scores2)
+    rng, n_queries = np.random.default_rng(seed), diffs.shape[1]
+
+    def draw(n):
+        bits = rng.integers(0, 256, size=(n, (n_queries + 7) // 8), dtype=np.uint8)
+        return np.unpackbits(bits, axis=1, count=n_queries).astype(np.float64) * 2 - 1
+
+    return diffs.mean(axis=1), _resample_pvalue(diffs, diffs, draw, n_samples, chunk_size)
+
+
+def bootstrap_test(scores1, scores2, n_samples=N_SAMPLES, seed=None, chunk_size=CHUNK_SIZE):
+    """
+    Paired two-sided bootstrap test on the mean difference: the queries are resampled with
+    replacement from the differences shifted to a zero mean, the same samples are shared by every pair.
+
+    :param scores1, scores2: np.ndarray in shape (n_pairs, n_queries), the aligned per-query scores
+    :param n_samples: int, number of bootstrap samples
+    :param seed: int or np.random.Generator
+    :param chunk_size: int, number of samples drawn at a time, bounds the memory to chunk_size * n_queries
+    :return: (mean differences, pvalues), each a np.ndarray in shape (n_pairs,)
+    """
+    diffs = np.atleast_2d(scores1) - np.atleast_2d(scores2)
+    rng, n_queries = np.random.default_rng(seed), diffs.shape[1]
+    centered = diffs - diffs.mean(axis=1, keepdims=True)
+
+    def draw(n):  # the number of times each query is drawn, i.e. multinomial counts
+        picks = rng.integers(0, n_queries, size=(n, n_queries)) + np.arange(n)[:, None] * n_queries
+        return np.bincount(picks.ravel(), minlength=n * n_queries).reshape(n, n_queries).astype(np.float64)
+
+    return diffs.mean(axis=1), _resample_pvalue(diffs, centered, draw, n_samples, chunk_size)
+
+
+SIG_TESTS = {
+    "t-test": _ttest,
+    "wilcoxon": _wilcoxon,
+    "sign": _sign_test,
+    "randomization": randomization_test,
+    "bootstrap": bootstrap_test,
+}
+_RESAMPLING_TESTS = ("randomization", "bootstrap")
+
+
+def adjust_pvalues(pvalues, method="holm"):
+    """
+    Correct the pvalues of a family of tests for multiple comparisons
+
+    :param pvalues: array-like of float
+    :param method: str, "bonferroni", "holm" or "bh" (Benjamini-Hochberg)
+    :return: np.ndarray, the adjusted pvalues in the same order
+    """
+    pvalues = np.asarray(pvalues, dtype=float)
+    n = len(pvalues)
+    if method == "bonferroni":
+        return np.minimum(pvalues * n, 1.0)
+    if method not in ("holm", "bh"):
+        raise ValueError(f"Unexpected correction {method}, expected 'bonferroni', 'holm' or 'bh'")
+
+    order = np.argsort(pvalues, kind="stable")
+    ranked = pvalues[order]
+    if method == "holm":
+        adjusted = np.maximum.accumulate(ranked * (n - np.arange(n)))
+    else:
+        adjusted = np.minimum.accumulate((ranked * n / np.arange(1, n + 1))[::-1])[::-1]
+    result = np.empty(n)
+    result[order] = np.minimum(adjusted, 1.0)
+    return result
+
+
+def paired_tests(scores1, scores2, tests=("t-test",), n_samples=N_SAMPLES, seed=None):
+    """
+    Run the paired tests on many system pairs at once
+
+    :param scores1, scores2: np.ndarray in shape (n_pairs, n_queries), the aligned per-query scores
+    :param tests: list of str, keys of `SIG_TESTS`
+    :param n_samples: int, number of samples of the randomization and bootstrap tests
+    :param seed: int, seed of the randomization and bootstrap tests
+    :return: dict in format {test: (statistics, pvalues)}, each a np.ndarray in shape (n_pairs,)
+    """
+    scores1, scores2 = np.atleast_2d(scores1), np.atleast_2d(scores2)
+    results = {}
+    for test in tests:
+        if test not in SIG_TESTS:
+            raise ValueError(f"Unexpected test {test}, expected one of {list(SIG_TESTS)}")
+        kwargs = {"n_samples": n_samples, "seed": seed} if test in _RESAMPLING_TESTS else {}
+        results[test] = tuple(np.asarray(arr, dtype=float) for arr in SIG_TESTS[test](scores1, scores2, **kwargs))
+    return results
+
+
+def batch_sig_test(
+    qrels, runs, metrics=("AP",), tests=("t-test",), baseline=None, pairs=None, correction=None, n_samples=N_SAMPLES,
+    seed=None, cache=None,
+):
+    """
+    Significance tests between many runs on many metrics, where every run is evaluated only once
+
+    :param qrels: dict in format {qid: {docid: label, ...}, ...} or `Qrels`
+    :param runs: dict in format {name: run}
+    :param metrics: list of ir_measures metrics or their names
+    :param tests: list of str, keys of `SIG_TESTS`
+    :param baseline: str, name of the run every other run is compared against
+    :param pairs: list of (name1, name2), the run pairs to compare; default to every run against the
+        baseline, or every pair of runs if no baseline is given
+    :param correction: str, "bonferroni", "holm" or "bh", adjusts the pvalues of each metric and test
+        across the pairs, see `adjust_pvalues`
+    :param n_samples, seed: see `paired_tests`
+    :param cache: see `calc_score_matrix`
+    :return: list of `SigTestResult`, one row per pair, metric and test
+    """
+    names = list(runs)
+    if pairs is None:
+        if baseline is not None:
+            pairs = [(baseline, name) for name in names if name != baseline]
+        else:
+            pairs = [(name1, name2) for i, name1 in enumerate(names) for name2 in names[i + 1 :]]
+    for pair in pairs:
+        for name in pair:
+            if name not in runs:
+                raise ValueError(f"Unknown run {name}, expected one of {names}")
+
+    _, scores = calc_score_matrix(qrels, [runs[name] for name in names], metrics=metrics, cache=cache)
+    index1 = [names.index(name1) for name1, _ in pairs]
+    index2 = [names.index(name2) for _, name2 in pairs]
+    means = scores.mean(axis=2)
+
+    rows = []
+    for j, metric in enumerate(metrics):
+        results = paired_tests(scores[index1, j], scores[index2, j], tests=tests, n_samples=n_samples, seed=seed)
+        adjusted = {
+            test: [None] * len(pairs) if correction is None else adjust_pvalues(pvalues, correction)
+            for test, (_, pvalues) in results.items()
+        }
+        for p, (name1, name2) in enumerate(pairs):
+            for test in tests:
+                statistics, pvalues = results[test]
+                mean1, mean2 = means[index1[p], j], means[index2[p], j]
+                rows.append(
+                    SigTestResult(
+                        name1, name2, str(metric), test, mean1, mean2, statistics[p], pvalues[p], adjusted[test][p]
+                    )
+                )
+    return rows
+
+
+def batch_sig_test_from_files(qrelfile, runfiles, **kwargs):
+    """
+    Same as `batch_sig_test`, with the runs named by their file paths
+    """
+    qrels = load_qrels(qrelfile, as_array=True)
+    runs = {runfile: load_runs(runfile, as_array=True) for runfile in runfiles}
+    return batch_sig_test(qrels, runs, **kwargs)
+
+
+def format_sig_table(rows, sep="\t"):
+    """
+    :param rows: list of `SigTestResult`
+    :return: str, the rows as a table with a header line, e.g. for printing or saving as tsv
+    """
+    lines = [sep.join(SigTestResult._fields)]
+    for row in rows:
+        row = [f"{value:.4f}" if isinstance(value, float) else "" if value is None else str(value) for value in row]
+        lines.append(sep.join(row))
+    return "\n".join(lines) + "\n"
 
 
 if __name__ == "__main__":
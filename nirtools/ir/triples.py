@@ -0,0 +1,213 @@
+"""
+Training triples (query, positive, negative) from a run, its qrels and the collection texts.
+
+`sample_triples` works on the array-backed `Run` and `Qrels` only: the judged positives are removed
+from the candidates with one join over (query, document) keys, and the negatives of all the positives
+are drawn at once from the depth window of their query. The texts are then resolved in batches through
+a `DocStore` (or any docid -> text mapping) while the triples are written out, optionally as several
+shards written by worker processes.
+"""
+import json
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import load_runs, load_qrels, load_topic_tsv, fileio
+from .containers import Run, Qrels
+from .docstore import DocStore
+from .fusion import _ranks
+from .metrics import _map_codes
+
+BATCH_SIZE = 10000
+FORMATS = ("tsv", "jsonl")
+
+_TSV_ESCAPES = str.maketrans("\t\n\r", "   ")
+
+# topics and collection of the current worker process, set once by `_init_worker`
+_worker_state = {}
+
+
+def sample_triples(run, qrels, n_negatives=1, window=(0, 1000), min_label=1, max_positives=None, seed=0):
+    """
+    Pair every judged positive of a query with negatives sampled uniformly from the run candidates
+    ranked in the window, excluding the positives of the query. Queries without positives or without
+    candidates are skipped. The result only depends on the inputs and the seed.
+
+    :param run: runfile path, `Run` or dict in format {qid: {docid: score, ...}, ...}
+    :param qrels: qrels path, `Qrels` or dict in format {qid: {docid: label, ...}, ...}
+    :param n_negatives: int, number of negatives per positive, drawn with replacement
+    :param window: (start, end), the 0-based ranks [start, end) the negatives are drawn from
+    :param min_label: int, the smallest label counted as positive
+    :param max_positives: int, keep at most this many positives per query, chosen at random
+    :param seed: int, seed of the sampling
+    :return: (qids, pos_docids, neg_docids), three aligned np.ndarray with one row per triple, grouped by
+        query in run order
+    """
+    run = load_runs(run, as_array=True) if isinstance(run, str) else run
+    run = run if isinstance(run, Run) else Run.from_dict(run)
+    qrels = load_qrels(qrels, as_array=True) if isinstance(qrels, str) else qrels
+    qrels = qrels if isinstance(qrels, Qrels) else Qrels.from_dict(qrels)
+    rng = np.random.default_rng(seed)
+    start, end = window
+
+    # positives of the queries in the run, as (run query, qrels docid code) and sorted by run query
+    run_qid2idx = {qid: i for i, qid in enumerate(run.qids.tolist())}
+    qrels_query = np.array([run_qid2idx.get(qid, -1) for qid in qrels.qids.tolist()], dtype=np.int64)
+    pos_query = qrels_query[qrels.query_codes()]
+    is_pos = (pos_query != -1) & (qrels.values >= min_label)
+    pos_query, pos_doc = pos_query[is_pos], qrels.doc_codes[is_pos]
+    if max_positives is not None:
+        order = np.lexsort((rng.random(len(pos_query)), pos_query))
+    else:
+        order = np.argsort(pos_query, kind="stable")
+    pos_query, pos_doc = pos_query[order], pos_doc[order]
+    if max_positives is not None:
+        first = np.searchsorted(pos_query, pos_query)
+        keep = np.arange(len(pos_query)) - first < max_positives
+        pos_query, pos_doc = pos_query[keep], pos_doc[keep]
+
+    # candidates in the window, without the positives: a join on query * n_docs + run docid code
+    run_query = run.query_codes()
+    ranks = _ranks(run)
+    n_docs = max(len(run.docids), 1)
+    pos_run_doc = _map_codes(run.docids, qrels.docids[pos_doc])
+    pos_keys = pos_query[pos_run_doc != -1] * n_docs + pos_run_doc[pos_run_doc != -1]
+    is_cand = (ranks > start) & (ranks <= end)
+    is_cand &= ~np.isin(run_query * n_docs + run.doc_codes, pos_keys)
+    cand = np.flatnonzero(is_cand)  # grouped by query, as the entries
+    cand_count = np.bincount(run_query[cand], minlength=len(run.qids))
+    cand_start = np.concatenate([[0], np.cumsum(cand_count)[:-1]])
+
+    rows = np.repeat(np.arange(len(pos_query)), n_negatives)
+    rows = rows[cand_count[pos_query[rows]] > 0]
+    query = pos_query[rows]
+    negatives = cand[cand_start[query] + (rng.random(len(rows)) * cand_count[query]).astype(np.int64)]
+    return run.qids[query], qrels.docids[pos_doc[rows]], run.docids[run.doc_codes[negatives]]
+
+
+def _fetch(collection, docids):
+    if hasattr(collection, "get_many"):
+        return collection.get_many(docids)
+    return {docid: collection[docid] for docid in docids if docid in collection}
+
+
+def iter_triples(triples, topics, collection, batch_size=BATCH_SIZE):
+    """
+    Resolve the texts of the triples, one batch of unique docids at a time. Triples whose query or
+    documents have no text are skipped.
+
+    :param triples: (qids, pos_docids, neg_docids), as returned by `sample_triples`
+    :param topics: dict in format {qid: text}
+    :param collection: `DocStore` or dict in format {docid: text}
+    :param batch_size: int, number of triples resolved at a time
+    :return: a iterator yielding (qid, pos_docid, neg_docid, query, positive, negative)
+    """
+    qids, pos_docids, neg_docids = triples
+    for i in range(0, len(qids), batch_size):
+        batch = qids[i : i + batch_size].tolist(), pos_docids[i : i + batch_size].tolist(), neg_docids[i : i + batch_size].tolist()
+        texts = _fetch(collection, set(batch[1]) | set(batch[2]))
+        for qid, pos_docid, neg_docid in zip(*batch):
+            query, positive, negative = topics.get(qid), texts.get(pos_docid), texts.get(neg_docid)
+            if query is None or positive is None or negative is None:
+                continue
+            yield qid, pos_docid, neg_docid, query, positive, negative
+
+
+def _format_triples(rows, fmt):
+    if fmt == "tsv":
+        return "".join(
+            f"{query.translate(_TSV_ESCAPES)}\t{positive.translate(_TSV_ESCAPES)}\t{negative.translate(_TSV_ESCAPES)}\n"
+            for _, _, _, query, positive, negative in rows
+        )
+    return "".join(
+        json.dumps(dict(zip(("qid", "pos_id", "neg_id", "query", "positive", "negative"), row))) + "\n" for row in rows
+    )
+
+
+def _init_worker(topics, collection):
+    if isinstance(collection, DocStore):
+        collection.close()  # a forked worker reopens the collection instead of sharing the parent's file
+    _worker_state.update(topics=topics, collection=collection)
+
+
+def _write_shard(outp_fn, triples, fmt, batch_size):
+    """
+    :return: (outp_fn, number of triples written, error), where error is the traceback of a failure
+    """
+    try:
+        n_written = 0
+        with fileio.open_output(outp_fn, "wt") as f:
+            rows = []
+            for row in iter_triples(triples, _worker_state["topics"], _worker_state["collection"], batch_size):
+                rows.append(row)
+                if len(rows) == batch_size:
+                    f.write(_format_triples(rows, fmt))
+                    n_written, rows = n_written + len(rows), []
+            f.write(_format_triples(rows, fmt))
+            n_written += len(rows)
+    except Exception:
+        return outp_fn, 0, traceback.format_exc()
+    return outp_fn, n_written, None
+
+
+def _mp_context():
+    # forked workers share the topics and the docstore index copy-on-write
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def write_triples(
+    run, qrels, topics, collection, outp_prefix, fmt="tsv", compression=None, num_shards=1, workers=1,
+    batch_size=BATCH_SIZE, **kwargs
+):
+    """
+    Sample the triples and write them with their texts, split into contiguous shards written in parallel.
+    tsv lines are "query\\tpositive\\tnegative" as the MS MARCO training triples, with tabs and newlines in
+    the texts replaced by spaces; jsonl lines also hold the ids.
+
+    >>> write_triples("bm25.trec", "qrels.train.tsv", "queries.train.tsv", "collection.tsv", "triples/train",
+    ...               num_shards=16, workers=8, window=(0, 200), seed=42)
+
+    :param run, qrels: see `sample_triples`
+    :param topics: dict in format {qid: text}, or the path of a tsv topic file, see `load_topic_tsv`
+    :param collection: `DocStore`, dict in format {docid: text}, or a collection path opened as a `DocStore`
+    :param outp_prefix: str, the shards are written to "{outp_prefix}-{shard_id:05d}.{fmt}"
+    :param fmt: str, "tsv" or "jsonl"
+    :param compression: str, e.g. "gz", appended to the shard extensions
+    :param num_shards: int, number of output files
+    :param workers: int, number of processes writing the shards
+    :param batch_size: int, number of triples whose texts are fetched and written at a time
+    :param kwargs: passed to `sample_triples`
+    :return: list of (shard path, number of triples written)
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unexpected output format {fmt}, expected one of {FORMATS}")
+    topics = dict(load_topic_tsv(topics)) if isinstance(topics, str) else topics
+    collection = DocStore(collection) if isinstance(collection, str) else collection
+
+    qids, pos_docids, neg_docids = sample_triples(run, qrels, **kwargs)
+    bounds = np.linspace(0, len(qids), num_shards + 1).astype(np.int64)
+    suffix = f".{fmt}" + (f".{compression}" if compression else "")
+    shards = [
+        (f"{outp_prefix}-{i:05d}{suffix}", (qids[start:end], pos_docids[start:end], neg_docids[start:end]))
+        for i, (start, end) in enumerate(zip(bounds, bounds[1:]))
+    ]
+
+    workers = min(workers or multiprocessing.cpu_count(), num_shards)
+    if workers == 1:
+        _init_worker(topics, collection)
+        results = [_write_shard(outp_fn, triples, fmt, batch_size) for outp_fn, triples in shards]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=_mp_context(), initializer=_init_worker, initargs=(topics, collection)
+        ) as executor:
+            futures = [executor.submit(_write_shard, outp_fn, triples, fmt, batch_size) for outp_fn, triples in shards]
+            results = [future.result() for future in futures]
+
+    for outp_fn, _, error in results:
+        if error is not None:
+            raise RuntimeError(f"Failed to write {outp_fn}:\n{error}")
+    return [(outp_fn, n_written) for outp_fn, n_written, _ in results]
@@ -1,21 +1,37 @@
+"""
+Download of (large) files shared on Google Drive.
+
+The content is written to `destination + ".part"` and only renamed to the destination once complete
+and verified, so an interrupted download never leaves a truncated destination. A dropped connection is
+resumed from the bytes already written with an HTTP Range request, and servers supporting ranges can
+be fetched in several parallel segments. Completed downloads are kept in a local cache addressed by
+their sha256, so downloading the same file again on the same machine does not touch the network.
+"""
 # taken from this StackOverflow answer: https://stackoverflow.com/a/39225039
+import os
 import sys
-import requests
+import shutil
+import hashlib
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 
-def download_file_from_google_drive(id, destination):
-    URL = "https://docs.google.com/uc?export=download"
+URL = "https://docs.google.com/uc?export=download"
+CHUNK_SIZE = 1 << 20
+RETRIES = 5
+TIMEOUT = 60
+CACHE_ENV = "NIRTOOLS_CACHE"
 
-    session = requests.Session()
+_RETRIED_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
 
-    response = session.get(URL, params={"id": id}, stream=True)
-    token = get_confirm_token(response)
-
-    if token:
-        params = {"id": id, "confirm": token}
-        response = session.get(URL, params=params, stream=True)
 
-    save_response_content(response, destination)
+def default_cache_dir():
+    """
+    :return: str, $NIRTOOLS_CACHE if set, otherwise ~/.cache/nirtools, with a downloads/ subdirectory
+    """
+    root = os.environ.get(CACHE_ENV) or os.path.join(os.path.expanduser("~"), ".cache", "nirtools")
+    return os.path.join(root, "downloads")
 
 
 def get_confirm_token(response):
@@ -26,16 +42,287 @@ def get_confirm_token(response):
     return None
 
 
-def save_response_content(response, destination):
-    CHUNK_SIZE = 32768
-
+def save_response_content(response, destination, chunk_size=CHUNK_SIZE):
     with open(destination, "wb") as f:
-        for chunk in response.iter_content(CHUNK_SIZE):
+        for chunk in response.iter_content(chunk_size):
             if chunk:  # filter out keep-alive new chunks
                 f.write(chunk)
 
 
+def _parse_checksum(checksum):
+    """
+    :param checksum: str, "algorithm:hexdigest" with an algorithm of hashlib, or a bare sha256 hexdigest
+    :return: (algorithm, hexdigest)
+    """
+    algorithm, _, digest = checksum.rpartition(":")
+    algorithm = algorithm or "sha256"
+    if algorithm not in hashlib.algorithms_available:
+        raise ValueError(f"Unexpected checksum algorithm {algorithm}, expected one of hashlib.algorithms_available")
+    return algorithm, digest.lower()
+
+
+def file_digest(fn, algorithm="sha256", chunk_size=CHUNK_SIZE):
+    h = hashlib.new(algorithm)
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _place(src, destination, link=True):
+    """
+    Put a copy of src at destination atomically, as a hard link if possible
+    """
+    tmp_fn = f"{destination}.tmp{os.getpid()}"
+    try:
+        try:
+            if not link:
+                raise OSError
+            os.link(src, tmp_fn)
+        except OSError:  # e.g. across file systems
+            shutil.copyfile(src, tmp_fn)
+        os.replace(tmp_fn, destination)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+
+def _cache_paths(cache_dir, id, sha256=None):
+    id_fn = os.path.join(cache_dir, "ids", id)
+    if sha256 is None:
+        try:
+            with open(id_fn) as f:
+                sha256 = f.read().strip()
+        except OSError:
+            return id_fn, None
+    return id_fn, os.path.join(cache_dir, "blobs", sha256)
+
+
+def _load_from_cache(cache_dir, id, checksum, destination):
+    algorithm, digest = _parse_checksum(checksum) if checksum else (None, None)
+    _, blob_fn = _cache_paths(cache_dir, id, sha256=digest if algorithm == "sha256" else None)
+    if blob_fn is None or not os.path.exists(blob_fn):
+        return False
+    if algorithm not in (None, "sha256") and file_digest(blob_fn, algorithm) != digest:
+        return False
+    _place(blob_fn, destination)
+    return True
+
+
+def _save_to_cache(cache_dir, id, destination, sha256):
+    id_fn, blob_fn = _cache_paths(cache_dir, id, sha256=sha256)
+    for dirname in (os.path.dirname(id_fn), os.path.dirname(blob_fn)):
+        os.makedirs(dirname, exist_ok=True)
+    if not os.path.exists(blob_fn):
+        _place(destination, blob_fn)
+    tmp_fn = f"{id_fn}.tmp{os.getpid()}"
+    with open(tmp_fn, "w") as f:
+        f.write(sha256)
+    os.replace(tmp_fn, id_fn)
+
+
+def _resolve(session, url, id):
+    """
+    :return: (params, response), the query parameters of the file content, past the confirmation
+        asked for large files, and the streamed response to them
+    """
+    params = {"id": id}
+    response = session.get(url, params=params, stream=True, timeout=TIMEOUT)
+    token = get_confirm_token(response)
+
+    if token:
+        response.close()
+        params = {"id": id, "confirm": token}
+        response = session.get(url, params=params, stream=True, timeout=TIMEOUT)
+    response.raise_for_status()
+    return params, response
+
+
+def _validator(response):
+    """
+    :return: str, the strong ETag of the content, or its Last-Modified date, None if the server sends neither
+    """
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):  # If-Range only accepts strong validators
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def _content_length(response):
+    """
+    :return: int, the full content length from a "Content-Range: bytes */<length>" header, None if unknown
+    """
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+def _download_range(session, url, params, part_fn, start=0, end=None, chunk_size=CHUNK_SIZE, retries=RETRIES,
+                    response=None, validator=None):
+    """
+    Download the bytes [start, end) of the content into part_fn, resuming after the bytes part_fn already
+    holds. A connection dropped before the end is retried, up to `retries` times in a row without progress.
+
+    :param end: int, None for the end of the content
+    :param response: the streamed response for the whole content, used if part_fn is empty
+    :param validator: str, see `_validator`, sent as If-Range so a content changed on the server is
+        sent whole instead of a range of it
+    """
+    failures = 0
+    while True:
+        done = os.path.getsize(part_fn) if os.path.exists(part_fn) else 0
+        if end is not None and start + done >= end:
+            break
+
+        headers = {}
+        if start + done > 0 or end is not None:
+            headers["Range"] = f"bytes={start + done}-{'' if end is None else end - 1}"
+            if validator:
+                headers["If-Range"] = validator
+        try:
+            if response is None or headers:
+                if response is not None:
+                    response.close()
+                response = session.get(url, params=params, headers=headers, stream=True, timeout=TIMEOUT)
+                if response.status_code == 416 and start == 0 and end is None:
+                    if _content_length(response) == done:
+                        break  # complete before the previous run was interrupted, verified by the checksum
+                    os.remove(part_fn)  # longer than the content, start over
+                    continue
+                response.raise_for_status()
+            if headers and response.status_code != 206:
+                if start > 0 or end is not None:
+                    raise ValueError(f"The server ignored the range request {headers['Range']}")
+                done = 0  # the server sends the whole content again
+
+            with open(part_fn, "ab" if done else "wb") as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+            if end is None:
+                break
+        except _RETRIED_ERRORS:
+            progress = (os.path.getsize(part_fn) if os.path.exists(part_fn) else 0) > done
+            failures = 0 if progress else failures + 1
+            if failures > retries:
+                raise
+        finally:
+            if response is not None:
+                response.close()
+                response = None
+
+
+def _segment_fns(part_fn, bounds):
+    return [f"{part_fn}.{start}-{end}" for start, end in zip(bounds, bounds[1:])]
+
+
+def _download_segments(session, url, params, part_fn, size, segments, chunk_size, retries, validator=None):
+    bounds = [size * i // segments for i in range(segments + 1)]
+    segment_fns = _segment_fns(part_fn, bounds)
+
+    def download(i):
+        segment_session = requests.Session()  # sessions are not thread-safe
+        segment_session.cookies.update(session.cookies)
+        with segment_session:
+            _download_range(
+                segment_session, url, params, segment_fns[i], bounds[i], bounds[i + 1], chunk_size, retries,
+                validator=validator,
+            )
+
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for future in [executor.submit(download, i) for i in range(segments)]:
+            future.result()
+
+    with open(part_fn, "wb") as f:
+        for segment_fn in segment_fns:
+            with open(segment_fn, "rb") as segment:
+                shutil.copyfileobj(segment, f, chunk_size)
+    for segment_fn in segment_fns:
+        os.remove(segment_fn)
+
+
+def _read_validator(validator_fn):
+    try:
+        with open(validator_fn) as f:
+            return f.read() or None
+    except OSError:
+        return None
+
+
+def _remove_parts(part_fn):
+    """
+    Remove the partial download, its segments and the validator of the content they hold
+    """
+    dirname, basename = os.path.split(os.path.abspath(part_fn))
+    for fn in os.listdir(dirname):
+        if fn == basename or fn.startswith(basename + "."):
+            os.remove(os.path.join(dirname, fn))
+
+
+def download_file_from_google_drive(
+    id, destination, chunk_size=CHUNK_SIZE, segments=1, checksum=None, cache=False, retries=RETRIES, url=URL
+):
+    """
+    :param id: str, the file id in the sharing link
+    :param destination: str, the output path, only written once the download is complete and verified
+    :param chunk_size: int, number of bytes read from the connection at a time
+    :param segments: int, download this many byte ranges in parallel if the server supports ranges
+    :param checksum: str, "algorithm:hexdigest" (e.g. "md5:...") or a sha256 hexdigest to verify the
+        content against, raise a ValueError and drop the download on mismatch
+    :param cache: bool or str, reuse the downloads kept in `default_cache_dir()` or the given directory;
+        cached files are hard-linked to the destination where possible, so modify them by replacement
+    :param retries: int, number of retries in a row without progress when the connection drops
+    :param url: str, the download endpoint
+    :return: str, the destination
+    """
+    cache_dir = (default_cache_dir() if cache is True else cache) if cache else None
+    if cache_dir and _load_from_cache(cache_dir, id, checksum, destination):
+        return destination
+
+    part_fn, validator_fn = destination + ".part", destination + ".part.validator"
+    with requests.Session() as session:
+        params, response = _resolve(session, url, id)
+        size = int(response.headers.get("Content-Length") or 0)
+        ranged = response.headers.get("Accept-Ranges") == "bytes" and "Content-Encoding" not in response.headers
+        validator = _validator(response)
+        if _read_validator(validator_fn) != validator:
+            _remove_parts(part_fn)  # downloaded from another version of the content
+        if validator:
+            with open(validator_fn, "w") as f:
+                f.write(validator)
+
+        if segments > 1 and ranged and size:
+            response.close()
+            if os.path.exists(part_fn):
+                os.remove(part_fn)  # the progress is kept per segment
+            _download_segments(session, url, params, part_fn, size, segments, chunk_size, retries, validator)
+        else:
+            resume = os.path.exists(part_fn) and os.path.getsize(part_fn) > 0
+            _download_range(session, url, params, part_fn, chunk_size=chunk_size, retries=retries,
+                            response=None if resume else response, validator=validator)
+
+    sha256 = None
+    if checksum:
+        algorithm, digest = _parse_checksum(checksum)
+        actual = file_digest(part_fn, algorithm)
+        if actual != digest:
+            _remove_parts(part_fn)
+            raise ValueError(f"Checksum mismatch for {id}: expected {algorithm}:{digest}, got {algorithm}:{actual}")
+        sha256 = actual if algorithm == "sha256" else None
+    os.replace(part_fn, destination)
+    _remove_parts(part_fn)
+
+    if cache_dir:
+        _save_to_cache(cache_dir, id, destination, sha256 or file_digest(destination))
+    return destination
+
+
 if __name__ == "__main__":
-    id = sys.argv[1]
-    desc = sys.argv[2]
-    download_file_from_google_drive(id, desc)
+    parser = ArgumentParser()
+    parser.add_argument("id", type=str)
+    parser.add_argument("destination", type=str)
+    parser.add_argument("--segments", "-s", type=int, default=1)
+    parser.add_argument("--checksum", type=str, help="algorithm:hexdigest, or a sha256 hexdigest")
+    parser.add_argument("--cache", action="store_true")
+    args = parser.parse_args(sys.argv[1:])
+    download_file_from_google_drive(
+        args.id, args.destination, segments=args.segments, checksum=args.checksum, cache=args.cache
+    )
@@ -1,6 +1,40 @@
-import tensorflow as tf
-from tensorflow.train import list_variables, load_checkpoint
-from tensorflow.python.tools.inspect_checkpoint import print_tensors_in_checkpoint_file
+"""
+Tools around tensorflow checkpoints. Tensorflow is only imported when a function needs it, and the
+variables of a checkpoint are read lazily (`LazyCheckpoint`) or one at a time (`iter_checkpoint`), so
+picking a few layers out of a large checkpoint does not load all the others.
+
+The variables can also be converted once into a safetensors file (8-byte little-endian header size,
+json header, raw little-endian tensor data), which `load_safetensors` memory-maps: the arrays are
+zero-copy views paged in from disk on access, and loading needs neither tensorflow nor safetensors.
+"""
+import re
+import json
+import mmap
+import logging
+import struct
+import fnmatch
+from functools import lru_cache
+from collections.abc import Mapping
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SAFETENSORS_ALIGNMENT = 8
+
+# numpy dtype name <-> safetensors dtype
+_SAFETENSORS_DTYPES = {
+    "float64": "F64", "float32": "F32", "float16": "F16", "bfloat16": "BF16", "int64": "I64", "int32": "I32",
+    "int16": "I16", "int8": "I8", "uint64": "U64", "uint32": "U32", "uint16": "U16", "uint8": "U8", "bool": "BOOL",
+}
+_NUMPY_DTYPES = {code: name for name, code in _SAFETENSORS_DTYPES.items()}
+
+
+@lru_cache(maxsize=None)
+def _tf():
+    import tensorflow
+
+    return tensorflow
 
 
 def inspect(ckpt_path, tensor_name=""):
@@ -12,6 +46,8 @@ def inspect(ckpt_path, tensor_name=""):
     :param tensor_name: the name of desired tensor, default to be ""
     :return:
     """
+    from tensorflow.python.tools.inspect_checkpoint import print_tensors_in_checkpoint_file
+
     print_tensors_in_checkpoint_file(
         file_name=ckpt_path, tensor_name=tensor_name, all_tensors=False
     )
@@ -53,6 +89,7 @@ def rename_variables(tvars, patterns, prefix="", save=False, outp_fn="converted.
             name = name.replace(ori, tgt)
         return name
 
+    tf = _tf()
     renamed_tvars = []
     with tf.Session().as_default() as sess:
         for var in tvars:
@@ -81,15 +118,223 @@ def convert_tvars_to_dict(tvars, name2nparr=None):
     return name2nparr
 
 
-def load_checkpoint_as_dict(path, keyword=""):
+def _name_filter(keyword="", pattern=None, glob=None):
+    """
+    :param keyword: str, keep the names containing it, case insensitive
+    :param pattern: str, keep the names matching this regular expression anywhere (`re.search`)
+    :param glob: str, keep the names matching this shell-style pattern, e.g. "bert/encoder/layer_1[01]/*"
+    :return: function, name -> bool, true for the names passing all the given filters
+    """
+    keyword = keyword.lower()
+    regex = re.compile(pattern) if pattern is not None else None
+
+    def keep(name):
+        if keyword not in name.lower():
+            return False
+        if regex is not None and not regex.search(name):
+            return False
+        return glob is None or fnmatch.fnmatchcase(name, glob)
+
+    return keep
+
+
+class LazyCheckpoint(Mapping):
+    """
+    Read-only mapping {name: np.ndarray} over the variables of a checkpoint, each read from disk on
+    first access. Only the checkpoint index is read when the mapping is created.
+
+    >>> ckpt = LazyCheckpoint("bert_large/model.ckpt", glob="bert/encoder/layer_23/*")
+    >>> ckpt.shapes
+    >>> kernel = ckpt["bert/encoder/layer_23/output/dense/kernel"]
+    """
+
+    def __init__(self, path, keyword="", pattern=None, glob=None, cache=True):
+        """
+        :param path: the checkpoint file path or directory
+        :param keyword, pattern, glob: only expose the matching variables, see `_name_filter`
+        :param cache: bool, keep the tensors read so far; otherwise every access reads from disk again
+        """
+        self.path = path
+        self.cache = cache
+        self._reader = _tf().train.load_checkpoint(path)
+        keep = _name_filter(keyword, pattern, glob)
+        shapes, dtypes = self._reader.get_variable_to_shape_map(), self._reader.get_variable_to_dtype_map()
+        self.shapes = {name: tuple(shapes[name]) for name in sorted(shapes) if keep(name)}
+        self._dtypes = {name: dtypes[name] for name in self.shapes}
+        self._tensors = {}
+
+    def dtype(self, name):
+        """
+        :return: np.dtype of the variable, without reading it
+        """
+        if name not in self.shapes:
+            raise KeyError(name)
+        return np.dtype(self._dtypes[name].as_numpy_dtype)
+
+    def __getitem__(self, name):
+        if name not in self.shapes:
+            raise KeyError(name)
+        if name in self._tensors:
+            return self._tensors[name]
+        tensor = self._reader.get_tensor(name)
+        if self.cache:
+            self._tensors[name] = tensor
+        return tensor
+
+    def __iter__(self):
+        return iter(self.shapes)
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __contains__(self, name):
+        return name in self.shapes
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.path!r}, {len(self)} variables, {len(self._tensors)} loaded)"
+
+
+def iter_checkpoint(path, keyword="", pattern=None, glob=None):
+    """
+    Read the variables of a checkpoint one at a time, in name order, so at most one is held in memory
+
+    :param path: the checkpoint file path or directory
+    :param keyword, pattern, glob: only read the matching variables, see `_name_filter`
+    :return: a iterator yielding (name, np.ndarray)
+    """
+    ckpt = LazyCheckpoint(path, keyword=keyword, pattern=pattern, glob=glob, cache=False)
+    for name in ckpt:
+        yield name, ckpt[name]
+
+
+def load_checkpoint_as_dict(path, keyword="", pattern=None, glob=None, lazy=False):
     """
     load the tensorflow dictionary from checkpoint file and convert it to a dictionary mapping name to value
+
     :param path: the checkpoint file path
+    :param keyword: only load the variables whose name contains the keyword, case insensitive
+    :param pattern, glob: only load the variables matching the regular expression or shell-style pattern
+    :param lazy: bool, return a `LazyCheckpoint` reading each variable on first access instead
     :return: the dictionary in the format of {dict: np.Array}
     """
-    reader = load_checkpoint(ckpt_dir_or_file=path)
-    return {
-        name: reader.get_tensor(name)
-        for name, shape in list_variables(path)
-        if keyword.lower() in name.lower()
-    }
+    if lazy:
+        return LazyCheckpoint(path, keyword=keyword, pattern=pattern, glob=glob)
+    return dict(iter_checkpoint(path, keyword=keyword, pattern=pattern, glob=glob))
+
+
+def _safetensors_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.name not in _SAFETENSORS_DTYPES:
+        raise TypeError(f"Unsupported dtype {dtype} for safetensors, expected one of {list(_SAFETENSORS_DTYPES)}")
+    return _SAFETENSORS_DTYPES[dtype.name]
+
+
+def _numpy_dtype(code):
+    if code not in _NUMPY_DTYPES:
+        raise TypeError(f"Unsupported safetensors dtype {code}, expected one of {list(_NUMPY_DTYPES)}")
+    if code == "BF16":
+        import ml_dtypes  # installed along with tensorflow
+
+        return np.dtype(ml_dtypes.bfloat16).newbyteorder("<")
+    return np.dtype(_NUMPY_DTYPES[code]).newbyteorder("<")
+
+
+def _write_safetensors(f, specs, tensors, metadata=None):
+    """
+    :param specs: list of (name, dtype, shape), in the order the tensors are written
+    :param tensors: iterable of np.ndarray aligned with specs, consumed one at a time
+    """
+    header, offset = {}, 0
+    for name, dtype, shape in specs:
+        size = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        header[name] = {"dtype": _safetensors_dtype(dtype), "shape": list(shape), "data_offsets": [offset, offset + size]}
+        offset += size
+    if metadata:
+        header["__metadata__"] = {str(k): str(v) for k, v in metadata.items()}
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-len(header) % SAFETENSORS_ALIGNMENT)  # so the data starts aligned
+
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
+    for (name, dtype, shape), tensor in zip(specs, tensors):
+        tensor = np.asarray(tensor)
+        if tensor.dtype != dtype or tensor.shape != tuple(shape):
+            raise ValueError(f"Expect {name} of dtype {dtype} and shape {tuple(shape)}, but got {tensor.dtype} {tensor.shape}")
+        f.write(np.ascontiguousarray(tensor, dtype=tensor.dtype.newbyteorder("<")).tobytes())
+
+
+def save_safetensors(tensors, outp_fn, metadata=None):
+    """
+    :param tensors: dict in format {name: np.ndarray}
+    :param outp_fn: output path
+    :param metadata: dict in format {str: str}, stored in the header
+    """
+    tensors = {name: np.asarray(tensor) for name, tensor in tensors.items()}
+    specs = [(name, tensor.dtype, tensor.shape) for name, tensor in tensors.items()]
+    with open(outp_fn, "wb") as f:
+        _write_safetensors(f, specs, tensors.values(), metadata)
+
+
+def convert_checkpoint_to_safetensors(path, outp_fn, keyword="", pattern=None, glob=None):
+    """
+    Convert the (matching) variables of a checkpoint into a safetensors file for fast repeated loads,
+    see `load_safetensors`. The variables are streamed, holding one in memory at a time. Variables
+    safetensors cannot store, e.g. the string `_CHECKPOINTABLE_OBJECT_GRAPH` of every object-based
+    checkpoint, are skipped.
+
+    :param path: the checkpoint file path or directory
+    :param outp_fn: output path
+    :param keyword, pattern, glob: only convert the matching variables, see `_name_filter`
+    """
+    ckpt = LazyCheckpoint(path, keyword=keyword, pattern=pattern, glob=glob, cache=False)
+    specs, skipped = [], []
+    for name, shape in ckpt.shapes.items():
+        dtype = ckpt.dtype(name)
+        if dtype.name in _SAFETENSORS_DTYPES:
+            specs.append((name, dtype, shape))
+        else:
+            skipped.append(name)
+    if skipped:
+        logger.info(f"Skip the variables of unsupported dtypes for safetensors: {skipped}")
+    with open(outp_fn, "wb") as f:
+        _write_safetensors(f, specs, (ckpt[name] for name, _, _ in specs), metadata={"source": path})
+
+
+def read_safetensors_header(fn):
+    """
+    :return: (header, data_start), the json header without "__metadata__" and the file offset of the data
+    """
+    with open(fn, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    return header, 8 + header_size
+
+
+def load_safetensors(fn, keyword="", pattern=None, glob=None, mmap_mode=True):
+    """
+    Load a safetensors file, e.g. written by `convert_checkpoint_to_safetensors`
+
+    :param fn: the safetensors file path
+    :param keyword, pattern, glob: only load the matching tensors, see `_name_filter`
+    :param mmap_mode: bool, memory-map the file and return read-only views into it, which cost nothing
+        until accessed and are shared between processes by the page cache; otherwise read copies
+    :return: the dictionary in the format of {name: np.ndarray}, in file order
+    """
+    header, data_start = read_safetensors_header(fn)
+    keep = _name_filter(keyword, pattern, glob)
+    names = sorted((name for name in header if keep(name)), key=lambda name: header[name]["data_offsets"][0])
+
+    tensors = {}
+    with open(fn, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if mmap_mode else None
+        for name in names:
+            info = header[name]
+            dtype, (begin, end) = _numpy_dtype(info["dtype"]), info["data_offsets"]
+            if buffer is not None:
+                tensor = np.frombuffer(buffer, dtype=dtype, count=(end - begin) // dtype.itemsize, offset=data_start + begin)
+            else:
+                f.seek(data_start + begin)
+                tensor = np.frombuffer(f.read(end - begin), dtype=dtype)
+            tensors[name] = tensor.reshape(info["shape"])
+    return tensors
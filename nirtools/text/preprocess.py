@@ -1,28 +1,97 @@
 import os
 import re
+import multiprocessing
+from functools import partial, lru_cache
+from itertools import islice
+
+_CAMEL_PATTERNS = (re.compile("(.)([A-Z][a-z]+)"), re.compile("([a-z0-9])([A-Z])"))
+# the two camel patterns in one pass: a space goes before an uppercase letter either following a
+# lowercase letter or digit, or starting a capitalized word after any other character but a newline.
+# Both patterns in turn put exactly one space at the same positions
+_CAMEL_BOUNDARY_PATTERN = re.compile(r"(?=[A-Z])(?:(?<=[a-z0-9])|(?<=.)(?=.[a-z]))")
+_NON_ALPHABET_PATTERN = re.compile("[^A-Za-z ]")
+CHUNK_SIZE = 1000
+
+
+def _resources_dir():
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "resources")
+
+
+@lru_cache(maxsize=None)
+def _supported_langs():
+    return tuple(sorted(fn.replace(".txt", "") for fn in os.listdir(_resources_dir())))
+
+
+@lru_cache(maxsize=None)
+def _load_reserved_words(lang):
+    if lang not in _supported_langs():
+        raise ValueError(
+            f"Reserved words for language {lang} is not available. Please choose from %s"
+            % ",".join(_supported_langs())
+        )
+
+    with open(os.path.join(_resources_dir(), f"{lang}.txt")) as f:
+        return tuple(word.strip() for word in f)
 
 
 def get_lang_reserved_words(lang):
     """
-    Load the reserved words of the specified language
+    Load the reserved words of the specified language, read from the resources once per language
 
     :param lang: str, the name of the language
     :return: list, all the reserved keywords
     """
-    join, dirname, abspath = os.path.join, os.path.dirname, os.path.abspath
-    nirpath = dirname(dirname(abspath(__file__)))
-    root_path = join(nirpath, "resources")  # root_path = "../resources"
-    supported_lang = [fn.replace(".txt", "") for fn in os.listdir(root_path)]
-    if lang not in supported_lang:
-        raise ValueError(
-            "Reserved words for language {lang} is not available. Please choose from %s"
-            % ",".join(supported_lang)
-        )
+    return list(_load_reserved_words(lang))
+
 
-    with open(os.path.join(root_path, f"{lang}.txt")) as f:
-        reserved_words = [word.strip() for word in f]
+@lru_cache(maxsize=None)
+def _reserved_word_set(langs):
+    return frozenset(word for lang in langs for word in _load_reserved_words(lang))
 
-    return reserved_words
+
+def get_reserved_word_set(lang):
+    """
+    The reserved words as a set for fast membership tests, built once per (combination of) language
+
+    :param lang: str, the name of the language, or list of str to merge the words of several languages
+    :return: frozenset
+    """
+    langs = (lang,) if isinstance(lang, str) else tuple(sorted(set(lang)))
+    return _reserved_word_set(langs)
+
+
+def _remove_words(tokens_or_sent, words, return_str):
+    tokens = tokens_or_sent.split() if isinstance(tokens_or_sent, str) else tokens_or_sent
+    tokens = [word for word in tokens if word not in words]
+    return " ".join(tokens) if return_str else tokens
+
+
+def remove_reserved_words(tokens_or_batch, lang, return_str=True, batch=None):
+    """
+    Remove the reserved words of the language from the sentence, or from each sentence of a batch,
+    looking the words up once. To stop a corpus, the "remove_reserved_words" step of `Pipeline` also
+    fuses it with the other token filters.
+
+    >>> remove_reserved_words("func main", "go")
+    'main'
+    >>> remove_reserved_words([["func", "main"], ["return", "x"]], "go", return_str=False)
+    [['main'], ['x']]
+    >>> remove_reserved_words(["func main", "return x"], "go", batch=True)
+    ['main', 'x']
+
+    :param tokens_or_batch: str, list of tokens as returned with return_str=False, or a batch (list) of either
+    :param lang: str or list of str, see `get_reserved_word_set`
+    :param return_str: bool, return str when set to True, otherwise return tokenized list. default True
+    :param batch: bool, whether tokens_or_batch is a batch. By default, only a list of lists is taken as a
+        batch, since a list of str is read as one list of tokens; pass batch=True for a batch of str
+    :return: str (or tokenized list) after the reserved words are removed, or a list of them for a batch
+    """
+    reserved_words = get_reserved_word_set(lang)
+    if batch is None:
+        batch = not isinstance(tokens_or_batch, str) and any(not isinstance(item, str) for item in tokens_or_batch[:1])
+    if batch:
+        return [_remove_words(item, reserved_words, return_str) for item in tokens_or_batch]
+    return _remove_words(tokens_or_batch, reserved_words, return_str)
 
 
 def code_tokenize(sent, return_str=True, lowercase=True):
@@ -34,8 +103,7 @@ def code_tokenize(sent, return_str=True, lowercase=True):
     :return: str, the sentense after camel and snake case is tokenized
     """
     # tokenize according to camel
-    camel_patterns = [re.compile("(.)([A-Z][a-z]+)"), re.compile("([a-z0-9])([A-Z])")]
-    for pattern in camel_patterns:
+    for pattern in _CAMEL_PATTERNS:
         sent = pattern.sub(r"\1 \2", sent)
 
     # tokenize according to snake
@@ -58,7 +126,7 @@ def remove_non_alphabet(sent, return_str=True):
     :param return_str: bool, return str when set to True, otherwise return tokenized list. default True
     :return: str, the sentense after non-alphabetics are removed
     """
-    sent = re.sub("[^A-Za-z ]", " ", sent)
+    sent = _NON_ALPHABET_PATTERN.sub(" ", sent)
     sent = sent.split()  # remove consecutive whitespace
 
     if return_str:
@@ -81,3 +149,139 @@ def remove_unicharacter(sent, return_str=True):
         sent = " ".join(sent)
 
     return sent
+
+
+def _snake_split(sent):
+    return sent.replace("_", " ")
+
+
+def _filter_tokens(min_len, words, tokens):
+    if words:
+        return [token for token in tokens if len(token) > min_len and token not in words]
+    return [token for token in tokens if len(token) > min_len]
+
+
+def _text_ops(name, kwargs):
+    if name == "code_tokenize":
+        ops = [partial(_CAMEL_BOUNDARY_PATTERN.sub, " ")]
+        if kwargs.get("lowercase", True):
+            ops.append(str.lower)
+        return ops + [_snake_split]  # after lower, which never produces "_", so remove_non_alphabet can drop it
+    if name == "lowercase":
+        return [str.lower]
+    if name == "remove_non_alphabet":
+        return [partial(_NON_ALPHABET_PATTERN.sub, " ")]
+    raise ValueError(f"Unexpected preprocessing step {name}, expected one of {STEPS}")
+
+
+STEPS = (
+    "code_tokenize", "lowercase", "remove_non_alphabet", "remove_unicharacter", "remove_words", "remove_reserved_words"
+)
+_TOKEN_STEPS = ("remove_unicharacter", "remove_words", "remove_reserved_words")
+
+
+class Pipeline:
+    """
+    Chain of the preprocessing steps above, compiled once into as few passes over the text as possible:
+    the patterns are precompiled, the text is only split and joined where a step needs it, and the
+    consecutive token filters run in one pass. The output is the same as calling the functions in turn.
+
+    >>> pipeline = Pipeline(["code_tokenize", "remove_non_alphabet", "remove_unicharacter"])
+    >>> pipeline("func ( t * SecondaryTree )")
+    'func secondary tree'
+    >>> docs = pipeline.process_batch(docs)
+    >>> for doc in pipeline.process_iter(open("corpus.txt"), workers=8): ...
+    """
+
+    def __init__(self, steps, return_str=True):
+        """
+        :param steps: list of step names from `STEPS`, or (name, kwargs) pairs, where
+            "code_tokenize" takes lowercase (default True), "remove_words" takes words, the collection of
+            tokens to remove, and "remove_reserved_words" takes lang, see `remove_reserved_words`;
+            "lowercase" lowers the text and is not followed by a split on its own
+        :param return_str: bool, return str when set to True, otherwise return tokenized list. default True
+        """
+        self.steps = [(step, {}) if isinstance(step, str) else (step[0], dict(step[1])) for step in steps]
+        self.return_str = return_str
+        self._ops = self._compile()
+
+    def _compile(self):
+        ops, state, prev = [], "text", None  # state is "text", "raw" (unnormalized whitespace) or "tokens"
+        filter_args = None
+        for name, kwargs in self.steps:
+            if name in _TOKEN_STEPS:
+                if state != "tokens":
+                    ops.append(str.split)
+                    state, filter_args = "tokens", None
+                min_len, words = filter_args or (0, frozenset())
+                if name == "remove_unicharacter":
+                    min_len = max(min_len, 1)
+                elif name == "remove_reserved_words":
+                    words = words | get_reserved_word_set(kwargs["lang"])
+                else:
+                    words = words | frozenset(kwargs["words"])
+                if filter_args is not None:
+                    ops.pop()  # merge into the filter of the previous step
+                filter_args = (min_len, words)
+                ops.append(partial(_filter_tokens, min_len, words))
+                prev = name
+                continue
+
+            text_ops = _text_ops(name, kwargs)
+            if state == "tokens":
+                ops.append(" ".join)
+            elif state == "raw" and "remove_non_alphabet" not in (prev, name):
+                # the functions split and join between the steps; it is only a no-op around
+                # remove_non_alphabet, which maps all whitespace to single spaces anyway
+                ops.extend([str.split, " ".join])
+            if name == "remove_non_alphabet" and ops and ops[-1] is _snake_split:
+                ops.pop()  # "_" is removed as a non-alphabet character
+            ops.extend(text_ops)
+            state, prev = "raw", name
+
+        if state != "tokens":
+            ops.append(str.split)
+        if self.return_str:
+            ops.append(" ".join)
+        return ops
+
+    def process(self, sent):
+        for op in self._ops:
+            sent = op(sent)
+        return sent
+
+    __call__ = process
+
+    def process_batch(self, sents):
+        """
+        :param sents: iterable of str
+        :return: list, the processed sentences
+        """
+        sents = list(sents)
+        for op in self._ops:  # one step over the whole batch at a time, so map runs the builtin ops in C
+            sents = list(map(op, sents))
+        return sents
+
+    def process_iter(self, sents, workers=None, chunksize=CHUNK_SIZE):
+        """
+        Process a corpus lazily in worker processes, keeping the input order
+
+        :param sents: iterable of str, e.g. a file object
+        :param workers: int, number of processes, default to the number of cpus; 1 processes in place
+        :param chunksize: int, number of sentences sent to a worker at a time
+        :return: a iterator yielding the processed sentences
+        """
+        sents = iter(sents)
+        chunks = iter(lambda: list(islice(sents, chunksize)), [])
+        workers = workers or multiprocessing.cpu_count()
+        if workers == 1:
+            for chunk in chunks:
+                yield from self.process_batch(chunk)
+            return
+
+        with multiprocessing.Pool(workers) as pool:
+            for outputs in pool.imap(self.process_batch, chunks):
+                yield from outputs
+
+    def __repr__(self):
+        return f"{type(self).__name__}({[name for name, _ in self.steps]})"
@@ -1,5 +1,11 @@
+import os
+import gzip
 from collections import OrderedDict
-from nirtools.ir import sort_qid_docid_value_dict
+
+import numpy as np
+import pytest
+
+from nirtools.ir import sort_qid_docid_value_dict, load_runs_from_file_contents, load_runs, load_qrels, write_runs, Run, Qrels
 
 
 def test_sort_qid_docid_value_dict():
@@ -8,4 +14,377 @@ def test_sort_qid_docid_value_dict():
         "2": {"DOC-02": 1, "DOC-01": 0},
         "10": {"DOC-30": 2, "DOC-3": 0},
     })
-    assert sort_qid_docid_value_dict(qrels) == expected
\ No newline at end of file
+    assert sort_qid_docid_value_dict(qrels) == expected
+
+RUN_LINES = [
+    "2 Q0 DOC-1 1 3.5 test\n",
+    "2 Q0 DOC-2 2 1.25 test\n",
+    "10 Q0 DOC-3 1 0.5 test\n",
+    "2 Q0 DOC-1 3 4.0 test\n",
+    "10 Q0 DOC-1 2 0.5 test\n",
+]
+
+
+def test_run_from_records_matches_dict():
+    runs = load_runs_from_file_contents(RUN_LINES)
+    array_runs = load_runs_from_file_contents(RUN_LINES, as_array=True)
+    assert isinstance(array_runs, Run)
+    assert array_runs.to_dict() == runs
+    assert list(array_runs) == ["2", "10"]
+    assert list(array_runs["2"].items()) == [("DOC-1", 4.0), ("DOC-2", 1.25)]
+    assert array_runs.num_entries == 4
+    assert Run.from_dict(runs).to_dict() == runs
+
+    # bytes columns, grouped by query, with and without a repeated (qid, docid) pair
+    qids, docids = np.array([b"2", b"2", b"10"]), np.array([b"doc-10", b"doc-9", b"doc-10"])
+    assert Run.from_records(qids, docids, [1, 2, 3]).to_dict() == {"2": {"doc-10": 1, "doc-9": 2}, "10": {"doc-10": 3}}
+    assert list(Run.from_records(qids[[0, 1, 0]], docids[[0, 1, 0]], [1, 2, 3])["2"].items()) == [("doc-10", 3), ("doc-9", 2)]
+
+    # concatenated in order, with and without a query in several parts
+    parts = [Run.from_dict({"2": {"b": 1, "a": 2}}), Run.from_dict({"10": {"c": 3, "a": 4}}), Run.from_dict({"2": {"a": 5}})]
+    assert Run.concat(parts[:2]).to_dict() == {"2": {"b": 1, "a": 2}, "10": {"c": 3, "a": 4}}
+    assert list(Run.concat(parts[:2]).docids) == ["a", "b", "c"]
+    assert Run.concat(parts).to_dict() == {"2": {"b": 1, "a": 5}, "10": {"c": 3, "a": 4}}
+    assert Run.concat([]).num_entries == 0
+
+
+def test_run_topk():
+    array_runs = load_runs_from_file_contents(RUN_LINES, as_array=True).topk(1)
+    assert array_runs.to_dict() == {"2": {"DOC-1": 4.0}, "10": {"DOC-3": 0.5}}
+
+
+def test_load_qrels_as_array(tmp_path):
+    fn = tmp_path / "qrels.txt"
+    fn.write_text("1 0 DOC-1 1\n1 0 DOC-2 0\n2 0 DOC-1 2\n")
+    qrels = load_qrels(str(fn), as_array=True)
+    assert isinstance(qrels, Qrels)
+    assert qrels.to_dict() == load_qrels(str(fn))
+    assert qrels.labels.tolist() == [1, 0, 2]
+
+
+def test_load_runs_whitespace_and_errors(tmp_path):
+    from nirtools.ir import _collect_records, _iter_rows
+
+    fn = tmp_path / "run.txt"
+    fn.write_bytes(b"1 Q0 d1 1 0.5 r\r\n1\tQ0\td2  2 1e3 r \n2 Q0 d\xc3\xa9 1 -2 r")
+    runs = load_runs(str(fn))
+    assert runs == {"1": {"d1": 0.5, "d2": 1000.0}, "2": {"dé": -2.0}}
+    assert load_runs(str(fn), as_array=True).to_dict() == runs
+    with open(fn, encoding="utf-8") as f:  # an ASCII batch followed by a non-ASCII one
+        qids, docids, scores = _collect_records(_iter_rows(f), batch_size=1)
+    assert qids.dtype.kind == "S" and docids.dtype.kind == "U"
+    assert Run.from_records(qids, docids, scores).to_dict() == runs
+
+    fn.write_text("1 Q0 d1 1 0.5 r\n1 Q0 d2 2 0.4\n")
+    with pytest.raises(ValueError):
+        load_runs(str(fn))
+
+
+def test_load_runs_topk_streaming():
+    lines = [f"{qid} Q0 DOC-{docid} 1 {docid % 3} r\n" for docid in range(10) for qid in ("1", "2")]
+    runs = load_runs_from_file_contents(lines, topk=4)
+    assert list(runs["1"].items()) == [("DOC-2", 2), ("DOC-5", 2), ("DOC-8", 2), ("DOC-1", 1)]
+    assert load_runs_from_file_contents(lines, topk=4, as_array=True).to_dict() == runs
+
+    # rising scores replace the smallest kept document, a repeated kept docid takes its last score
+    lines = [f"1 Q0 DOC-{docid} 1 {docid} r\n" for docid in range(10)] + ["1 Q0 DOC-8 1 0.5 r\n"]
+    assert list(load_runs_from_file_contents(lines, topk=3)["1"].items()) == [("DOC-9", 9), ("DOC-7", 7), ("DOC-8", 0.5)]
+
+    for topk in (0, -1, 1.5, True):
+        with pytest.raises(TypeError):
+            load_runs_from_file_contents(lines, topk=topk)
+
+
+def test_load_runs_parallel(tmp_path, monkeypatch):
+    from nirtools.ir import parallel
+
+    monkeypatch.setattr(parallel, "MIN_RANGE_SIZE", 64)
+    monkeypatch.setattr(parallel.os, "cpu_count", lambda: 2)
+    fn = tmp_path / "run.txt"
+    fn.write_text("".join(f"{qid} Q0 DOC-{docid} 1 {docid % 7} r\n" for qid in range(5) for docid in range(20)))
+    ranges = parallel.split_byte_ranges(str(fn), 7)
+    assert len(ranges) == 7 and ranges[0][0] == 0 and ranges[-1][1] == fn.stat().st_size
+    query_ranges = parallel._query_ranges(str(fn), ranges)
+    query_starts = [0] + [fn.read_text().index(f"\n{qid} ") + 1 for qid in range(1, 5)]
+    assert set(start for start, _ in query_ranges) <= set(query_starts) and query_ranges[-1][1] == fn.stat().st_size
+
+    ungrouped = tmp_path / "ungrouped.txt"
+    ungrouped.write_text("".join(f"{docid % 3} Q0 DOC-{docid} 1 {docid % 7} r\n" for docid in range(60)))
+    for path in (fn, ungrouped):
+        for topk in (None, 3):
+            runs = load_runs(str(path), topk=topk)
+            parallel_runs = load_runs(str(path), topk=topk, num_workers=2)
+            assert [list(docs.items()) for docs in parallel_runs.values()] == [list(docs.items()) for docs in runs.values()]
+            assert load_runs(str(path), topk=topk, num_workers=2, as_array=True).to_dict() == runs
+
+    monkeypatch.setattr(parallel.os, "cpu_count", lambda: 1)  # loaded serially, without a pool
+    monkeypatch.setattr(parallel, "ProcessPoolExecutor", None)
+    assert load_runs(str(fn), num_workers=4) == load_runs(str(fn))
+
+
+def test_write_runs(tmp_path):
+    runs = {"10": {"DOC-1": 0.5, "DOC-2": 1.5}, "2": {"DOC-3": 0.1}}
+    expected = "2\tQ0\tDOC-3\t1\t0.1\ttest\n10\tQ0\tDOC-2\t1\t1.5\ttest\n10\tQ0\tDOC-1\t2\t0.5\ttest\n"
+    for fn, source in [("run.txt", runs), ("array.txt", Run.from_dict(runs)), ("run.txt.gz", runs)]:
+        write_runs(source, str(tmp_path / "out" / fn))
+        with (gzip.open if fn.endswith(".gz") else open)(str(tmp_path / "out" / fn), "rt") as f:
+            assert f.read() == expected
+
+    write_runs(((qid, runs[qid]) for qid in ["10", "2"]), str(tmp_path / "stream.txt"))
+    assert (tmp_path / "stream.txt").read_text().splitlines()[0] == "10\tQ0\tDOC-2\t1\t1.5\ttest"
+
+
+def test_load_compressed_inputs(tmp_path):
+    import bz2
+    from nirtools.ir import load_collection_tsv
+
+    content = "1 Q0 DOC-1 1 0.5 r\n1 Q0 DOC-2 2 0.25 r\n"
+    with gzip.open(str(tmp_path / "run.gz"), "wt") as f:
+        f.write(content)
+    (tmp_path / "run_no_ext").write_bytes(bz2.compress(content.encode()))
+    expected = {"1": {"DOC-1": 0.5, "DOC-2": 0.25}}
+    assert load_runs(str(tmp_path / "run.gz")) == load_runs(str(tmp_path / "run_no_ext")) == expected
+
+    with gzip.open(str(tmp_path / "collection.tsv.gz"), "wt") as f:
+        f.write("DOC-1\thello world\nDOC-2\tbye\n")
+    assert list(load_collection_tsv(str(tmp_path / "collection.tsv.gz"))) == [("DOC-1", "hello world"), ("DOC-2", "bye")]
+
+
+def test_load_collection_trec(tmp_path):
+    from nirtools.ir import load_collection_trec
+
+    fn = tmp_path / "collection.trec"
+    fn.write_bytes(
+        b"<DOC>\n<DOCNO> DOC-1 </DOCNO>\n<HEADLINE>\nhead\n</HEADLINE>\n<TEXT>\nHello\n  world \n</TEXT>\n</DOC>\n"
+        b"<DOC>\n<DOCNO>DOC-2</DOCNO>\n<TEXT>\ninvalid \xff byte\n</TEXT>\n</DOC>\n"
+        b"<DOC>\n<DOCNO>DOC-3</DOCNO>\n</DOC>\n"
+    )
+    assert list(load_collection_trec(str(fn))) == [("DOC-1", "Hello world"), ("DOC-2", "invalid � byte")]
+    assert next(load_collection_trec(str(fn), fields=("HEADLINE", "TEXT"))) == ("DOC-1", "head Hello world")
+
+
+def _doc_length(docid, content):
+    return docid, len(content.split())
+
+
+def test_collection_shards_and_parallel_map(tmp_path):
+    from nirtools.ir.collection import iter_collection, parallel_map
+
+    docs = [(f"D{i}", " ".join(["w"] * (i % 7 + 1))) for i in range(500)]
+    trec = "".join(f"<DOC>\n<DOCNO>{docid}</DOCNO>\n<TEXT>\n{text}\n</TEXT>\n</DOC>\n" for docid, text in docs)
+    tsv = "".join(f"{docid}\t{text}\n" for docid, text in docs)
+    (tmp_path / "coll.trec").write_text(trec)
+    with gzip.open(tmp_path / "coll.tsv.gz", "wt") as f:
+        f.write(tsv)
+    (tmp_path / "dir").mkdir()
+    for i in range(5):
+        (tmp_path / "dir" / f"part{i}.tsv").write_text("".join(tsv.splitlines(True)[i * 100 : (i + 1) * 100]))
+
+    expected = [(docid, len(text.split())) for docid, text in docs]
+    for path in ["coll.trec", "coll.tsv.gz", "dir"]:
+        path = str(tmp_path / path)
+        shards = [list(iter_collection(path, num_shards=3, shard_id=i)) for i in range(3)]
+        assert all(shards) and sorted(sum(shards, [])) == sorted(docs)
+
+        assert list(parallel_map(_doc_length, path, workers=3, batch_size=16, queue_size=2)) == expected
+        assert sorted(parallel_map(_doc_length, path, workers=3, ordered=False)) == sorted(expected)
+
+    with pytest.raises(RuntimeError, match="TypeError"):
+        list(parallel_map(int, str(tmp_path / "coll.trec"), workers=2))
+
+
+def test_docstore(tmp_path):
+    from nirtools.ir.docstore import DocStore
+
+    docs = {f"D{i}": f"text of document {i}" for i in range(300)}
+    trec = "".join(f"<DOC>\n<DOCNO> {docid} </DOCNO>\n<TEXT>\n{text}\n</TEXT>\n</DOC>\n" for docid, text in docs.items())
+    (tmp_path / "coll.trec").write_text(trec)
+    with gzip.open(tmp_path / "coll.tsv.gz", "wt") as f:
+        f.write("".join(f"{docid}\t{text}\n" for docid, text in docs.items()))
+
+    for fn, kwargs in [("coll.trec", {}), ("coll.tsv.gz", {"block_size": 256})]:
+        store = DocStore(str(tmp_path / fn), cache_size=10, **kwargs)
+        assert len(store) == 300 and "D7" in store and "D300" not in store
+        assert store["D42"] == docs["D42"] and store.get("missing") is None
+        batch = ["D299", "D3", "missing", "D150", "D3"]
+        assert store.get_many(batch) == {docid: docs[docid] for docid in batch if docid in docs}
+        assert dict(store) == docs
+        store.close()
+
+    # the index is reused until the collection changes
+    index_fn = str(tmp_path / "coll.trec.docstore.npz")
+    mtime = os.path.getmtime(index_fn)
+    assert DocStore(str(tmp_path / "coll.trec"), build=False)["D1"] == docs["D1"]
+    assert os.path.getmtime(index_fn) == mtime
+
+
+def test_load_topics(tmp_path):
+    from nirtools.ir import load_topics, load_topic_trec, TOPIC_CACHE_SUFFIX
+
+    trec = (
+        "<top>\n<num> Number: 301\n<title> International Organized Crime\n\n"
+        "<desc> Description:\nIdentify organizations that participate in\ninternational criminal activity.\n\n"
+        "<narr> Narrative:\nA relevant document must name the organization.\n</top>\n\n"
+        "<top>\n<num> Number: 302 \n<title> Poliomyelitis and Post-Polio\n\n<desc> Description:\nIs the disease "
+        "under control?\n</top>\n"
+    )
+    with gzip.open(tmp_path / "topics.trec.gz", "wt") as f:
+        f.write(trec)
+    topics = load_topics(str(tmp_path / "topics.trec.gz"), fields=["title", "desc", "narr"])
+    assert topics == {
+        "301": {
+            "title": "International Organized Crime",
+            "desc": "Identify organizations that participate in international criminal activity.",
+            "narr": "A relevant document must name the organization.",
+        },
+        "302": {"title": "Poliomyelitis and Post-Polio", "desc": "Is the disease under control?"},
+    }
+    assert dict(load_topic_trec(str(tmp_path / "topics.trec.gz"), fields=["desc"]))["302"] == {
+        "desc": ["Is", "the", "disease", "under", "control?"]
+    }
+
+    (tmp_path / "ntcir.xml").write_text(
+        "<TOPIC><TOP><NUM>0001</NUM><TITLE>cheap flights</TITLE><DESCRIPTION>find cheap\nflights</DESCRIPTION>"
+        "</TOP><top lang='en'><num>C041</num><EN-title>Pesticides in Baby Food</EN-title>"
+        "<EN-narr>Any document on pesticides.</EN-narr></top></TOPIC>"
+    )
+    assert load_topics(str(tmp_path / "ntcir.xml"), fields=["title", "desc"]) == {
+        "0001": {"title": "cheap flights", "desc": "find cheap flights"},
+        "C041": {"title": "Pesticides in Baby Food"},
+    }
+
+    topic_fn = str(tmp_path / "cached.trec")
+    with open(topic_fn, "w") as f:
+        f.write(trec)
+    assert load_topics(topic_fn, cache=True) == load_topics(topic_fn)
+    assert os.path.exists(topic_fn + TOPIC_CACHE_SUFFIX)
+    assert load_topics(topic_fn, cache=True)["301"] == {"title": "International Organized Crime"}
+    assert "desc" in load_topics(topic_fn, fields=["desc"], cache=True)["301"]  # other fields are reparsed
+    with open(topic_fn, "w") as f:
+        f.write(trec.replace("301", "401"))
+    assert "401" in load_topics(topic_fn, cache=True)
+
+    with pytest.raises(ValueError):
+        load_topics(topic_fn, fields=["body"])
+
+
+def test_triples(tmp_path):
+    import json
+    import numpy as np
+    from nirtools.ir.docstore import DocStore
+    from nirtools.ir.triples import sample_triples, write_triples
+
+    rng = np.random.default_rng(0)
+    run = {f"q{q}": {f"d{d}": float(-rank) for rank, d in enumerate(rng.choice(100, 30, replace=False))} for q in range(20)}
+    qrels = {qid: {docid: 1 for docid in list(docs)[::7]} for qid, docs in run.items() if qid != "q3"}
+    qrels["q1"]["d999"] = 2  # positive outside the run
+    qrels["q2"] = {docid: 0 for docid in run["q2"]}  # judged, but no positive
+
+    qids, pos, neg = sample_triples(run, qrels, n_negatives=3, window=(2, 20), seed=1)
+    again = sample_triples(Run.from_dict(run), Qrels.from_dict(qrels), n_negatives=3, window=(2, 20), seed=1)
+    assert all((a == b).all() for a, b in zip((qids, pos, neg), again))
+    assert len(qids) == 3 * sum(1 for qid, docs in qrels.items() for label in docs.values() if label >= 1)
+    assert not {"q2", "q3"} & set(qids.tolist())
+    for qid, pos_docid, neg_docid in zip(qids.tolist(), pos.tolist(), neg.tolist()):
+        assert qrels[qid][pos_docid] >= 1 and qrels[qid].get(neg_docid, 0) < 1
+        assert 2 <= list(run[qid]).index(neg_docid) < 20
+    qids, _, _ = sample_triples(run, qrels, max_positives=1, seed=1)
+    assert len(qids) == len(set(qids.tolist())) == 18
+
+    with open(tmp_path / "collection.tsv", "w") as f:
+        f.write("".join(f"d{d}\tdoc {d}\n" for d in range(100)))
+    topics = {qid: f"query {qid}" for qid in run}
+    kwargs = dict(n_negatives=2, window=(0, 10), seed=3)
+    serial = write_triples(run, qrels, topics, str(tmp_path / "collection.tsv"), str(tmp_path / "a"), **kwargs)
+    assert [os.path.basename(fn) for fn, _ in serial] == ["a-00000.tsv"]
+    lines = open(tmp_path / "a-00000.tsv").read().splitlines()
+    assert len(lines) == serial[0][1] == len(sample_triples(run, qrels, **kwargs)[0]) - 2  # d999 is not in the collection
+    assert lines[0].startswith("query q0\tdoc ")
+
+    store = DocStore(str(tmp_path / "collection.tsv"))
+    sharded = write_triples(
+        run, qrels, topics, store, str(tmp_path / "b"), fmt="jsonl", compression="gz", num_shards=3, workers=2, **kwargs
+    )
+    rows = [json.loads(line) for fn, _ in sharded for line in gzip.open(fn, "rt")]
+    assert [row["query"] + " " + row["positive"] + " " + row["negative"] for row in rows] == [
+        line.replace("\t", " ") for line in lines
+    ]
+    assert rows[0]["positive"] == "doc " + rows[0]["pos_id"][1:]
+
+    # workers forked with the collection file open do not share its position
+    big_run = {f"q{q}": {f"d{d}": float(-rank) for rank, d in enumerate(rng.choice(5000, 50, replace=False))} for q in range(500)}
+    big_qrels = {qid: {docid: 1 for docid in list(docs)[:5]} for qid, docs in big_run.items()}
+    with open(tmp_path / "big.tsv", "w") as f:
+        f.write("".join(f"d{d}\tdoc {d}\n" for d in range(5000)))
+    store = DocStore(str(tmp_path / "big.tsv"), cache_size=0)
+    assert store["d1"] == "doc 1"
+    position = store._f.tell()
+    assert store["d4999"] == "doc 4999" and store._f.tell() == position
+    sharded = write_triples(
+        big_run, big_qrels, {qid: qid for qid in big_run}, store, str(tmp_path / "c"), num_shards=8, workers=4,
+        n_negatives=4, batch_size=100,
+    )
+    assert sum(n_written for _, n_written in sharded) == 10000
+
+
+def test_runops(tmp_path):
+    import numpy as np
+    from nirtools.ir import ArrayView, as_dict
+    from nirtools.ir.runops import cut, filter_qids, intersect_qids, merge_shards
+
+    rng = np.random.default_rng(0)
+    run = {f"q{q}": {f"d{d}": float(rng.integers(0, 5)) for d in rng.choice(50, 20, replace=False)} for q in range(10)}
+    runfile = str(tmp_path / "run.trec")
+    lines = [f"{qid} Q0 {docid} 0 {score} tag\n" for qid, docs in run.items() for docid, score in docs.items()]
+    rng.shuffle(lines)  # not grouped by query
+    open(runfile, "w").writelines(lines)
+
+    arr = Run.from_dict(run)
+    top = cut(arr, 5)
+    assert isinstance(top, ArrayView) and as_dict(top) == arr.topk(5).to_dict() == top.materialize().to_dict()
+    sorted_arr = arr.topk(100)
+    assert np.shares_memory(cut(sorted_arr, 5).query("q1")[1], sorted_arr.values)
+    cut(runfile, 5, outp_fn=str(tmp_path / "cut.trec"), tmp_dir=str(tmp_path))
+    assert load_runs(str(tmp_path / "cut.trec")) == {
+        qid: dict(sorted(docs.items(), key=lambda kv: -kv[1])[:5]) for qid, docs in load_runs(runfile).items()
+    }  # ties keep their order in the file, same for both
+
+    qids = ["q3", "q1", "missing"]
+    view = filter_qids(arr, qids)
+    assert list(view) == ["q1", "q3"] and view["q3"] == run["q3"]
+    assert np.shares_memory(view.query("q3")[1], arr.values)
+    filter_qids(runfile, qids, outp_fn=str(tmp_path / "filtered.trec"))
+    assert open(tmp_path / "filtered.trec").readlines() == [line for line in lines if line.split()[0] in qids]
+
+    other = {qid: docs for qid, docs in run.items() if qid in ("q2", "q5", "q11")}
+    other["q11"] = {"d1": 1.0}
+    write_runs(other, str(tmp_path / "other.trec"))
+    view1, view2 = intersect_qids(arr, other)
+    assert list(view1) == list(view2) == ["q2", "q5"]
+    fn1, fn2 = intersect_qids(runfile, str(tmp_path / "other.trec"), str(tmp_path / "i1.trec"), str(tmp_path / "i2.trec"))
+    assert set(load_runs(fn1)) == set(load_runs(fn2)) == {"q2", "q5"}
+
+    shards = [{qid: dict(list(docs.items())[i::3]) for qid, docs in run.items() if qid != f"q{i}"} for i in range(3)]
+    shard_fns = []
+    for i, shard in enumerate(shards):
+        shard_fns.append(str(tmp_path / f"shard{i}.trec"))
+        write_runs(shard, shard_fns[-1])
+    open(shard_fns[0], "a").write("q0 Q0 d100 1 9.0 test\n")  # no longer sorted by qid
+    merge_shards(shard_fns, str(tmp_path / "merged.trec"), tmp_dir=str(tmp_path))
+    expected = merge_shards(shards + [{"q0": {"d100": 9.0}}])
+    assert load_runs(str(tmp_path / "merged.trec")) == expected.to_dict()
+    assert expected["q0"]["d100"] == 9.0 and len(expected["q4"]) == 20
+    merge_shards(shard_fns, str(tmp_path / "merged10.trec"), topk=10, tmp_dir=str(tmp_path))
+    assert load_runs(str(tmp_path / "merged10.trec")) == expected.topk(10).to_dict()
+    assert not [fn for fn in os.listdir(tmp_path) if fn.endswith(".run")]  # the sorted copies are removed
+
+    # shards written by write_runs hold integer qids in int order, merged without sorting
+    numeric_fns = [str(tmp_path / "numeric0.trec"), str(tmp_path / "numeric1.trec")]
+    write_runs({"10": {"d1": 1.0}, "2": {"d2": 2.0}}, numeric_fns[0])
+    write_runs({"2": {"d3": 3.0}, "10": {"d4": 4.0}}, numeric_fns[1])
+    merged = merge_shards(numeric_fns, str(tmp_path / "numeric.trec"), tmp_dir=str(tmp_path / "missing"))
+    assert [line.split()[0] for line in open(merged)] == ["2", "2", "10", "10"]
+    assert list(merge_shards([{"10": {"d1": 1.0}}, {"2": {"d2": 2.0}}])) == ["2", "10"]
+
+    empty_tail = Run(np.array(["1", "2"]), np.array(["a", "b", "c"]), np.array([0, 3, 3]), np.array([0, 1, 2]), np.ones(3))
+    assert empty_tail.view(depth=1)["1"] == {"a": 1.0} and empty_tail.view(depth=1)["2"] == {}
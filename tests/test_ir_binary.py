@@ -0,0 +1,31 @@
+import os
+
+import numpy as np
+
+from nirtools.ir import load_runs, load_qrels, Run
+from nirtools.ir.binary import save_runs_binary, load_runs_binary, CACHE_SUFFIX
+
+
+def test_save_load_runs_binary(tmp_path):
+    runs = {"1": {"DOC-1": 1.5, "DOC-2": -0.25}, "2": {"DOC-3": 3.0}}
+    fn = str(tmp_path / "run.bin")
+    save_runs_binary(runs, fn)
+    loaded = load_runs_binary(fn)
+    assert isinstance(loaded, Run) and not loaded.values.flags.owndata
+    assert loaded.values.dtype == np.float32
+    assert loaded.to_dict() == runs
+
+
+def test_load_runs_cache(tmp_path):
+    fn = tmp_path / "run.txt"
+    fn.write_text("1 Q0 DOC-1 1 0.123456789012 r\n1 Q0 DOC-2 2 0.1 r\n")
+    runs = load_runs(str(fn), cache=True)
+    assert os.path.exists(str(fn) + CACHE_SUFFIX)
+    assert runs == load_runs(str(fn)) == load_runs(str(fn), cache=True)
+
+    fn.write_text("1 Q0 DOC-3 1 0.5 r\n")  # the changed source invalidates the sidecar
+    assert load_runs(str(fn), cache=True, as_array=True).to_dict() == {"1": {"DOC-3": 0.5}}
+
+    qrels_fn = tmp_path / "qrels.txt"
+    qrels_fn.write_text("1 0 DOC-1 1\n")
+    assert load_qrels(str(qrels_fn), cache=True) == load_qrels(str(qrels_fn), cache=True) == {"1": {"DOC-1": 1}}
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from nirtools.ir import Run, load_runs, write_runs
+from nirtools.ir.metrics import calc_aggregate
+from nirtools.ir.fusion import align_runs, fuse, fuse_runfiles, grid_search, weight_grid
+
+
+def _random_runs(n_runs=3, n_queries=20, n_docs=30, seed=0):
+    rng = np.random.default_rng(seed)
+    runs = []
+    for _ in range(n_runs):
+        run = {}
+        for q in range(n_queries):
+            docs = rng.choice(n_docs * 2, n_docs, replace=False)
+            run[f"q{q}"] = {f"d{d}": float(rng.normal()) for d in docs}
+        runs.append(run)
+    runs[0]["only-first"] = {"d1": 1.0, "d2": 1.0}  # constant scores
+    return runs
+
+
+def _reference(runs, method, weights, norm, k=60):
+    fused = {}
+    for qid in {qid for run in runs for qid in run}:
+        per_run = []
+        for run in runs:
+            docs = run.get(qid, {})
+            ranked = sorted(docs, key=lambda docid: -docs[docid])
+            values = np.array([docs[docid] for docid in ranked])
+            if method == "rrf":
+                per_run.append({docid: 1 / (k + rank) for rank, docid in enumerate(ranked, 1)})
+                continue
+            if norm == "minmax" and len(values):
+                span = values.max() - values.min()
+                values = (values - values.min()) / span if span > 0 else np.ones(len(values))
+            elif norm == "zscore" and len(values):
+                values = (values - values.mean()) / values.std() if values.std() > 0 else np.zeros(len(values))
+            per_run.append(dict(zip(ranked, values)))
+
+        docids = {docid for docs in per_run for docid in docs}
+        fused[qid] = {}
+        for docid in docids:
+            if method == "interpolate":
+                contributions = [docs.get(docid, min(docs.values(), default=0)) for docs in per_run]
+            else:
+                contributions = [docs.get(docid, 0) for docs in per_run]
+            score = sum(w * c for w, c in zip(weights, contributions))
+            if method == "combmnz":
+                score *= sum(docid in docs for docs in per_run)
+            fused[qid][docid] = score
+    return fused
+
+
+@pytest.mark.parametrize(
+    "method,norm", [("rrf", None), ("combsum", "minmax"), ("combmnz", "zscore"), ("interpolate", "minmax"),
+                    ("interpolate", "zscore"), ("combsum", None)]
+)
+def test_fuse(method, norm):
+    runs = _random_runs()
+    weights = [0.5, 0.3, 0.2]
+    fused = fuse(runs, method=method, weights=weights, norm=norm)
+    expected = _reference(runs, method, weights, norm)
+    assert set(fused) == set(expected)
+    for qid, docs in expected.items():
+        assert fused[qid] == pytest.approx(docs), qid
+
+
+def test_fuse_runfiles_and_grid_search(tmp_path):
+    runs = _random_runs(n_runs=2, seed=1)
+    runfiles = []
+    for i, run in enumerate(runs):
+        runfiles.append(str(tmp_path / f"run{i}.trec"))
+        write_runs(run, runfiles[-1])
+
+    fuse_runfiles(runfiles, str(tmp_path / "fused.trec.gz"), method="rrf", depth=10, topk=5)
+    fused = load_runs(str(tmp_path / "fused.trec.gz"))
+    expected = fuse([Run.from_dict(run).topk(10) for run in runs], method="rrf").topk(5).to_dict()
+    assert fused.keys() == expected.keys()
+    for qid, docs in expected.items():
+        assert fused[qid] == pytest.approx(docs)
+
+    aligned = align_runs(runfiles)
+    assert aligned.scores.shape == aligned.ranks.shape == (2, aligned.union.num_entries)
+
+    rng = np.random.default_rng(0)
+    qrels = {qid: {docid: int(rng.integers(0, 3)) for docid in docs} for qid, docs in runs[1].items()}
+    grid = weight_grid(2, step=0.25)
+    assert grid.tolist() == [[0, 1], [0.25, 0.75], [0.5, 0.5], [0.75, 0.25], [1, 0]]
+    assert len(weight_grid(3, step=0.5)) == 6
+
+    best, results = grid_search(runfiles, qrels, metric="nDCG@10", step=0.25, norm="zscore")
+    assert [w for w, _ in results] == grid.tolist()
+    for w, value in results:
+        expected = calc_aggregate(fuse(runs, method="interpolate", weights=w, norm="zscore"), qrels, ["nDCG@10"])
+        assert value == pytest.approx(expected["nDCG@10"])
+    assert best == max(results, key=lambda result: result[1])[0]
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from nirtools.ir import Run
+from nirtools.ir import metric_cache, sig_test
+from nirtools.ir.metric_cache import MetricCache, content_hash
+from nirtools.ir.sig_test import calc_score_matrix, batch_sig_test
+from nirtools.ir.eval import sig_test_from_runs
+
+
+QRELS = {"q1": {"d1": 1, "d2": 0}, "q2": {"d3": 2}}
+RUN = {"q1": {"d1": 1.5, "d2": 2.0}, "q2": {"d3": 0.1, "d4": 0.3}}
+
+
+real_walk = os.walk
+
+
+def test_content_hash():
+    shuffled = {"q2": {"d4": 0.3, "d3": 0.1}, "q1": {"d2": 2.0, "d1": 1.5}}
+    assert content_hash(RUN) == content_hash(shuffled) == content_hash(Run.from_dict(RUN))
+    assert content_hash(RUN) != content_hash({"q1": {"d1": 1.5, "d2": 2.5}, "q2": {"d3": 0.1, "d4": 0.3}})
+
+    run = Run.from_dict(RUN)
+    assert content_hash(run) == content_hash(RUN)
+    run.to_records = None  # hashed once per object
+    assert content_hash(run) == content_hash(RUN)
+
+
+def test_metric_cache(tmp_path, monkeypatch):
+    cache = MetricCache(str(tmp_path))
+    calls = []
+
+    def compute(metrics):
+        calls.append(metrics)
+        return {metric: {"q1": len(metric), "q2": 0.5} for metric in metrics}
+
+    assert cache.get_or_compute(QRELS, RUN, ["a"], compute) == {"a": {"q1": 1, "q2": 0.5}}
+    assert cache.get_or_compute(QRELS, RUN, ["a", "bb"], compute)["bb"] == {"q1": 2, "q2": 0.5}
+    assert calls == [["a"], ["bb"]]
+
+    # the default cache of the evaluation functions, shared through the environment
+    monkeypatch.setenv("NIRTOOLS_CACHE", str(tmp_path / "env"))
+    expected = calc_score_matrix(QRELS, [RUN], metrics=["AP", "P@1"])[1]
+    assert (calc_score_matrix(QRELS, [RUN], metrics=["AP", "P@1"], cache=True)[1] == expected).all()
+    assert (calc_score_matrix(QRELS, [RUN], metrics=["AP", "P@1"], cache=True)[1] == expected).all()
+    assert sig_test_from_runs(QRELS, RUN, RUN, metric="P_1", cache=True) == pytest.approx(
+        sig_test_from_runs(QRELS, RUN, RUN, metric="P_1"), nan_ok=True
+    )
+    assert len(os.listdir(tmp_path / "env" / "metrics")) >= 2
+
+    # dict qrels are hashed once for all the runs, not once per run
+    hashed = []
+    counted = lambda obj: hashed.append(obj) or content_hash(obj)
+    monkeypatch.setattr(metric_cache, "content_hash", counted)
+    monkeypatch.setattr(sig_test, "content_hash", counted)
+    batch_sig_test(QRELS, {"a": RUN, "b": dict(RUN), "c": dict(RUN)}, metrics=["AP", "P@1"], cache=True)
+    assert sum(obj is QRELS for obj in hashed) == 1 and len(hashed) == 4
+
+    # the directory is only walked once, then when the size limit is passed
+    walks = []
+    monkeypatch.setattr(os, "walk", lambda *args: walks.append(args) or real_walk(*args))
+    bounded = MetricCache(str(tmp_path / "bounded"), max_size=1000)
+    for i in range(100):
+        bounded.put("qrels", "run", f"m{i}", {"q1": 0.5, "q2": 1.0})
+    sizes = [os.path.getsize(os.path.join(root, fn)) for root, _, fns in real_walk(tmp_path / "bounded") for fn in fns]
+    assert bounded._size == sum(sizes) <= 1000 and len(walks) < 100 // 4
+    assert bounded.get("qrels", "run", "m99") is not None and bounded.get("qrels", "run", "m0") is None
+
+    cache.max_size = 0
+    cache.evict()
+    assert cache._size == 0
+    assert cache.get(content_hash(QRELS), content_hash(RUN), "a") is None
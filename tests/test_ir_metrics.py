@@ -0,0 +1,182 @@
+import os
+
+import numpy as np
+import pytest
+import ir_measures
+import pytrec_eval
+
+from nirtools.ir import Run, Qrels
+from nirtools.ir.metrics import calc_per_query, calc_aggregate, parse_metric, from_trec_eval_name
+
+
+def _random_run_qrels(n_queries=50, n_docs=80, seed=0):
+    rng = np.random.default_rng(seed)
+    run, qrels = {}, {}
+    for q in range(n_queries):
+        docs = rng.choice(n_docs * 3, n_docs, replace=False)
+        run[f"q{q}"] = {f"d{d}": float(rng.integers(0, 20)) / 3 for d in docs}  # many ties
+        if q % 7 == 0:
+            continue  # only in the run
+        judged = rng.choice(n_docs * 3, 40, replace=False)
+        qrels[f"q{q}"] = {f"d{d}": int(rng.integers(-1, 4)) for d in judged}
+    qrels["only-in-qrels"] = {"d1": 1}
+    qrels["no-relevant"] = {"d1": 0}
+    run["no-relevant"] = {"d1": 1.0, "d2": 2.0}
+    return run, qrels
+
+
+def test_matches_ir_measures():
+    run, qrels = _random_run_qrels()
+    metrics = ["AP", "nDCG", "nDCG@10", "RR", "RR@10", "P@5", "P@20", "R@50", "Rprec"]
+    expected = {
+        (str(m.measure), m.query_id): m.value
+        for m in ir_measures.iter_calc([ir_measures.parse_measure(metric) for metric in metrics], qrels, run)
+    }
+    qids, results = calc_per_query(Run.from_dict(run), Qrels.from_dict(qrels), metrics)
+    assert sorted(qids.tolist()) == sorted({qid for _, qid in expected})
+    for metric in metrics:
+        for qid, value in zip(qids.tolist(), results[metric]):
+            assert value == pytest.approx(expected[(metric, qid)], abs=1e-9), (metric, qid)
+
+    # dict input and the aggregate
+    aggregate = ir_measures.calc_aggregate([ir_measures.parse_measure("AP")], qrels, run)
+    assert calc_aggregate(run, qrels, ["AP"])["AP"] == pytest.approx(list(aggregate.values())[0], abs=1e-9)
+
+
+def test_trec_eval_names():
+    run, qrels = _random_run_qrels(seed=1)
+    names = ["map", "ndcg_cut_10", "P_5", "recall_20", "Rprec", "recip_rank"]
+    expected = pytrec_eval.RelevanceEvaluator(qrels, set(names)).evaluate(run)
+    qids, results = calc_per_query(Run.from_dict(run), qrels, [from_trec_eval_name(name) for name in names])
+    for name in names:
+        values = dict(zip(qids.tolist(), results[from_trec_eval_name(name)]))
+        for qid, scores in expected.items():
+            assert values[qid] == pytest.approx(scores[name], abs=1e-9), (name, qid)
+    assert from_trec_eval_name("bpref") is None
+
+
+def test_parse_metric():
+    assert parse_metric("nDCG@10") == ("nDCG", 10)
+    assert parse_metric(ir_measures.parse_measure("RR")) == ("RR", None)
+    for metric in ["P", "AP@10", "ERR@10", "nDCG(dcg='exp-log2')@10"]:
+        with pytest.raises(ValueError):
+            parse_metric(metric)
+
+
+def test_evaluate_many(tmp_path):
+    from nirtools.ir import write_runs, write_qrels, load_runs
+    from nirtools.ir.eval import evaluate_many
+
+    run, qrels = _random_run_qrels(seed=2)
+    write_qrels(qrels, str(tmp_path / "qrels.txt"))
+    runfiles = []
+    for i in range(3):
+        shifted = {
+            qid: {docid: score + (i if docid.endswith("1") else 0) for docid, score in docs.items()}
+            for qid, docs in run.items()
+        }
+        runfiles.append(str(tmp_path / f"run{i}.trec"))
+        write_runs(shifted, runfiles[-1])
+    (tmp_path / "broken.trec").write_text("q1 Q0 d1 1\n")
+    runfiles.insert(1, str(tmp_path / "broken.trec"))
+
+    metrics = ["map", "ndcg_cut_10", "bpref"]
+    results = evaluate_many(runfiles, str(tmp_path / "qrels.txt"), metrics, workers=2, per_query=True)
+    results = {result.runfile: result for result in results}
+    assert set(results) == set(runfiles)
+    assert "ValueError" in results[str(tmp_path / "broken.trec")].error
+
+    evaluator = pytrec_eval.RelevanceEvaluator(qrels, set(metrics))
+    for runfile in runfiles[:1] + runfiles[2:]:
+        expected = evaluator.evaluate(load_runs(runfile))
+        result = results[runfile]
+        assert result.error is None
+        for metric in metrics:
+            assert result.per_query[metric] == pytest.approx({qid: scores[metric] for qid, scores in expected.items()})
+            assert result.scores[metric] == pytest.approx(np.mean([scores[metric] for scores in expected.values()]))
+
+
+def test_calc_runfile(tmp_path):
+    from nirtools.ir import write_runs
+    from nirtools.ir.metrics import iter_calc_runfile, calc_runfile
+
+    run, qrels = _random_run_qrels(seed=3)
+    metrics = ["AP", "nDCG@10", "RR@10"]
+    qids, expected = calc_per_query(Run.from_dict(run), Qrels.from_dict(qrels), metrics)
+    expected = {qid: {metric: expected[metric][i] for metric in metrics} for i, qid in enumerate(qids.tolist())}
+
+    runfile = str(tmp_path / "run.trec")
+    write_runs(run, runfile)
+    results = dict(iter_calc_runfile(runfile, qrels, metrics, batch_entries=100))
+    assert results.keys() == expected.keys()
+    for qid, values in results.items():
+        assert values == pytest.approx(expected[qid])
+
+    lines = open(runfile).readlines()
+    np.random.default_rng(0).shuffle(lines)
+    shuffled = str(tmp_path / "shuffled.trec")
+    open(shuffled, "w").writelines(lines)
+    with pytest.raises(ValueError, match="not grouped"):
+        list(iter_calc_runfile(shuffled, qrels, metrics))
+
+    means = calc_runfile(shuffled, qrels, metrics, outp_fn=str(tmp_path / "eval.txt"), tmp_dir=str(tmp_path))
+    for metric in metrics:
+        assert means[metric] == pytest.approx(np.mean([values[metric] for values in expected.values()]))
+    outp = [line.split("\t") for line in open(tmp_path / "eval.txt").read().splitlines()]
+    assert len(outp) == (len(expected) + 1) * len(metrics)
+    assert outp[-1][:2] == ["RR@10", "all"]
+    assert sorted(os.listdir(tmp_path)) == ["eval.txt", "run.trec", "shuffled.trec"]  # no sort leftovers
+
+
+def test_query_wise_scores(tmp_path):
+    import pyarrow.parquet as pq
+    from nirtools.ir import write_runs, write_qrels
+    from nirtools.ir.eval import (
+        query_wise_scores, win_tie_loss, top_changes, write_query_wise_scores, query_wise_compare_runfiles
+    )
+
+    run, qrels = _random_run_qrels(seed=4)
+    other = {qid: {docid: -score for docid, score in docs.items()} for qid, docs in run.items() if qid != "q1"}
+    write_runs(other, str(tmp_path / "other.trec"))
+    metrics = ["map", "ndcg_cut_10", "bpref"]
+    comparison = query_wise_scores(
+        {"run": Run.from_dict(run), "dict": run, "other": str(tmp_path / "other.trec")}, qrels, metrics
+    )
+    assert comparison.scores.shape == (len(comparison.qids), 3, 3)
+
+    evaluator = pytrec_eval.RelevanceEvaluator(qrels, set(metrics))
+    expected = [evaluator.evaluate(run), evaluator.evaluate(other)]
+    for i, qid2scores in zip([0, 2], expected):
+        assert set(comparison.qids[~np.isnan(comparison.scores[:, i, 0])]) == set(qid2scores)
+        for j, metric in enumerate(metrics):
+            got = dict(zip(comparison.qids.tolist(), comparison.scores[:, i, j].tolist()))
+            assert {qid: got[qid] for qid in qid2scores} == pytest.approx(
+                {qid: scores[metric] for qid, scores in qid2scores.items()}
+            )
+    np.testing.assert_allclose(comparison.scores[:, 0], comparison.scores[:, 1])
+
+    wtl = win_tie_loss(comparison, baseline="run")
+    diff = comparison.scores[:, 2, 0] - comparison.scores[:, 0, 0]
+    assert (wtl.wins[2, 0], wtl.ties[2, 0], wtl.losses[2, 0]) == (
+        (diff > 0).sum(), (diff == 0).sum(), (diff < 0).sum()
+    )
+    assert wtl.ties[1].tolist() == [len(expected[0])] * 3 and wtl.wins[1].sum() == wtl.losses[1].sum() == 0
+
+    gains, losses = top_changes(comparison, baseline="run", n=3)[("other", "map")]
+    assert [qid for qid, _ in losses] == comparison.qids[np.argsort(np.nan_to_num(diff), kind="stable")[:3]].tolist()
+    assert all(change > 0 for _, change in gains) and all(change < 0 for _, change in losses)
+
+    write_query_wise_scores(comparison, str(tmp_path / "scores.tsv.gz"))
+    write_query_wise_scores(comparison, str(tmp_path / "scores.parquet"))
+    table = pq.read_table(str(tmp_path / "scores.parquet"))
+    assert table.column_names[:3] == ["qid", "run:map", "run:ndcg_cut_10"]
+    np.testing.assert_allclose(table.column("other:bpref").to_numpy(), comparison.scores[:, 2, 2])
+
+    write_qrels(qrels, str(tmp_path / "qrels.txt"))
+    write_runs(run, str(tmp_path / "run.trec"))
+    query_wise_compare_runfiles(
+        str(tmp_path / "run.trec"), str(tmp_path / "other.trec"), str(tmp_path / "qrels.txt"),
+        output_fn=str(tmp_path / "compare.txt"),
+    )
+    lines = open(tmp_path / "compare.txt").read().splitlines()
+    assert "q1\t" + str(expected[0]["q1"]["map"]) + "\t--" in lines
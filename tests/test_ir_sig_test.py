@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+from nirtools.ir import Run
+from nirtools.ir.sig_test import calc_score_matrix, batch_sig_test, sig_test_from_runs, format_sig_table
+
+
+def _make_runs(n_runs=3, n_queries=30, n_docs=20, seed=0):
+    rng = np.random.default_rng(seed)
+    qrels = {f"q{q}": {f"d{d}": int(rng.integers(0, 3)) for d in range(n_docs)} for q in range(n_queries)}
+    runs = {
+        f"run{i}": {f"q{q}": {f"d{d}": float(rng.random()) for d in range(n_docs)} for q in range(n_queries)}
+        for i in range(n_runs)
+    }
+    return qrels, runs
+
+
+def test_batch_sig_test_matches_pairwise():
+    qrels, runs = _make_runs()
+    rows = batch_sig_test(qrels, runs, metrics=["AP", "nDCG@10"], tests=["t-test", "wilcoxon", "sign"], baseline="run0")
+    assert len(rows) == 2 * 2 * 3
+    assert {(row.run1, row.run2) for row in rows} == {("run0", "run1"), ("run0", "run2")}
+
+    for row in rows:
+        if row.test == "t-test":
+            t, p, mean1, mean2 = sig_test_from_runs(qrels, runs[row.run1], runs[row.run2], metric=row.metric, return_scores=True)
+            assert (row.statistic, row.pvalue, row.mean1, row.mean2) == pytest.approx((t, p, mean1, mean2))
+
+    _, scores = calc_score_matrix(qrels, [runs["run0"], Run.from_dict(runs["run2"])], metrics=["AP"])
+    wilcoxon = [row for row in rows if row.test == "wilcoxon" and row.run2 == "run2" and row.metric == "AP"][0]
+    assert wilcoxon.pvalue == pytest.approx(stats.wilcoxon(scores[0, 0], scores[1, 0]).pvalue)
+    assert format_sig_table(rows).count("\n") == len(rows) + 1
+
+
+def test_wilcoxon_independent_of_batch():
+    from nirtools.ir.sig_test import _wilcoxon
+
+    rng = np.random.default_rng(0)
+    a, b = rng.random((3, 20)), rng.random((3, 20))
+    b[1, :5] = a[1, :5]  # zero differences on some queries
+    b[2] = a[2]  # on every query
+    statistic, pvalue = _wilcoxon(a, b)
+    for i in range(2):
+        assert (statistic[i], pvalue[i]) == pytest.approx(tuple(stats.wilcoxon(a[i], b[i])))
+        assert _wilcoxon(a[i : i + 1], b[i : i + 1])[1][0] == pvalue[i]
+    assert np.isnan(statistic[2]) and pvalue[2] == 1
+
+
+def test_score_matrix_fills_missing_queries():
+    qrels, runs = _make_runs(n_runs=2, n_queries=4)
+    del runs["run1"]["q2"]
+    qids, scores = calc_score_matrix(qrels, list(runs.values()), metrics=["P@5"])
+    assert qids == ["q0", "q1", "q2", "q3"]
+    assert scores.shape == (2, 1, 4) and scores[1, 0, 2] == 0
+
+
+def test_resampling_tests():
+    from nirtools.ir.sig_test import randomization_test, bootstrap_test
+
+    rng = np.random.default_rng(1)
+    base = rng.random((1, 200))
+    scores1 = np.concatenate([base + 0.1, base + rng.normal(0, 0.01, (1, 200)), base + 0.001])
+    scores2 = np.repeat(base, 3, axis=0)
+
+    for test in [randomization_test, bootstrap_test]:
+        diffs, pvalues = test(scores1, scores2, n_samples=2000, seed=0, chunk_size=300)
+        assert diffs == pytest.approx([0.1, (scores1[1] - base[0]).mean(), 0.001])
+        assert pvalues[0] < 0.001 and pvalues[1] > 0.01
+        assert (pvalues == test(scores1, scores2, n_samples=2000, seed=0)[1]).all()
+
+    # exact test: with 10 queries every sign assignment can be enumerated
+    diffs = rng.normal(0.2, 1, 10)
+    signs = np.array(np.meshgrid(*[[-1, 1]] * 10)).reshape(10, -1).T
+    exact = (np.abs(signs @ diffs) >= abs(diffs.sum()) - 1e-12).mean()
+    _, (pvalue,) = randomization_test(diffs, np.zeros(10), n_samples=20000, seed=0)
+    assert pvalue == pytest.approx(exact, abs=0.02)
+
+
+def test_adjust_pvalues():
+    from nirtools.ir.sig_test import adjust_pvalues
+
+    pvalues = [0.01, 0.04, 0.03, 0.2]
+    assert adjust_pvalues(pvalues, "bonferroni") == pytest.approx([0.04, 0.16, 0.12, 0.8])
+    assert adjust_pvalues(pvalues, "holm") == pytest.approx([0.04, 0.09, 0.09, 0.2])
+    assert adjust_pvalues(pvalues, "bh") == pytest.approx([0.04, 0.04 * 4 / 3, 0.04 * 4 / 3, 0.2])
+    with pytest.raises(ValueError):
+        adjust_pvalues(pvalues, "sidak")
+
+    qrels, runs = _make_runs()
+    rows = batch_sig_test(qrels, runs, tests=["randomization", "bootstrap"], correction="holm", n_samples=500, seed=0)
+    assert all(row.pvalue <= row.pvalue_adjusted <= 1 for row in rows)
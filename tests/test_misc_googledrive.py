@@ -0,0 +1,129 @@
+import os
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from nirtools.misc.googledrive import download_file_from_google_drive
+
+CONTENT = os.urandom(300000)
+
+
+class _DriveHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the Google Drive endpoint: asks for a confirmation through a cookie, supports ranges
+    of the content version `etag`, and drops the connection halfway through the first `drops` responses
+    """
+
+    log = []
+    drops = 0
+    ranges = True
+    etag = '"v1"'
+    range_etag = None  # the version If-Range is checked against, if the content changed since `etag` was sent
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        type(self).log.append((query.get("confirm"), self.headers.get("Range")))
+        if "confirm" not in query:
+            self.send_response(200)
+            self.send_header("Set-Cookie", "download_warning_123=token; Path=/")
+            self.send_header("Content-Length", "7")
+            self.end_headers()
+            self.wfile.write(b"warning")
+            return
+
+        start, end = 0, len(CONTENT)
+        if_range = self.headers.get("If-Range")
+        if self.headers.get("Range") and self.ranges and if_range in (None, self.range_etag or self.etag):
+            first, last = self.headers["Range"].replace("bytes=", "").split("-")
+            start, end = int(first), int(last) + 1 if last else len(CONTENT)
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(CONTENT)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(CONTENT)}")
+        else:
+            self.send_response(200)
+        if self.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+
+        if type(self).drops > 0:
+            type(self).drops -= 1
+            self.wfile.write(CONTENT[start : start + (end - start) // 2])
+            return  # HTTP/1.0, the connection is closed with the body incomplete
+        self.wfile.write(CONTENT[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def drive():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _DriveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _DriveHandler.log, _DriveHandler.drops, _DriveHandler.ranges = [], 0, True
+    _DriveHandler.etag, _DriveHandler.range_etag = '"v1"', None
+    yield f"http://127.0.0.1:{server.server_address[1]}/uc"
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_resume_and_checksum(drive, tmp_path):
+    destination = str(tmp_path / "file.bin")
+    _DriveHandler.drops = 2
+    sha256 = hashlib.sha256(CONTENT).hexdigest()
+    download_file_from_google_drive("abc", destination, chunk_size=4096, checksum=sha256, url=drive)
+    assert open(destination, "rb").read() == CONTENT
+    assert os.listdir(tmp_path) == ["file.bin"]
+    ranges = [byte_range for confirm, byte_range in _DriveHandler.log if confirm]
+    assert ranges[0] is None and all(byte_range.startswith("bytes=") for byte_range in ranges[1:])
+    assert 0 < int(ranges[1][6:-1]) <= len(CONTENT) // 2  # resumed after the bytes received
+
+    # a partial download left by a crash is resumed if it holds the same version of the content
+    def crashed(name, content, etag='"v1"'):
+        open(str(tmp_path / f"{name}.part"), "wb").write(content)
+        open(str(tmp_path / f"{name}.part.validator"), "w").write(etag)
+        _DriveHandler.log = []
+        download_file_from_google_drive("abc", str(tmp_path / name), url=drive)
+        assert open(tmp_path / name, "rb").read() == CONTENT
+        assert [fn for fn in os.listdir(tmp_path) if fn.startswith(name)] == [name]
+        return _DriveHandler.log[-1]
+
+    assert crashed("resumed.bin", CONTENT[:1000]) == (["token"], "bytes=1000-")
+    assert crashed("complete.bin", CONTENT) == (["token"], f"bytes={len(CONTENT)}-")  # answered with 416
+    assert crashed("stale.bin", CONTENT[:1000], etag='"v0"') == (["token"], None)  # the remote file changed
+    _DriveHandler.range_etag = '"v2"'  # changed after the confirmation, the server ignores the If-Range
+    assert crashed("changed.bin", b"garbage") == (["token"], "bytes=7-")
+    _DriveHandler.range_etag = None
+    _DriveHandler.ranges = False
+    assert crashed("restarted.bin", b"garbage") == (["token"], "bytes=7-")
+
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        download_file_from_google_drive("abc", str(tmp_path / "bad.bin"), checksum="md5:0", url=drive)
+    assert not [fn for fn in os.listdir(tmp_path) if fn.startswith("bad.bin")]
+
+
+def test_download_segments_and_cache(drive, tmp_path):
+    destination = str(tmp_path / "file.bin")
+    cache_dir = str(tmp_path / "cache")
+    download_file_from_google_drive("abc", destination, segments=4, cache=cache_dir, url=drive)
+    assert open(destination, "rb").read() == CONTENT
+    ranges = sorted(byte_range for confirm, byte_range in _DriveHandler.log if confirm and byte_range)
+    assert len(ranges) == 4 and ranges[0] == "bytes=0-74999"
+    assert [fn for fn in os.listdir(tmp_path) if fn.startswith("file.bin")] == ["file.bin"]
+
+    _DriveHandler.log = []
+    download_file_from_google_drive("abc", str(tmp_path / "again.bin"), cache=cache_dir, url=drive)
+    md5 = hashlib.md5(CONTENT).hexdigest()
+    download_file_from_google_drive("abc", str(tmp_path / "again_md5.bin"), checksum=f"md5:{md5}", cache=cache_dir, url=drive)
+    assert _DriveHandler.log == []  # served from the cache
+    assert open(tmp_path / "again.bin", "rb").read() == open(tmp_path / "again_md5.bin", "rb").read() == CONTENT
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from nirtools.tensorflow.ckpt import (
+    save_safetensors, load_safetensors, read_safetensors_header, load_checkpoint_as_dict, iter_checkpoint,
+    LazyCheckpoint, convert_checkpoint_to_safetensors,
+)
+
+
+def test_safetensors(tmp_path):
+    tensors = {
+        "bert/embeddings/word_embeddings": np.arange(12, dtype=np.float32).reshape(3, 4),
+        "bert/encoder/layer_0/bias": np.array([1, -2, 3], dtype=np.int64),
+        "bert/encoder/layer_1/bias": np.array([True, False]),
+        "global_step": np.array(7, dtype=np.int32),
+        "empty": np.zeros((0, 2), dtype=np.float16),
+    }
+    outp_fn = str(tmp_path / "model.safetensors")
+    save_safetensors(tensors, outp_fn, metadata={"format": "np"})
+
+    header, data_start = read_safetensors_header(outp_fn)
+    assert data_start % 8 == 0 and set(header) == set(tensors)
+    assert header["global_step"] == {"dtype": "I32", "shape": [], "data_offsets": [74, 78]}
+
+    for mmap_mode in (True, False):
+        loaded = load_safetensors(outp_fn, mmap_mode=mmap_mode)
+        assert list(loaded) == list(tensors)
+        for name, tensor in tensors.items():
+            assert loaded[name].dtype == tensor.dtype and np.array_equal(loaded[name], tensor)
+
+    assert list(load_safetensors(outp_fn, glob="bert/encoder/*")) == ["bert/encoder/layer_0/bias", "bert/encoder/layer_1/bias"]
+    assert list(load_safetensors(outp_fn, pattern=r"layer_\d/bias$", keyword="LAYER_1")) == ["bert/encoder/layer_1/bias"]
+
+    with pytest.raises(TypeError):
+        save_safetensors({"text": np.array(["a"])}, outp_fn)
+
+
+def test_lazy_checkpoint(tmp_path):
+    tf = pytest.importorskip("tensorflow")
+    variables = {"dense/kernel": np.ones((2, 3), dtype=np.float32), "dense/bias": np.arange(3, dtype=np.float32)}
+    checkpoint = tf.train.Checkpoint(**{name.replace("/", "_"): tf.Variable(value) for name, value in variables.items()})
+    path = checkpoint.write(str(tmp_path / "ckpt"))
+
+    eager = load_checkpoint_as_dict(path, keyword="dense_")
+    lazy = load_checkpoint_as_dict(path, keyword="dense_", lazy=True)
+    assert isinstance(lazy, LazyCheckpoint) and set(lazy) == set(eager) and len(lazy) == 2
+    assert repr(lazy).endswith("2 variables, 0 loaded)")
+    for name, tensor in iter_checkpoint(path, glob="dense_*"):
+        assert np.array_equal(lazy[name], tensor) and np.array_equal(eager[name], tensor)
+
+    outp_fn = str(tmp_path / "ckpt.safetensors")
+    convert_checkpoint_to_safetensors(path, outp_fn, keyword="dense_")
+    loaded = load_safetensors(outp_fn)
+    assert set(loaded) == set(eager) and all(np.array_equal(loaded[name], eager[name]) for name in eager)
+
+    # without a filter, the string variable holding the object graph is skipped
+    convert_checkpoint_to_safetensors(path, outp_fn)
+    assert "_CHECKPOINTABLE_OBJECT_GRAPH" in LazyCheckpoint(path)
+    assert set(load_safetensors(outp_fn)) == set(eager)
@@ -32,3 +32,59 @@ def test_remove_unicharacter():
                "EOF return btEPool2 get nil true atomic LoadUint64 ver nil"
     assert preprocess.remove_unicharacter(code) == expected
 
+
+
+def test_pipeline():
+    code = "func ( t * SecondaryTree ) SeekFirst ( ) ( e * SecondaryEnumerator , err error ) { q := t . first if q == nil { return nil , io . EOF } return btEPool2 . get ( nil , true , 0 , q . d [ 0 ] . k , q , t , atomic . LoadUint64 ( & t . ver ) ) , nil }"
+    docs = [code, "getHTTPResponse_code\nIOError\tXMLHttpRequest2Json", "", "a_b __init__ ΣΑΣ İx"]
+    functions = {
+        "code_tokenize": preprocess.code_tokenize,
+        "remove_non_alphabet": preprocess.remove_non_alphabet,
+        "remove_unicharacter": preprocess.remove_unicharacter,
+    }
+    chains = [
+        ["code_tokenize", "remove_non_alphabet", "remove_unicharacter"],
+        ["remove_non_alphabet", "code_tokenize"],
+        ["remove_unicharacter", "code_tokenize", "code_tokenize", "remove_unicharacter"],
+    ]
+    for chain in chains:
+        expected = []
+        for doc in docs:
+            for step in chain:
+                doc = functions[step](doc)
+            expected.append(doc)
+        pipeline = preprocess.Pipeline(chain)
+        assert [pipeline(doc) for doc in docs] == expected, chain
+        assert pipeline.process_batch(docs) == expected, chain
+        assert list(pipeline.process_iter(iter(docs * 3), workers=2, chunksize=2)) == expected * 3, chain
+
+    pipeline = preprocess.Pipeline(
+        [("code_tokenize", {"lowercase": False}), "remove_unicharacter", ("remove_words", {"words": ["err", "nil"]})],
+        return_str=False,
+    )
+    assert pipeline("if err != nil { return errNil }") == ["if", "!=", "return", "Nil"]
+
+
+def test_remove_reserved_words():
+    assert preprocess.get_reserved_word_set("ruby") == frozenset(preprocess.get_lang_reserved_words("ruby"))
+    assert preprocess.get_reserved_word_set(["go", "ruby"]) is preprocess.get_reserved_word_set(["ruby", "go"])
+    assert preprocess.get_reserved_word_set(["go", "ruby"]) >= preprocess.get_reserved_word_set("go")
+
+    words = preprocess.get_lang_reserved_words("go")
+    words.append("modified")  # the cached words are not affected
+    assert "modified" not in preprocess.get_lang_reserved_words("go")
+
+    code = "func ( t * SecondaryTree ) SeekFirst ( ) { if q == nil { return nil , io . EOF } }"
+    assert preprocess.remove_reserved_words(code, "go") == \
+        "( t * SecondaryTree ) SeekFirst ( ) { q == nil { nil , io . EOF } }"
+    assert preprocess.remove_reserved_words(["func", "x", "nil"], ["go", "ruby"], return_str=False) == ["x"]
+    assert preprocess.remove_reserved_words([["func", "x"], ["nil", "y"]], ["go", "ruby"]) == ["x", "y"]
+    assert preprocess.remove_reserved_words(["func x", "if y"], "go", return_str=False, batch=True) == [["x"], ["y"]]
+
+    pipeline = preprocess.Pipeline(
+        ["code_tokenize", "remove_non_alphabet", ("remove_reserved_words", {"lang": "go"}), "remove_unicharacter"]
+    )
+    expected = preprocess.remove_unicharacter(
+        preprocess.remove_reserved_words(preprocess.remove_non_alphabet(preprocess.code_tokenize(code)), "go")
+    )
+    assert pipeline(code) == expected == "secondary tree seek first nil nil io eof"